@@ -1,10 +1,46 @@
 import streamlit as st
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import pandas as pd
-import yfinance as yf
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
-from datetime import datetime, timedelta
-import html
+import numpy as np
+from datetime import date, datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from contextlib import closing
+from functools import partial
+import hashlib
+import importlib
+import os
+import sqlite3
+import threading
+
+import metrics
+from caches import ByteLRU, MemoryBudget
+from charts import (
+    MAX_TRADE_ANNOTATIONS,
+    RESOLUTION_LABELS,
+    build_equity_figure,
+    build_price_figure,
+    chart_window,
+    downsample_bars,
+    figure_from_bytes,
+    figure_to_bytes,
+)
+from cube import HOLD_BUCKET_LABELS, WEEKDAY_LABELS, build_trade_cube, cube_mask, cube_summary, rollup
+from excursions import excursion_ranges, excursion_summary, holding_period_stats, trade_excursions
+from fetch_scheduler import FetchScheduler
+from indicators import DEFAULT_INDICATORS, INDICATOR_PRESETS, add_indicators, indicator_warmup, parse_indicator
+from offload import OffloadPool
+from portfolio import equity_curve, portfolio_price_ranges, position_events
+from price_store import PriceStore
+from trade_analysis import (
+    COST_METHODS,
+    analyze_trade_performance,
+    dump_analysis_state,
+    load_analysis_state,
+    load_trade_bytes,
+)
+
+MAX_UPLOAD_MB = 200  # アップロード上限 (Streamlitの既定値に合わせる)
 
 # ページ設定
 st.set_page_config(
@@ -159,167 +195,882 @@ def local_css():
     </style>
     """, unsafe_allow_html=True)
 
-def load_and_process_data(file):
+# --- 株価キャッシュ (永続・差分取得) ---
+PRICE_CACHE_PATH = os.environ.get(
+    "PRICE_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "price_cache.sqlite3")
+)
+
+@st.cache_resource
+def get_fetch_scheduler():
     """
-    アップロードされたCSVファイルを読み込み、前処理を行う関数
+    取得元への問い合わせをプロセス全体で制御するスケジューラー (株価・銘柄名で共有)
     """
-    try:
-        # 1. ヘッダー行の動的特定
-        content = file.getvalue().decode("shift-jis", errors="ignore") # 日本語CSVを想定
-        lines = content.splitlines()
-        
-        header_row_index = None
-        for i, line in enumerate(lines):
-            if "約定日" in line and "銘柄コード" in line:
-                header_row_index = i
-                break
-        
-        if header_row_index is None:
-            return None, "CSV内に「約定日」または「銘柄コード」が見つかりませんでした。"
-
-        # 2. CSV読み込み
-        from io import StringIO
-        csv_data = StringIO("\n".join(lines[header_row_index:]))
-        df = pd.read_csv(csv_data)
-
-        # 3. 不要データの除外
-        df = df.dropna(subset=["銘柄コード"])
-
-        # 4. 銘柄コードの整形
-        def format_ticker(x):
-            if pd.isna(x):
-                return ""
-            s = str(x).replace(".0", "")
-            if not s.endswith(".T"):
-                return s + ".T"
-            return s
-
-        df["銘柄コード"] = df["銘柄コード"].apply(format_ticker)
-
-        # 5. 売買区分の判定
-        def get_side(x):
-            if not isinstance(x, str):
-                return None
-            if "買" in x:
-                return "Buy"
-            elif "売" in x:
-                return "Sell"
-            return None
-
-        df["Side"] = df["取引"].apply(get_side)
-        
-        # 6. 日付の処理
-        df["約定日"] = pd.to_datetime(df["約定日"])
+    scheduler = FetchScheduler()
+    metrics.register_gauge("fetch_queue_depth", lambda: scheduler.stats()["queue_depth"])
+    metrics.register_gauge("fetch_in_flight", lambda: scheduler.stats()["in_flight"])
+    return scheduler
 
-        return df, None
+MEMORY_BUDGET_MB = int(os.environ.get("MEMORY_BUDGET_MB", "256"))  # 全キャッシュ (チャート・セッションごとのメモ) の合計の上限
+SESSION_IDLE_MINUTES = 30  # これより長く操作の無いセッションのメモは捨てる (次の操作で再計算する)
+FIGURE_CACHE_MAX_MB = 64   # 作成済みチャートを保持するメモリの上限 (MEMORY_BUDGET_MB の内数)
 
-    except Exception as e:
-        return None, f"データ読み込み中にエラーが発生しました: {str(e)}"
+@st.cache_resource
+def get_memory_budget():
+    """
+    プロセス内の全キャッシュのバイト数を1つの上限で管理する (全セッションで共有)
+    上限を超えると、チャートかセッションのメモ (解析結果・分析結果など) かを問わず最も長く使われていないものから捨てる
+    """
+    budget = MemoryBudget(MEMORY_BUDGET_MB * 2**20)
+    metrics.register_gauge("memory_cache_bytes", lambda: budget.stats()["bytes"])
+    metrics.register_gauge("memory_cache_evictions", lambda: budget.stats()["evictions"])
+    metrics.register_gauge("memory_cache_sessions", lambda: budget.stats()["sessions"])
+    return budget
+
+@st.cache_resource
+def get_figure_cache():
+    """
+    作成済みチャート (圧縮したJSON) の LRU キャッシュ (全セッションで共有)
+    キーにアップロードのハッシュを含むため、同じCSVを開いたセッション同士でだけ再利用される
+    """
+    cache = ByteLRU("figure", FIGURE_CACHE_MAX_MB * 2**20, budget=get_memory_budget())
+    metrics.register_gauge("figure_cache_bytes", lambda: cache.stats()["bytes"])
+    metrics.register_gauge("figure_cache_entries", lambda: cache.stats()["entries"])
+    return cache
 
-def analyze_trade_performance(df):
+@st.cache_resource
+def get_price_store():
+    return PriceStore(PRICE_CACHE_PATH, scheduler=get_fetch_scheduler())
+
+def to_date_range(start, end):
     """
-    データフレーム全体から売買ペアを特定し、損益レシオと勝率を計算する
-    FIFO (先入れ先出し) 法でBuyとSellを突合
+    日付の閉区間 [start, end] を PriceStore 用の半開区間 [start, end+1日) に変換する (未来日は今日まで)
     """
-    # 数量カラムの特定
-    qty_col = None
-    for col in ['約定数量', '数量', '株数']:
-        if col in df.columns:
-            qty_col = col
-            break
-            
-    # 銘柄名カラムの特定
+    start = pd.Timestamp(start).date()
+    end = min(pd.Timestamp(end).date(), date.today()) + timedelta(days=1)
+    return start, end
+
+def fetch_stock_data(ticker, start, end):
+    """
+    株価の日足を取得する (start, end は日付として扱い、endを含む)
+    """
+    return get_price_store().get(ticker, *to_date_range(start, end))
+
+# --- 株価の先読み ---
+PREFETCH_WORKERS = 4  # 同時に取得する銘柄数の上限
+
+def build_prefetch_plan(df):
+    """
+    銘柄ごとの取引回数とチャート用の取得期間を求め、取引回数の多い順に並べる
+    """
+    plan = df.groupby("銘柄コード", observed=True)["約定日"].agg(["count", "min", "max"])
+    plan = plan.sort_values("count", ascending=False, kind="stable")
+    fetch_start, _, end = chart_window(plan["min"], plan["max"])
+    return pd.DataFrame({"count": plan["count"], "fetch_start": fetch_start, "end": end})
+
+class PricePrefetcher:
+    """
+    アップロード直後に全銘柄の日足をバックグラウンドで PriceStore に読み込む
+    取引回数の多い銘柄から順に、最大 max_workers 銘柄ずつ並行して取得する
+    """
+
+    def __init__(self, store, plan, max_workers=PREFETCH_WORKERS):
+        self.plan = plan
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="price-prefetch")
+        # 投入順 = 取得順 (ThreadPoolExecutorは先入れ先出し)
+        # キャッシュに無い期間を取り寄せるだけで、日足は読み出さない (チャートを開いたときに読み出す)
+        self.futures = {
+            ticker: self.executor.submit(store.ensure, ticker, *to_date_range(row.fetch_start, row.end))
+            for ticker, row in plan.iterrows()
+        }
+
+    def state(self, ticker):
+        future = self.futures[ticker]
+        if future.running():
+            return "取得中"
+        if not future.done():
+            return "待機"
+        if future.cancelled() or future.exception() is not None:
+            return "失敗"
+        return "完了"
+
+    def progress(self):
+        done = sum(f.done() for f in self.futures.values())
+        return done, len(self.futures)
+
+    def wait(self, ticker):
+        """
+        先読み中の銘柄はその完了を待つ。未着手ならキャンセルして呼び出し側に取得させる
+        """
+        future = self.futures.get(ticker)
+        if future is None or future.cancel():
+            return
+        wait_futures([future])
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+def get_prefetcher(upload_key, df):
+    """
+    アップロードごとに1つの PricePrefetcher をセッションに保持する
+    """
+    current = st.session_state.get("price_prefetch")
+    if current and current[0] == upload_key:
+        return current[1]
+    if current:
+        current[1].shutdown()
+    prefetcher = PricePrefetcher(get_price_store(), build_prefetch_plan(df))
+    st.session_state["price_prefetch"] = (upload_key, prefetcher)
+    return prefetcher
+
+def render_prefetch_status(prefetcher, ticker_map):
+    """
+    先読みの進捗と取得順をフラグメントで表示する (完了するまで1秒ごとに更新)
+    """
+    done, total = prefetcher.progress()
+
+    @st.fragment(run_every=1.0 if done < total else None)
+    def status():
+        done, total = prefetcher.progress()
+        st.progress(
+            done / total if total else 1.0,
+            text=f"価格データ先読み: {done}/{total} 銘柄 (同時取得数: {prefetcher.max_workers})",
+        )
+        with st.expander("先読みの順序と状態 (取引回数の多い順)"):
+            st.dataframe(
+                pd.DataFrame({
+                    "銘柄": [f"{t} {ticker_map.get(t, t)}" for t in prefetcher.plan.index],
+                    "取引回数": prefetcher.plan["count"].to_numpy(),
+                    "状態": [prefetcher.state(t) for t in prefetcher.plan.index],
+                }),
+                hide_index=True,
+                use_container_width=True,
+            )
+
+    status()
+
+# --- 銘柄名の解決 ---
+NAME_CACHE_TTL_DAYS = 30   # 銘柄名はほとんど変わらないため長めに保持する
+NAME_LOOKUP_WORKERS = 8    # 同時に問い合わせる銘柄数の上限
+
+def lookup_ticker_name(ticker):
+    """
+    yfinanceから銘柄名を取得する
+    """
+    import yfinance as yf
+
+    info = yf.Ticker(ticker).info
+    return info.get('shortName') or info.get('longName') or ticker
+
+class TickerNameResolver:
+    """
+    銘柄名をバックグラウンドのスレッドプールで取得し、銘柄ごとにSQLiteへ保存する
+    プロセス内の全セッションで共有し、同じ銘柄の問い合わせは1回にまとめる
+    """
+
+    def __init__(self, path, lookup=lookup_ticker_name, max_workers=NAME_LOOKUP_WORKERS, ttl_days=NAME_CACHE_TTL_DAYS,
+                 scheduler=None):
+        self.path = path
+        self.lookup = lookup
+        self.ttl_days = ttl_days
+        self.scheduler = scheduler or FetchScheduler()
+        self.names = {}
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="name-lookup")
+        with closing(self._connect()) as conn, conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS ticker_names (
+                    ticker TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    fetched_at TEXT NOT NULL
+                )
+            """)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def resolve(self, tickers):
+        """
+        取得済みの銘柄名を返し、未取得の銘柄は問い合わせを開始する (待たない)
+        """
+        with self.lock:
+            unknown = [t for t in tickers if t not in self.names and t not in self.in_flight]
+            self.in_flight.update(unknown)
+
+        if unknown:
+            min_fetched = (datetime.now() - timedelta(days=self.ttl_days)).isoformat()
+            with closing(self._connect()) as conn:
+                stored = dict(conn.execute(
+                    f"SELECT ticker, name FROM ticker_names WHERE fetched_at >= ? AND ticker IN ({','.join('?' * len(unknown))})",
+                    (min_fetched, *unknown),
+                ).fetchall())
+            with self.lock:
+                self.names.update(stored)
+                self.in_flight.difference_update(stored)
+            metrics.count("name_cache.hit", len(stored))
+            metrics.count("name_cache.miss", len(unknown) - len(stored))
+            for t in unknown:
+                if t not in stored:
+                    self.executor.submit(self._fetch, t)
+
+        with self.lock:
+            return {t: self.names[t] for t in tickers if t in self.names}
+
+    def preload(self):
+        """
+        有効期限内の銘柄名をまとめてメモリに読み込む (以降の resolve はSQLiteを開かずに済む)
+        """
+        min_fetched = (datetime.now() - timedelta(days=self.ttl_days)).isoformat()
+        with closing(self._connect()) as conn:
+            stored = dict(conn.execute(
+                "SELECT ticker, name FROM ticker_names WHERE fetched_at >= ?", (min_fetched,)
+            ).fetchall())
+        with self.lock:
+            self.names.update(stored)
+        return len(stored)
+
+    def _stored_name(self, ticker):
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT name FROM ticker_names WHERE ticker = ?", (ticker,)).fetchone()
+        return row[0] if row else None
+
+    def pending(self, tickers):
+        """
+        まだ銘柄名が届いていない銘柄数
+        """
+        with self.lock:
+            return sum(t not in self.names for t in tickers)
+
+    def _fetch(self, ticker):
+        try:
+            with metrics.stage("name_lookup.upstream", rows=1):
+                name = self.scheduler.call(("name", ticker), self.lookup, ticker)
+            with closing(self._connect()) as conn, conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO ticker_names VALUES (?, ?, ?)",
+                    (ticker, name, datetime.now().isoformat()),
+                )
+        except Exception:
+            # 再試行しても取得できなければ期限切れの名前、それも無ければコードを表示する
+            # (保存しないので次回起動時に再取得。失敗の内容は FetchScheduler がログに出す)
+            name = self._stored_name(ticker)
+            metrics.count("name_cache.stale_served" if name else "name_lookup.failed")
+            name = name or ticker
+        with self.lock:
+            self.names[ticker] = name
+            self.in_flight.discard(ticker)
+
+@st.cache_resource
+def get_name_resolver():
+    return TickerNameResolver(PRICE_CACHE_PATH, scheduler=get_fetch_scheduler())
+
+def render_name_status(resolver, tickers):
+    """
+    銘柄名の取得中は残り件数を表示し、全て揃ったらページを再描画して選択肢に反映する
+    """
+    if not resolver.pending(tickers):
+        return
+
+    @st.fragment(run_every=1.0)
+    def status():
+        remaining = resolver.pending(tickers)
+        if not remaining:
+            st.rerun()
+        st.caption(f"銘柄名を取得中... (残り {remaining}/{len(tickers)} 銘柄、取得済みの名前から順に表示されます)")
+
+    status()
+
+# --- トレード履歴の表示 ---
+HISTORY_PAGE_SIZES = [50, 100, 500, 1000]
+HISTORY_SORT_KEYS = {
+    "売却日": "sell_date",
+    "買付日": "buy_date",
+    "損益": "pnl",
+    "保有日数": "hold_days",
+    "銘柄": "ticker",
+}
+
+def format_trade_history(history, excursions=None):
+    """
+    突合結果を表示用の列に一括変換する (行ごとの文字列組み立てはしない)
+    excursions (trade_excursions の結果) があれば保有中の最大逆行・順行幅の列を加える
+    """
+    table = pd.DataFrame({
+        "銘柄": history["ticker"].astype(str) + " " + history["name"].astype(str),
+        "買付日": history["buy_date"].dt.strftime('%Y/%m/%d'),
+        "買値": history["buy_price"].astype("int64"),
+        "売却日": history["sell_date"].dt.strftime('%Y/%m/%d'),
+        "売値": history["sell_price"].astype("int64"),
+        "数量": history["qty"].astype("int64"),
+        "損益": history["pnl"].astype("int64"),
+        "保有日数": history["hold_days"],
+    })
+    if excursions is not None:
+        table["MAE"] = excursions["mae_pct"].reindex(history.index)
+        table["MFE"] = excursions["mfe_pct"].reindex(history.index)
+    return table
+
+def render_trade_history(history, excursions=None):
+    """
+    完了したトレードを並べ替え・絞り込み・ページ送りできる1つの表として表示する
+    """
+    history = history.assign(hold_days=(history["sell_date"] - history["buy_date"]).dt.days)
+    col1, col2, col3, col4 = st.columns([3, 2, 2, 1])
+    with col1:
+        keyword = st.text_input("銘柄で絞り込み", key="history_keyword", placeholder="コード or 銘柄名")
+    with col2:
+        outcome = st.radio("結果", ["すべて", "勝ち", "負け"], horizontal=True, key="history_outcome")
+    with col3:
+        sort_label = st.selectbox("並び順", list(HISTORY_SORT_KEYS), key="history_sort")
+    with col4:
+        descending = st.toggle("降順", value=True, key="history_desc")
+
+    # 絞り込み (ブールマスク)
+    mask = np.ones(len(history), dtype=bool)
+    if keyword:
+        mask &= (
+            history["ticker"].astype(str).str.contains(keyword, case=False, regex=False)
+            | history["name"].astype(str).str.contains(keyword, case=False, regex=False)
+        ).to_numpy()
+    if outcome == "勝ち":
+        mask &= (history["pnl"] > 0).to_numpy()
+    elif outcome == "負け":
+        mask &= (history["pnl"] <= 0).to_numpy()
+
+    filtered = history[mask].sort_values(
+        HISTORY_SORT_KEYS[sort_label], ascending=not descending, kind="stable"
+    )
+    if filtered.empty:
+        st.write("条件に一致するトレードはありません。")
+        return
+
+    # ページ送り (表示するページ分だけ整形して送る)
+    col1, col2, col3 = st.columns([2, 2, 6])
+    with col1:
+        page_size = st.selectbox("表示件数", HISTORY_PAGE_SIZES, key="history_page_size")
+    page_count = -(-len(filtered) // page_size)
+    if st.session_state.get("history_page", 1) > page_count:
+        st.session_state["history_page"] = page_count  # 絞り込みでページ数が減った場合
+    with col2:
+        page = st.number_input("ページ", min_value=1, max_value=page_count, key="history_page")
+    with col3:
+        st.caption(f"{len(filtered)} 件中 {(page - 1) * page_size + 1}〜{min(page * page_size, len(filtered))} 件目 (全 {page_count} ページ)")
+
+    page_df = format_trade_history(filtered.iloc[(page - 1) * page_size : page * page_size], excursions)
+    st.dataframe(
+        page_df.style.apply(
+            lambda pnl: np.where(pnl > 0, 'color: #10b981; font-weight: bold', 'color: #ef4444; font-weight: bold'),
+            subset=["損益"],
+        ),
+        hide_index=True,
+        use_container_width=True,
+        column_config={
+            "買値": st.column_config.NumberColumn(format="%d円"),
+            "売値": st.column_config.NumberColumn(format="%d円"),
+            "数量": st.column_config.NumberColumn(format="%d株"),
+            "損益": st.column_config.NumberColumn(format="%+d円"),
+            "保有日数": st.column_config.NumberColumn(format="%d日"),
+            "MAE": st.column_config.NumberColumn(format="%.1f%%", help="保有中の最大逆行幅 (買値からの最大下落率)"),
+            "MFE": st.column_config.NumberColumn(format="%.1f%%", help="保有中の最大順行幅 (買値からの最大上昇率)"),
+        },
+    )
+
+# --- アップロード単位のメモ化 ---
+def upload_digest(file):
+    """
+    アップロードされたファイルの内容ハッシュ (コピーせずにバッファを読む)
+    """
+    return hashlib.blake2b(file.getbuffer(), digest_size=16).hexdigest()
+
+def uploads_digest(files):
+    """
+    複数のアップロードをまとめたハッシュ (同じ日の約定はファイルの順に並ぶため、順序も含める)
+    """
+    return hashlib.blake2b("".join(upload_digest(f) for f in files).encode(), digest_size=16).hexdigest()
+
+def session_memo(stage, key, compute):
+    """
+    セッション内で段階 (stage) ごとに最新の計算結果を key (アップロードのハッシュ) と共に保持する
+    key が一致すれば再計算せずに返し、ヒット/ミス数を記録する
+    保持する値はバイト数を測ってメモリ予算 (get_memory_budget) に登録する。予算から追い出されたら
+    (他のセッションの大きなアップロード、またはこのセッションが使われなくなった場合) 次の実行で再計算する
+    """
+    memo = st.session_state.setdefault("upload_memo", {})
+    counts = st.session_state.setdefault("memo_stats", {}).setdefault(stage, {"hit": 0, "miss": 0})
+    budget = get_memory_budget()
+    session_id = current_session_id()
+
+    entry = memo.get(stage)
+    if entry is not None and entry[0] == key:
+        counts["hit"] += 1
+        metrics.count(f"memo.{stage}.hit")
+        budget.touch(stage, session_id)
+        return entry[1]
+
+    counts["miss"] += 1
+    metrics.count(f"memo.{stage}.miss")
+    value = compute()
+    entry = memo[stage] = (key, value)
+    with metrics.stage(f"memo.{stage}.measure"):
+        stored = budget.put(stage, session_id, value, owner=session_id, on_evict=partial(drop_memo, memo, stage, entry))
+    if not stored:
+        # 1件で予算を超える値は保持しない (今回の実行でだけ使う)
+        memo.pop(stage, None)
+    return value
+
+def drop_memo(memo, stage, entry):
+    # メモリ予算から追い出されたメモをセッションから外す (他のセッションのスレッドから呼ばれることがある)
+    # その後に同じ段階を計算し直していれば、新しい方は残す
+    if memo.get(stage) is entry:
+        memo.pop(stage, None)
+
+def evict_idle_sessions():
+    """
+    このセッションが使われたことを記録し、閉じられたセッションと長く操作の無いセッションのメモを捨てる
+    """
+    budget = get_memory_budget()
+    budget.seen(current_session_id())
+    budget.evict_idle(session_is_active, SESSION_IDLE_MINUTES * 60)
+
+def memo_value(stage, key):
+    """
+    session_memo で key について計算済みの値があれば返す (無ければ計算せずに None)
+    """
+    entry = st.session_state.get("upload_memo", {}).get(stage)
+    return entry[1] if entry is not None and entry[0] == key else None
+
+# --- 重い計算のワーカープロセスへの委譲 ---
+# 0 にするとセッションのスレッドで計算する。ワーカーのメモリは MEMORY_BUDGET_MB の外のため、512MB の環境では1まで
+OFFLOAD_WORKERS = int(os.environ.get("OFFLOAD_WORKERS", "1"))
+OFFLOAD_MIN_BYTES = 5 * 2**20  # これより小さいCSVはプロセス間の受け渡しの方が高くつくため、その場で解析する
+OFFLOAD_MIN_ROWS = 100_000     # 同じく、これより小さいデータの計算はその場で行う
+OFFLOAD_POLL_SEC = 0.25        # 待ち行列の順番の表示を更新する間隔
+
+def current_session_id():
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else None
+
+def session_is_active(session_id):
+    # ブラウザのタブが閉じられたセッションのジョブは実行しない
+    return not Runtime.exists() or Runtime.instance().is_active_session(session_id)
+
+@st.cache_resource
+def get_offload_pool():
+    """
+    CPU を長く使う計算を実行するワーカープロセスのプール (全セッションで共有)
+    """
+    pool = OffloadPool(OFFLOAD_WORKERS, is_active=session_is_active)
+    metrics.register_gauge("offload_queued", lambda: pool.stats()["queued"])
+    metrics.register_gauge("offload_running", lambda: pool.stats()["running"])
+    return pool
+
+def run_offloaded(name, key, label, func, *args, offload=True):
+    """
+    func(*args) をワーカープロセスで実行して結果を返す (待っている間は待ち行列の順番を表示する)
+    name ごとに実行中のジョブを key と共にセッションに保持し、ウィジェットの操作で再実行されても同じジョブの完了を待つ
+    key が変わった (別のファイルをアップロードした) ときは前のジョブを取り消す
+    offload=False (小さいデータ) または OFFLOAD_WORKERS=0 のときはその場で計算する
+    """
+    if not offload or OFFLOAD_WORKERS <= 0:
+        return func(*args)
+
+    pool = get_offload_pool()
+    jobs = st.session_state.setdefault("offload_jobs", {})
+    current = jobs.get(name)
+    if current is not None and (current[0] != key or current[1].cancelled()):
+        current[1].cancel()
+        current = None
+    if current is None:
+        current = jobs[name] = (key, pool.submit(current_session_id(), name, func, *args))
+    job = current[1]
+
+    status = st.empty()
+    with metrics.stage(f"offload.{name}"):
+        while not job.done():
+            position = job.position()
+            if position:
+                status.caption(f"⏳ {label}: 順番待ち {position} 番目 (同時に計算できるのは {pool.max_workers} 件まで)")
+            else:
+                status.caption(f"⏳ {label}: 計算中 (別プロセス)")
+            wait_futures([job.future], timeout=OFFLOAD_POLL_SEC)
+    status.empty()
+    jobs.pop(name, None)
+    return job.result()
+
+def build_ticker_map(df):
+    """
+    銘柄の選択肢と、CSVに含まれる銘柄名のマップを作る
+    """
+    ticker_options = sorted(df["銘柄コード"].unique())
+    ticker_map = {}
+
     name_col = None
-    for col in ['銘柄名', '銘柄']:
-        if col in df.columns:
-            name_col = col
-            break
+    if "銘柄名" in df.columns:
+        name_col = "銘柄名"
+    elif "銘柄" in df.columns:
+        name_col = "銘柄"
 
-    if not qty_col:
-        return None, "数量データの列が見つかりません"
+    if name_col:
+        ticker_map = df[["銘柄コード", name_col]].drop_duplicates().set_index("銘柄コード")[name_col].to_dict()
 
-    trades = [] # 利益/損失のリスト
-    trade_history = [] # 詳細履歴のリスト
+    return ticker_options, ticker_map
 
-    # 銘柄ごとに計算
-    for ticker in df['銘柄コード'].unique():
-        ticker_df = df[df['銘柄コード'] == ticker].sort_values('約定日')
-        
-        # 銘柄名の取得 (最初の行から)
-        stock_name = ticker
-        if name_col and not ticker_df.empty:
-            stock_name = ticker_df.iloc[0][name_col]
-
-        buy_queue = [] # [{'price': price, 'qty': qty, 'date': date}, ...]
-
-        for _, row in ticker_df.iterrows():
-            side = row['Side']
-            price = row['約定単価']
-            qty = row[qty_col]
-            date = row['約定日']
-
-            if side == 'Buy':
-                buy_queue.append({'price': price, 'qty': qty, 'date': date})
-            elif side == 'Sell':
-                # 売り注文に対応する買い注文を古い順に消化
-                while qty > 0 and buy_queue:
-                    buy_pos = buy_queue[0]
-                    
-                    match_qty = min(buy_pos['qty'], qty)
-                    
-                    # 損益計算: (売値 - 買値) * 数量
-                    pnl = (price - buy_pos['price']) * match_qty
-                    trades.append(pnl)
-                    
-                    # 履歴記録
-                    trade_history.append({
-                        'ticker': ticker,
-                        'name': stock_name,
-                        'buy_date': buy_pos['date'],
-                        'buy_price': buy_pos['price'],
-                        'sell_date': date,
-                        'sell_price': price,
-                        'qty': match_qty,
-                        'pnl': pnl
-                    })
-
-                    # 数量更新
-                    buy_pos['qty'] -= match_qty
-                    qty -= match_qty
-
-                    # 買いポジションを使い切ったらキューから削除
-                    if buy_pos['qty'] == 0:
-                        buy_queue.pop(0)
-
-    # 集計
-    if not trades:
-        return None, "完了したトレード（売り買いのセット）が見つかりませんでした。"
-
-    winning_trades = [t for t in trades if t > 0]
-    losing_trades = [t for t in trades if t <= 0]
-
-    win_count = len(winning_trades)
-    loss_count = len(losing_trades)
-    total_completed = len(trades)
-
-    win_rate = (win_count / total_completed) * 100 if total_completed > 0 else 0
-
-    avg_profit = sum(winning_trades) / win_count if win_count > 0 else 0
-    avg_loss = abs(sum(losing_trades) / loss_count) if loss_count > 0 else 0
-
-    # 損益レシオ (平均損失が0の場合は便宜上0または無限大とするが、ここでは表示用に調整)
-    risk_reward = avg_profit / avg_loss if avg_loss > 0 else float('inf')
-    
-    return {
-        "win_rate": win_rate,
-        "risk_reward": risk_reward,
-        "total_trades": total_completed,
-        "avg_profit": avg_profit,
-        "avg_loss": avg_loss,
-        "history": trade_history
-    }, None
+# --- ポートフォリオの損益推移 ---
+def ensure_price_ranges(prefetcher, ranges, name):
+    """
+    銘柄ごとの期間 (ranges の start, end 列) の日足を PriceStore に揃える
+    先読みの完了を待ってから、足りない分だけを並行して取得する (失敗した銘柄は {name}.price_error に数える)
+    """
+    store = get_price_store()
+    for ticker in ranges.index:
+        prefetcher.wait(ticker)
+
+    def ensure(ticker, start, end):
+        try:
+            store.ensure(ticker, *to_date_range(start, end))
+        except Exception:
+            metrics.count(f"{name}.price_error")
+
+    with ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix=f"{name}-fetch") as executor:
+        list(executor.map(ensure, ranges.index, ranges["start"], ranges["end"]))
+
+def load_portfolio_closes(prefetcher, ranges):
+    """
+    評価に必要な全銘柄の終値を 日付×銘柄 の行列で返す
+    保有が続いている期間など足りない分は取得してから読み出す
+    取得に失敗した銘柄は行列に含まれない (約定単価で評価される)
+    """
+    ensure_price_ranges(prefetcher, ranges, "portfolio")
+    with metrics.stage("portfolio.load_closes") as timer:
+        closes = get_price_store().load_close_panel(
+            list(ranges.index), *to_date_range(ranges["start"].min(), ranges["end"].max())
+        )
+        timer.rows = closes.size
+    return closes
+
+def compute_portfolio_curve(prefetcher, analysis_state, memo_key):
+    events = position_events(analysis_state["history"], analysis_state["open_lots"])
+    closes = load_portfolio_closes(prefetcher, portfolio_price_ranges(events))
+    with metrics.stage("portfolio.equity_curve", rows=closes.size):
+        return run_offloaded(
+            "portfolio", memo_key, "損益推移の計算", equity_curve, events, closes, offload=closes.size >= OFFLOAD_MIN_ROWS
+        )
+
+def render_portfolio_curve(prefetcher, analysis_state, memo_key):
+    """
+    実現損益と評価損益を合わせた損益の推移と最大ドローダウンを表示する (全銘柄の株価が必要なため任意)
+    """
+    with st.expander("📈 ポートフォリオの損益推移 (実現損益 + 評価損益)"):
+        if not st.toggle("全銘柄の株価で損益の推移を計算する", key="portfolio_curve"):
+            st.caption("保有中の銘柄の値動き (評価損益) も含めた日々の損益と、最大ドローダウンを表示します。")
+            return
+
+        with st.spinner("全銘柄の株価を読み込んでいます..."):
+            curve, summary = session_memo(
+                "portfolio", memo_key, lambda: compute_portfolio_curve(prefetcher, analysis_state, memo_key)
+            )
+
+        col1, col2, col3 = st.columns(3)
+        col1.metric("損益合計 (実現 + 評価)", f"{summary['final_equity']:,.0f} 円")
+        col2.metric("うち評価損益", f"{summary['final_unrealized']:,.0f} 円")
+        col3.metric(
+            "最大ドローダウン", f"{summary['max_drawdown']:,.0f} 円",
+            help=f"{summary['max_drawdown_peak']:%Y/%m/%d} の高値から {summary['max_drawdown_trough']:%Y/%m/%d} まで",
+        )
+        st.plotly_chart(build_equity_figure(curve), use_container_width=True)
+        st.caption(
+            f"※ {summary['tickers']} 銘柄 × {summary['days']:,} 日の終値で評価 "
+            "(株価が取得できない日・銘柄は直前の終値または約定単価で評価)"
+        )
+
+# --- 切り口別の分析 (集計キューブ) ---
+CUBE_VIEWS = {"銘柄": "ticker", "決済月": "month", "買付曜日": "weekday", "保有期間": "hold_bucket"}
+
+@st.fragment
+def render_trade_cube(cube, ticker_map):
+    """
+    銘柄・決済月・買付曜日・保有期間で絞り込み、切り口ごとの勝率・損益レシオ・損益を表示する
+    集計キューブを足し合わせるだけなので、絞り込みを変えても突合はやり直さない (このブロックだけを再実行する)
+    """
+    view = st.radio("集計の切り口", list(CUBE_VIEWS), horizontal=True, key="cube_view")
+
+    col1, col2, col3 = st.columns([3, 2, 2])
+    with col1:
+        tickers = st.multiselect(
+            "銘柄", sorted(cube["ticker"].unique()), key="cube_tickers",
+            format_func=lambda t: f"{t} {ticker_map.get(t, '')}".strip(), placeholder="すべて",
+        )
+    with col2:
+        weekdays = st.multiselect(
+            "買付曜日", sorted(int(d) for d in cube["weekday"].unique()), key="cube_weekdays",
+            format_func=lambda d: WEEKDAY_LABELS[d], placeholder="すべて",
+        )
+    with col3:
+        buckets = st.multiselect("保有期間", HOLD_BUCKET_LABELS, key="cube_buckets", placeholder="すべて")
+    months = list(pd.DatetimeIndex(cube["month"].unique()).sort_values())
+    month_range = None
+    if len(months) > 1:
+        month_range = st.select_slider(
+            "決済月", months, value=(months[0], months[-1]), key="cube_months", format_func=lambda m: f"{m:%Y/%m}"
+        )
+
+    with metrics.stage("cube.rollup", rows=len(cube)):
+        mask = cube_mask(
+            cube, tickers=tickers or None, months=month_range, weekdays=weekdays or None, hold_buckets=buckets or None
+        )
+        summary = cube_summary(cube, mask)
+        table = rollup(cube, CUBE_VIEWS[view], mask)
+    if not summary["total_trades"]:
+        st.write("条件に一致するトレードはありません。")
+        return
+
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("トレード数", f"{summary['total_trades']:,} 回")
+    col2.metric("勝率", f"{summary['win_rate']:.1f}%")
+    col3.metric("損益レシオ", f"{summary['risk_reward']:.2f}" if summary["risk_reward"] != float("inf") else "∞")
+    col4.metric("損益合計", f"{summary['pnl']:,.0f} 円", help=f"平均保有日数 {summary['avg_hold_days']:.1f}日")
+
+    if view == "銘柄":
+        labels = [f"{t} {ticker_map.get(t, '')}".strip() for t in table.index]
+    elif view == "決済月":
+        labels = table.index.strftime("%Y/%m")
+    elif view == "買付曜日":
+        labels = [WEEKDAY_LABELS[d] for d in table.index]
+    else:
+        labels = table.index.astype(str)
+    st.dataframe(
+        pd.DataFrame({
+            view: labels,
+            "回数": table["count"].to_numpy(),
+            "勝率": table["win_rate"].to_numpy(),
+            "損益レシオ": table["risk_reward"].replace(np.inf, np.nan).to_numpy(),
+            "平均保有日数": table["avg_hold_days"].to_numpy(),
+            "損益": table["pnl"].to_numpy(),
+            "総利益": table["gross_profit"].to_numpy(),
+            "総損失": table["gross_loss"].to_numpy(),
+        }),
+        hide_index=True,
+        use_container_width=True,
+        column_config={
+            "勝率": st.column_config.NumberColumn(format="%.1f%%"),
+            "損益レシオ": st.column_config.NumberColumn(format="%.2f", help="損失が無い場合は空欄"),
+            "平均保有日数": st.column_config.NumberColumn(format="%.1f日"),
+            "損益": st.column_config.NumberColumn(format="%+d円"),
+            "総利益": st.column_config.NumberColumn(format="%d円"),
+            "総損失": st.column_config.NumberColumn(format="%d円"),
+        },
+    )
+
+# --- 保有期間と最大逆行・順行幅 (MAE / MFE) ---
+def compute_trade_excursions(prefetcher, history, memo_key):
+    ranges = excursion_ranges(history)
+    ensure_price_ranges(prefetcher, ranges, "excursions")
+    with metrics.stage("excursions.load_bars") as timer:
+        bars = get_price_store().load_high_low(
+            list(ranges.index), *to_date_range(ranges["start"].min(), ranges["end"].max())
+        )
+        timer.rows = len(bars)
+    with metrics.stage("excursions.reduceat", rows=len(history)):
+        excursions = run_offloaded(
+            "excursions", memo_key, "MAE / MFE の計算", trade_excursions, history, bars, offload=len(bars) >= OFFLOAD_MIN_ROWS
+        )
+    return excursions, excursion_summary(history, excursions)
+
+def render_metric_card(title, value, meaning, guide):
+    """
+    分析結果のカード (タイトル・値・意味・目安)
+    """
+    st.markdown(f"""
+    <div style="background-color: #ffffff; padding: 20px; border-radius: 10px; border: 1px solid #e5e7eb; box-shadow: 0 2px 4px rgba(0,0,0,0.05);">
+        <div style="color: #6b7280; font-size: 0.9rem; font-weight: 600; margin-bottom: 5px;">{title}</div>
+        <div style="font-size: 2rem; font-weight: 700; color: #111827;">{value}</div>
+        <div style="margin-top: 10px; font-size: 0.8rem; color: #4b5563; line-height: 1.4;">
+            <strong>意味:</strong> {meaning}<br>
+            <strong>目安:</strong> {guide}
+        </div>
+    </div>
+    """, unsafe_allow_html=True)
+
+def render_holding_card(history):
+    stats = holding_period_stats(history)
+    render_metric_card(
+        "平均保有日数 (Holding Period)",
+        f"{stats['avg_hold_days']:.1f}日",
+        f"買付から売却までの暦日数 (中央値 {stats['median_hold_days']:.0f}日)。<br>"
+        f"勝ち {stats['avg_hold_days_win']:.1f}日 / 負け {stats['avg_hold_days_loss']:.1f}日",
+        "負けの保有が勝ちより長いと損切りが遅い傾向",
+    )
+
+def render_excursion_card(prefetcher, history, memo_key):
+    """
+    MAE / MFE のカード。全銘柄の株価が必要なため、先読みが終わるまでは進捗を表示して待つ (1秒ごとに更新)
+    """
+    done, total = prefetcher.progress()
+
+    @st.fragment(run_every=1.0 if done < total else None)
+    def card():
+        done, total = prefetcher.progress()
+        title = "平均 MAE / MFE (含み損益の幅)"
+        if done < total:
+            render_metric_card(title, "…", f"株価の先読みを待っています ({done}/{total} 銘柄)", "-")
+            return
+        _, summary = session_memo("excursions", memo_key, lambda: compute_trade_excursions(prefetcher, history, memo_key))
+        render_metric_card(
+            title,
+            f"{summary['avg_mae_pct']:+.1f}% / {summary['avg_mfe_pct']:+.1f}%",
+            "保有中の最大含み損 (MAE)・最大含み益 (MFE) の買値比の平均。<br>"
+            f"含み益のうち確定できた割合 {summary['mfe_capture_pct']:.0f}%",
+            f"日足の高値・安値で計算 ({summary['measured_trades']:,} 回)",
+        )
+
+    card()
+
+def select_indicators():
+    """
+    チャートに表示するテクニカル指標を選ぶ ("EMA(50)" のように入力すればパラメータも変えられる)
+    書式の誤りは警告を表示して除外する
+    """
+    selected = st.multiselect(
+        "テクニカル指標",
+        INDICATOR_PRESETS,
+        default=DEFAULT_INDICATORS,
+        accept_new_options=True,
+        key="indicators",
+        help="一覧にない指標は名前とパラメータを入力して追加できます (例: EMA(50), BB(20,2.5), RSI(9))",
+    )
+    indicators = []
+    for spec in selected:
+        try:
+            parse_indicator(spec)
+        except ValueError as e:
+            st.warning(str(e))
+            continue
+        indicators.append(spec)
+    return indicators
+
+METRICS_PORT = os.environ.get("METRICS_PORT")  # 設定すると /metrics (Prometheus形式) をこのポートで公開する
+
+@st.cache_resource
+def init_metrics():
+    """
+    計測ログの出力先を設定し、必要ならメトリクス用のHTTPサーバーを起動する (プロセスで1回)
+    """
+    metrics.configure_logging()
+    if METRICS_PORT:
+        return metrics.start_metrics_server(int(METRICS_PORT))
+
+# --- 起動後のウォームアップ ---
+# 重いモジュールは使う直前に読み込む (起動直後はアップロード欄の表示を優先する)
+# STARTUP_WARMUP=0 でなければ、最初の画面を返した後にバックグラウンドで読み込みとキャッシュの準備を済ませる
+WARMUP_ENABLED = os.environ.get("STARTUP_WARMUP", "1") != "0"
+WARMUP_MODULES = ["plotly.graph_objects", "plotly.subplots", "yfinance"]
+WARMUP_TICKERS = 5       # 日足を最新にしておく銘柄数 (最近取得した順)
+WARMUP_RECENT_DAYS = 7   # その銘柄について取り直す直近の日数
+
+def warm_up(store, resolver, modules=WARMUP_MODULES, tickers=WARMUP_TICKERS):
+    """
+    1. 遅延読み込みしているモジュールを読み込む
+    2. 保存済みの銘柄名をメモリに読み込む
+    3. 最近取得した銘柄の直近の日足を取得する (yfinanceの初回接続もここで済ませる)
+    失敗してもアプリの動作には影響しないため、例外は記録して続ける
+    """
+    for name in modules:
+        with metrics.stage(f"warmup.import.{name}"):
+            importlib.import_module(name)
+
+    with metrics.stage("warmup.names") as timer:
+        timer.rows = resolver.preload()
+
+    with metrics.stage("warmup.prices") as timer:
+        recent = store.recent_tickers(tickers)
+        timer.rows = len(recent)
+        for ticker in recent:
+            try:
+                store.ensure(ticker, *to_date_range(date.today() - timedelta(days=WARMUP_RECENT_DAYS), date.today()))
+            except Exception:
+                metrics.count("warmup.price_error")
+
+@st.cache_resource
+def start_warm_up():
+    """
+    ウォームアップをプロセスで1回だけバックグラウンドで開始する
+    """
+    if not WARMUP_ENABLED:
+        return None
+    thread = threading.Thread(
+        target=warm_up, args=(get_price_store(), get_name_resolver()), name="warm-up", daemon=True
+    )
+    thread.start()
+    return thread
+
+def render_debug_panel():
+    """
+    URLに ?debug=1 を付けたときだけ、サイドバーに計測結果を表示する
+    - 今回の実行の段階ごとの所要時間・行数・メモリ
+    - メモ化のヒット/ミス数 (このセッション)
+    - キャッシュのヒット数などの累計とメモリ予算の使用量 (このプロセス)
+    """
+    if st.query_params.get("debug") != "1":
+        return
+
+    with st.sidebar.expander("🛠 Debug", expanded=True):
+        events = metrics.run_events()
+        st.caption(f"今回の実行 (合計 {sum(e['seconds'] for e in events):.3f}s, RSS {metrics.rss_bytes() / 2**20:.0f}MB)")
+        if events:
+            st.dataframe(
+                pd.DataFrame(events)[["stage", "seconds", "rows", "rss_mb", "rss_delta_mb"]],
+                hide_index=True,
+                use_container_width=True,
+            )
+
+        stats = st.session_state.get("memo_stats", {})
+        if stats:
+            st.caption("メモ化 (このセッション)")
+            st.dataframe(
+                pd.DataFrame.from_dict(stats, orient="index").rename_axis("stage"),
+                use_container_width=True,
+            )
+
+        stages, counters, _ = metrics.snapshot()
+        if counters:
+            st.caption("キャッシュなどの回数 (プロセス累計)")
+            st.dataframe(
+                pd.Series(counters, name="count").rename_axis("name").to_frame(),
+                use_container_width=True,
+            )
+        memory = get_memory_budget().stats()
+        st.caption(
+            f"メモリ予算 (全キャッシュ合計 {memory['bytes'] / 2**20:.1f}MB / {memory['max_bytes'] / 2**20:.0f}MB, "
+            f"{memory['entries']} 件, {memory['sessions']} セッション, 追い出し {memory['evictions']} 回 "
+            f"(うち操作の無いセッション {memory['idle_evictions']} 件))"
+        )
+        if memory["groups"]:
+            st.dataframe(
+                pd.DataFrame.from_dict(memory["groups"], orient="index").rename_axis("cache"),
+                use_container_width=True,
+            )
+        st.caption("ワーカープロセスの計算 (プロセス累計と現在の待ち行列)")
+        st.dataframe(
+            pd.Series(get_offload_pool().stats(), name="value").rename_axis("name").to_frame(),
+            use_container_width=True,
+        )
+        st.caption("取得元への問い合わせ (プロセス累計と現在の待ち行列)")
+        st.dataframe(
+            pd.Series(get_fetch_scheduler().stats(), name="value").rename_axis("name").to_frame(),
+            use_container_width=True,
+        )
+        if stages:
+            st.caption("段階ごとの累計 (プロセス累計)")
+            st.dataframe(
+                pd.DataFrame.from_dict(stages, orient="index").rename_axis("stage"),
+                use_container_width=True,
+            )
 
 def main():
+    init_metrics()
+    metrics.start_run()
+    evict_idle_sessions()
     local_css()
     
     # Header Section with Logo
@@ -335,240 +1086,130 @@ def main():
     </div>
     """, unsafe_allow_html=True)
 
-    # Data Upload Section
-    uploaded_file = st.file_uploader("CSV upload", type=["csv"], label_visibility="collapsed")
+    # Data Upload Section (口座ごとのCSVをまとめてアップロードできる)
+    uploaded_files = st.file_uploader(
+        "CSV upload", type=["csv"], accept_multiple_files=True, label_visibility="collapsed"
+    )
     
     st.markdown("""
     <div style='font-size: 0.8rem; color: #6b7280; margin-bottom: 2rem;'>
-        Supported: SBI証券. / Required: '約定日', '銘柄コード'
+        Supported: SBI証券. / Required: '約定日', '銘柄コード' / 複数口座 (NISA・特定など) のCSVはまとめて選択すると重複を除いて統合します
     </div>
     """, unsafe_allow_html=True)
 
-    if uploaded_file is not None:
-        # File Size Limit Check (10MB)
-        if uploaded_file.size > 10 * 1024 * 1024:
-             st.error("File size exceeds the 10MB limit. Please upload a smaller file.")
+    if uploaded_files:
+        # File Size Limit Check
+        oversized = [f.name for f in uploaded_files if f.size > MAX_UPLOAD_MB * 1024 * 1024]
+        if oversized:
+             st.error(f"File size exceeds the {MAX_UPLOAD_MB}MB limit: {', '.join(oversized)}. Please upload a smaller file.")
              return
 
+        upload_key = uploads_digest(uploaded_files)
+        upload_bytes = sum(f.size for f in uploaded_files)
         with st.spinner("Processing data..."):
-            df, error = load_and_process_data(uploaded_file)
+            df, error, duplicates = session_memo("parse", upload_key, lambda: run_offloaded(
+                "parse", upload_key, "CSVの解析", load_trade_bytes, [(f.name, f.getvalue()) for f in uploaded_files],
+                offload=upload_bytes >= OFFLOAD_MIN_BYTES,
+            ))
 
         if error:
             st.error(error)
             return
 
         st.success("Data Loaded!")
-        
-        # 2. 銘柄選択
-        ticker_options = sorted(df["銘柄コード"].unique())
-        ticker_map = {}
-
-        name_col = None
-        if "銘柄名" in df.columns:
-            name_col = "銘柄名"
-        elif "銘柄" in df.columns:
-            name_col = "銘柄"
+        if len(uploaded_files) > 1:
+            st.caption(f"{len(uploaded_files)} ファイルを統合しました ({len(df):,} 件, 重複 {duplicates:,} 件を除外)")
 
-        if name_col:
-            ticker_map = df[["銘柄コード", name_col]].drop_duplicates().set_index("銘柄コード")[name_col].to_dict()
+        # 全銘柄の日足をバックグラウンドで先読み
+        prefetcher = get_prefetcher(upload_key, df)
         
-        # マップにない銘柄はyfinanceから取得
-        @st.cache_data
-        def fetch_ticker_names(tickers):
-            names = {}
-            for t in tickers:
-                try:
-                    ticker_info = yf.Ticker(t)
-                    info = ticker_info.info
-                    names[t] = info.get('shortName') or info.get('longName') or t
-                except:
-                    names[t] = t
-            return names
+        # 2. 銘柄選択
+        ticker_options, csv_names = session_memo("ticker_map", upload_key, lambda: build_ticker_map(df))
+        ticker_map = dict(csv_names)
 
+        # マップにない銘柄はyfinanceから取得 (待たずにコードを表示し、届いた名前から反映)
         missing_tickers = [t for t in ticker_options if t not in ticker_map]
         if missing_tickers:
-            with st.spinner("Fetching ticker names..."):
-                fetched_names = fetch_ticker_names(missing_tickers)
-                ticker_map.update(fetched_names)
+            name_resolver = get_name_resolver()
+            ticker_map.update(name_resolver.resolve(missing_tickers))
+            render_name_status(name_resolver, missing_tickers)
 
         def format_func(ticker):
             name = ticker_map.get(ticker, ticker)
             return f"{ticker} {name}"
 
+        # 先読みの進捗
+        render_prefetch_status(prefetcher, ticker_map)
+
         # メインエリアで銘柄選択
         selected_ticker = st.selectbox("Select Ticker", ticker_options, format_func=format_func)
 
-        # データをキャッシュする関数
-        @st.cache_data(ttl=3600)
-        def fetch_stock_data(ticker, start, end):
-            ticker_obj = yf.Ticker(ticker)
-            return ticker_obj.history(start=start, end=end)
-
         if selected_ticker:
             ticker_df = df[df["銘柄コード"] == selected_ticker].copy()
             
 
             # 3. チャート描画
+            indicators = select_indicators()
             try:
                 min_trade_date = ticker_df["約定日"].min()
                 max_trade_date = ticker_df["約定日"].max()
                 
-                display_start_date = min_trade_date - timedelta(days=30)
-                end_date = max_trade_date + timedelta(days=30)
-                fetch_start_date = display_start_date - timedelta(days=40)
-
-                if end_date > datetime.today():
-                    end_date = datetime.today()
+                fetch_start_date, display_start_date, end_date = chart_window(
+                    min_trade_date, max_trade_date, indicator_warmup(indicators)
+                )
 
-                with st.spinner(f"Loading chart for {selected_ticker}..."):
+                with st.spinner(f"Loading chart for {selected_ticker}..."), metrics.stage("chart.fetch") as timer:
+                    prefetcher.wait(selected_ticker)
                     stock_data = fetch_stock_data(selected_ticker, fetch_start_date, end_date)
+                    timer.rows = len(stock_data)
                 
                 if stock_data.empty:
                     st.error(f"No stock data found for {selected_ticker}.")
                 else:
-                    stock_data['SMA5'] = stock_data['Close'].rolling(window=5).mean()
-                    stock_data['SMA25'] = stock_data['Close'].rolling(window=25).mean()
-                    stock_data = stock_data[stock_data.index >= pd.Timestamp(display_start_date).tz_localize(stock_data.index.tz)]
-
-                    # Plotly Chart
-                    fig = make_subplots(
-                        rows=2, cols=1, 
-                        shared_xaxes=True, 
-                        vertical_spacing=0.05, 
-                        row_heights=[0.75, 0.25],
-                        subplot_titles=("Price Action", "Volume")
+                    max_annotations = st.slider(
+                        "吹き出しを表示する取引数 (新しい順)", 0, 500, MAX_TRADE_ANNOTATIONS, step=10
                     )
 
-                    stock_data['DateStr'] = stock_data.index.strftime('%Y-%m-%d')
-                    
-                    # Candlestick (Modern Colors)
-                    fig.add_trace(go.Candlestick(
-                        x=stock_data['DateStr'],
-                        open=stock_data['Open'],
-                        high=stock_data['High'],
-                        low=stock_data['Low'],
-                        close=stock_data['Close'],
-                        name='Price',
-                        increasing_line_color='#10b981', # Emerald Green
-                        decreasing_line_color='#ef4444'  # Red
-                    ), row=1, col=1)
-                    
-                    # SMAs
-                    fig.add_trace(go.Scatter(
-                        x=stock_data['DateStr'],
-                        y=stock_data['SMA5'],
-                        mode='lines',
-                        name='SMA 5',
-                        line=dict(color='#f59e0b', width=1.5) # Amber
-                    ), row=1, col=1)
-                    
-                    fig.add_trace(go.Scatter(
-                        x=stock_data['DateStr'],
-                        y=stock_data['SMA25'],
-                        mode='lines',
-                        name='SMA 25',
-                        line=dict(color='#2563eb', width=1.5) # Blue
-                    ), row=1, col=1)
-
-                    
-                    # Trade Markers & Annotations
-                    qty_col = None
-                    for col in ['約定数量', '数量', '株数']:
-                        if col in ticker_df.columns:
-                            qty_col = col
-                            break
-                    
-
-                    # Iterate over all trades to add annotations
-                    for index, row in ticker_df.iterrows():
-                        if row["Side"] not in ["Buy", "Sell"]:
-                            continue
-                        
-                        date_str = row["約定日"].strftime('%Y-%m-%d')
-                        if date_str not in stock_data['DateStr'].values:
-                            continue # Skip if date is not in chart range (though range is extended now)
-
-                        price = row["約定単価"]
-                        qty = row[qty_col] if qty_col else '-'
-                        side_label = "買" if row["Side"] == "Buy" else "売"
-                        color = '#ef4444' if row["Side"] == "Buy" else '#2563eb'
-
-                        # Annotation (Speech Bubble)
-                        # Format: 12/5 買 1055円 100株
-                        short_date = row["約定日"].strftime('%m/%d')
-                        annotation_text = f"<b>{short_date} {side_label}<br>{int(price)}円 {qty}株</b>"
-
-                        # Increase distance for visibility
-                        ay_distance = -60 if row["Side"] == "Buy" else 60
-
-                        fig.add_annotation(
-                            x=date_str,
-                            y=price,
-                            text=annotation_text,
-                            showarrow=True,
-                            arrowhead=2,
-                            arrowsize=1,
-                            arrowwidth=2,
-                            arrowcolor=color,
-                            ax=0,
-                            ay=ay_distance,
-                            bgcolor="white",
-                            bordercolor=color,
-                            borderwidth=2,
-                            borderpad=4,
-                            font=dict(color=color, size=12),
-                            opacity=1.0
-                        )
-
-                    # Volume
-                    fig.add_trace(go.Bar(
-                        x=stock_data['DateStr'],
-                        y=stock_data['Volume'],
-                        name='Volume',
-                        marker_color='#9ca3af', # Gray
-                        opacity=0.4
-                    ), row=2, col=1)
-
-                    # Layout Styling
-                    all_dates = stock_data['DateStr'].tolist()
-                    formatted_dates = [d[5:].replace('-', '/') for d in all_dates]
-                    
-                    fig.update_layout(
-                        height=800,
-                        template="plotly_white", # Light Theme
-                        paper_bgcolor='rgba(0,0,0,0)',
-                        plot_bgcolor='rgba(0,0,0,0)',
-                        font=dict(family="Inter, sans-serif", color="#1f2937"),
-                        xaxis2=dict(
-                            type='category',
-                            tickmode='array',
-                            tickvals=all_dates,
-                            ticktext=formatted_dates,
-                            title=None,
-                            gridcolor='#e5e7eb'
-                        ),
-                        xaxis=dict(
-                            type='category',
-                            showticklabels=False,
-                            gridcolor='#e5e7eb'
-                        ),
-                        yaxis=dict(title="Price (JPY)", gridcolor='#e5e7eb'),
-                        yaxis2=dict(title="Volume", gridcolor='#e5e7eb'),
-                        showlegend=True,
-                        legend=dict(
-                            orientation="h",
-                            yanchor="bottom",
-                            y=1.02,
-                            xanchor="right",
-                            x=1
-                        ),
-                        margin=dict(l=20, r=20, t=60, b=20)
+                    # 同じ銘柄・期間・指標・吹き出し数で作成済みのチャートがあれば、指標の計算から作成までを省く
+                    # (日足が更新されたら作り直すため、最新のバーの日付と終値もキーに含める)
+                    figure_cache = get_figure_cache()
+                    bars_key = (len(stock_data), stock_data.index[-1], float(stock_data["Close"].iloc[-1]))
+                    figure_key = (
+                        upload_key, selected_ticker, str(display_start_date), str(end_date), tuple(indicators),
+                        max_annotations, *bars_key,
                     )
-                    
-                    fig.update_xaxes(tickangle=-45, nticks=20, row=2, col=1)
-                    fig.update_layout(xaxis_rangeslider_visible=False)
-
-                    st.plotly_chart(fig, use_container_width=True)
+                    cached = figure_cache.get(figure_key)
+                    if cached is not None:
+                        with metrics.stage("chart.figure_cache", rows=cached[3]):
+                            blob, resolution, daily_bars, bars = cached
+                            fig = figure_from_bytes(blob)
+                    else:
+                        # 指標は取得した全期間で1回だけ計算し、表示期間を切り出す
+                        with metrics.stage("chart.indicators", rows=len(stock_data)):
+                            # 当日分の日足は期限 (PRICE_CACHE_PROVISIONAL_TTL_MINUTES) ごとに取り直すため、チャートと同じく日足の本数・最新の日付と終値もキーに含める
+                            indicator_key = (upload_key, selected_ticker, tuple(indicators), *bars_key)
+                            stock_data = session_memo("indicators", indicator_key, lambda: add_indicators(stock_data, indicators))
+                            stock_data = stock_data[stock_data.index >= pd.Timestamp(display_start_date).tz_localize(stock_data.index.tz)].copy()
+
+                        # 長い期間は週足・月足に集約してブラウザに送るバーの数を抑える
+                        with metrics.stage("chart.lod", rows=len(stock_data)) as timer:
+                            daily_bars = len(stock_data)
+                            stock_data, resolution = downsample_bars(stock_data)
+                            bars = timer.rows = len(stock_data)
+
+                        with metrics.stage("chart.build_figure", rows=bars):
+                            fig = build_price_figure(stock_data, ticker_df, max_annotations, indicators, resolution)
+
+                        with metrics.stage("chart.store_figure", rows=bars):
+                            blob = figure_to_bytes(fig)
+                            figure_cache.put(figure_key, (blob, resolution, daily_bars, bars), len(blob))
+
+                    if resolution != "D":
+                        label = RESOLUTION_LABELS.get(resolution, f"{resolution[:-1]}か月足")
+                        st.caption(f"表示期間が長いため{label}で表示しています (日足 {daily_bars:,} 本 → {bars:,} 本)")
+
+                    with metrics.stage("chart.plotly_chart", rows=bars):
+                        st.plotly_chart(fig, use_container_width=True)
 
             except Exception as e:
                 st.error(f"Error plotting chart: {str(e)}")
@@ -577,80 +1218,126 @@ def main():
         st.markdown("---")
         st.subheader("📊 全体トレード分析 (ポートフォリオ全体)")
         
-        analysis_result, analysis_error = analyze_trade_performance(df)
+        # 前回の分析状態があれば、それ以降の約定だけを追加で分析する
+        with st.expander("🔁 前回の分析状態から続ける (新しい約定だけを分析)"):
+            st.caption("前回保存した分析状態ファイルを読み込むと、その最終約定日より後の約定だけを突合して履歴に追加します。")
+            state_file = st.file_uploader("分析状態ファイル", type=["gz"], key="state_upload")
+
+        prev_state, state_key = None, ""
+        if state_file is not None:
+            state_key = upload_digest(state_file)
+            try:
+                prev_state = session_memo("state", state_key, lambda: load_analysis_state(state_file.getvalue()))
+            except ValueError as e:
+                st.error(str(e))
+                state_key = ""
+
+        analysis_result, analysis_error = session_memo("analysis", upload_key + state_key, lambda: run_offloaded(
+            "analysis", upload_key + state_key, "トレード分析 (突合・平均取得単価)", analyze_trade_performance, df, prev_state,
+            offload=len(df) >= OFFLOAD_MIN_ROWS,
+        ))
         
         if analysis_error:
             st.warning(analysis_error)
         elif analysis_result:
+            # 取得単価の計算方法 (税務上の移動平均法・総平均法と FIFO を比べられる)
+            method = st.radio(
+                "取得単価の計算方法", list(COST_METHODS), format_func=COST_METHODS.get, horizontal=True, key="cost_method"
+            )
+            method_result = analysis_result["methods"][method]
+
             # Metrics
-            win_rate = analysis_result["win_rate"]
-            risk_reward = analysis_result["risk_reward"]
+            win_rate = method_result["win_rate"]
+            risk_reward = method_result["risk_reward"]
             
             # Formatting
             rr_display = f"{risk_reward:.2f}" if risk_reward != float('inf') else "∞"
             
             # Layout
-            col1, col2 = st.columns(2)
+            col1, col2, col3, col4 = st.columns(4)
             
             # Win Rate Card
             with col1:
-                st.markdown(f"""
-                <div style="background-color: #ffffff; padding: 20px; border-radius: 10px; border: 1px solid #e5e7eb; box-shadow: 0 2px 4px rgba(0,0,0,0.05);">
-                    <div style="color: #6b7280; font-size: 0.9rem; font-weight: 600; margin-bottom: 5px;">勝率 (Win Rate)</div>
-                    <div style="font-size: 2rem; font-weight: 700; color: #111827;">{win_rate:.1f}%</div>
-                    <div style="margin-top: 10px; font-size: 0.8rem; color: #4b5563; line-height: 1.4;">
-                        <strong>意味:</strong> 利益が出たトレードの割合です。<br>
-                        <strong>目安:</strong> 40%〜60% (損益レシオとのバランスが重要)
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
+                render_metric_card(
+                    "勝率 (Win Rate)", f"{win_rate:.1f}%",
+                    "利益が出たトレードの割合です。", "40%〜60% (損益レシオとのバランスが重要)",
+                )
 
             # Risk Reward Card
             with col2:
-                st.markdown(f"""
-                <div style="background-color: #ffffff; padding: 20px; border-radius: 10px; border: 1px solid #e5e7eb; box-shadow: 0 2px 4px rgba(0,0,0,0.05);">
-                    <div style="color: #6b7280; font-size: 0.9rem; font-weight: 600; margin-bottom: 5px;">損益レシオ (Risk Reward)</div>
-                    <div style="font-size: 2rem; font-weight: 700; color: #111827;">{rr_display}</div>
-                    <div style="margin-top: 10px; font-size: 0.8rem; color: #4b5563; line-height: 1.4;">
-                        <strong>意味:</strong> 平均利益 ÷ 平均損失。<br>
-                        <strong>目安:</strong> 1.0以上 (1.5以上だと優秀)
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
+                render_metric_card(
+                    "損益レシオ (Risk Reward)", rr_display,
+                    "平均利益 ÷ 平均損失。", "1.0以上 (1.5以上だと優秀)",
+                )
+
+            # Holding Period / Excursion Cards
+            with col3:
+                render_holding_card(analysis_result["history"])
+            with col4:
+                render_excursion_card(prefetcher, analysis_result["history"], upload_key + state_key)
             
-            st.caption(f"※ 計算対象: 完了したトレードセット (合計 {analysis_result['total_trades']} 回)")
+            if method == "fifo":
+                st.caption(f"※ 計算対象: 完了したトレードセット (合計 {analysis_result['total_trades']} 回)")
+            else:
+                st.caption(
+                    f"※ 計算対象: 売り約定ごとの実現損益 (合計 {method_result['total_trades']} 回)。"
+                    "保有日数・MAE / MFE・切り口別の分析・トレード詳細は FIFO の約定ペアで計算しています。"
+                )
+            with st.expander("🧮 取得単価の計算方法の比較"):
+                methods = analysis_result["methods"]
+                st.dataframe(
+                    pd.DataFrame({
+                        "計算方法": [COST_METHODS[m] for m in methods],
+                        "回数": [r["total_trades"] for r in methods.values()],
+                        "勝率": [r["win_rate"] for r in methods.values()],
+                        "損益レシオ": [r["risk_reward"] if r["risk_reward"] != float("inf") else None for r in methods.values()],
+                        "実現損益": [r["gross_profit"] - r["gross_loss"] for r in methods.values()],
+                    }),
+                    hide_index=True,
+                    use_container_width=True,
+                    column_config={
+                        "勝率": st.column_config.NumberColumn(format="%.1f%%"),
+                        "損益レシオ": st.column_config.NumberColumn(format="%.2f", help="損失が無い場合は空欄"),
+                        "実現損益": st.column_config.NumberColumn(format="%+d円"),
+                    },
+                )
+                st.caption(
+                    "FIFO は約定ペアごと、移動平均法・総平均法は売り約定ごとの損益です。"
+                    "総平均法は銘柄ごと・暦年ごとの平均取得単価を使います (前回の分析状態から続けた場合は、その時点を期の区切りとみなします)。"
+                )
+            if prev_state is not None:
+                st.caption(
+                    f"※ 前回の分析状態 ({prev_state['last_date']:%Y/%m/%d} まで) に "
+                    f"{analysis_result['new_fills']} 件の新しい約定を追加して分析しました。"
+                )
+
+            render_portfolio_curve(prefetcher, analysis_result["state"], upload_key + state_key)
+
+            with st.expander("🔎 切り口別の分析 (銘柄・決済月・買付曜日・保有期間)"):
+                cube = session_memo("cube", upload_key + state_key, lambda: build_trade_cube(analysis_result["history"]))
+                render_trade_cube(cube, ticker_map)
+
+            # 次回の差分分析用に状態を保存
+            last_date = analysis_result["state"]["last_date"]
+            st.download_button(
+                "💾 分析状態を保存 (次回は新しい約定だけを分析)",
+                data=session_memo(
+                    "state_dump", upload_key + state_key, lambda: dump_analysis_state(analysis_result["state"])
+                ),
+                file_name=f"trade_state_{last_date:%Y%m%d}.json.gz",
+                mime="application/gzip",
+            )
             
             # Detailed Trade History
             with st.expander("✅ 分析対象のトレード詳細 (完了したセット)"):
-                history = analysis_result.get("history", [])
-                if history:
-                    for h in history:
-                        b_date = h['buy_date'].strftime('%Y/%m/%d')
-                        s_date = h['sell_date'].strftime('%Y/%m/%d')
-                        name = h.get('name', h['ticker'])
-                        pnl = int(h['pnl'])
-                        pnl_str = f"+{pnl}" if pnl > 0 else f"{pnl}"
-                        
-                        # XSS対策: 表示する変数をエスケープ
-                        safe_name = html.escape(str(name))
-                        safe_ticker = html.escape(str(h['ticker'])) # 念のため
-                        safe_b_price = html.escape(str(int(h['buy_price'])))
-                        safe_qty = html.escape(str(int(h['qty'])))
-                        safe_s_price = html.escape(str(int(h['sell_price'])))
-                        
-                        st.markdown(f"""
-                        <div style='font-family: monospace; font-size: 0.9rem; border-bottom: 1px solid #f3f4f6; padding: 4px 0;'>
-                            <strong style='color: #1f2937; margin-right: 8px;'>{safe_name}</strong> 
-                            {b_date} 買 {safe_b_price}円 ({safe_qty}株) 
-                            <span style='color: #9ca3af;'>→</span> 
-                            {s_date} 売 {safe_s_price}円 ({safe_qty}株)
-                            <span style='float: right; font-weight: bold; color: {'#10b981' if pnl > 0 else '#ef4444'};'>
-                                {pnl_str}円
-                            </span>
-                        </div>
-                        """, unsafe_allow_html=True)
+                history = analysis_result.get("history")
+                if history is not None and not history.empty:
+                    excursions = memo_value("excursions", upload_key + state_key)
+                    render_trade_history(history, excursions[0] if excursions else None)
                 else:
                     st.write("詳細データはありません。")
 
 if __name__ == "__main__":
     main()
+    render_debug_panel()
+    start_warm_up()
@@ -0,0 +1,121 @@
+"""
+取引履歴CSVのディレクトリをまとめて分析し、勝率・損益レシオのレポートを書き出すコマンド
+Streamlitを起動せずに、複数のCSVをプロセスプールで並列に処理する
+
+使い方:
+    python batch_report.py <CSVのディレクトリ> [-o reports] [-j 4]
+
+出力:
+    <出力先>/<ファイル名>.json   ファイルごとのレポート
+    <出力先>/summary.csv         ファイルごとのレポートの一覧
+    <出力先>/aggregate.json      全ファイル合算のレポート
+"""
+import argparse
+import json
+import math
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+from trade_analysis import analyze_trade_performance, load_and_process_data
+
+REPORT_FIELDS = [
+    "win_rate", "risk_reward", "total_trades", "avg_profit", "avg_loss",
+    "win_count", "loss_count", "gross_profit", "gross_loss",
+]
+
+def analyze_file(path):
+    """
+    1つのCSVを読み込んで分析し、レポート (dict) を返す (ワーカープロセスで実行)
+    """
+    report = {"file": path.name, "error": None}
+    try:
+        with open(path, "rb") as f:
+            df, error = load_and_process_data(f)
+        if error:
+            return {**report, "error": error}
+
+        result, error = analyze_trade_performance(df)
+        if error:
+            return {**report, "fills": len(df), "error": error}
+    except Exception as e:
+        # 1ファイルの失敗でバッチ全体を止めない
+        return {**report, "error": f"分析中にエラーが発生しました: {str(e)}"}
+
+    return {**report, "fills": len(df), **{key: result[key] for key in REPORT_FIELDS}}
+
+def aggregate_reports(reports):
+    """
+    ファイルごとのレポートの件数・損益合計から全体の勝率・損益レシオを求める
+    """
+    ok = [r for r in reports if r["error"] is None]
+    win_count = sum(r["win_count"] for r in ok)
+    loss_count = sum(r["loss_count"] for r in ok)
+    gross_profit = sum(r["gross_profit"] for r in ok)
+    gross_loss = sum(r["gross_loss"] for r in ok)
+    total_trades = win_count + loss_count
+
+    avg_profit = gross_profit / win_count if win_count > 0 else 0
+    avg_loss = gross_loss / loss_count if loss_count > 0 else 0
+
+    return {
+        "files": len(reports),
+        "failed_files": len(reports) - len(ok),
+        "fills": sum(r["fills"] for r in ok),
+        "win_rate": (win_count / total_trades) * 100 if total_trades > 0 else 0,
+        "risk_reward": avg_profit / avg_loss if avg_loss > 0 else float('inf'),
+        "total_trades": total_trades,
+        "avg_profit": avg_profit,
+        "avg_loss": avg_loss,
+        "win_count": win_count,
+        "loss_count": loss_count,
+        "gross_profit": gross_profit,
+        "gross_loss": gross_loss,
+    }
+
+def to_json_value(value):
+    # JSONには無限大が無いため、損益レシオ∞ (損失なし) は null で書き出す
+    if isinstance(value, float) and math.isinf(value):
+        return None
+    return value
+
+def write_json(path, report):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({k: to_json_value(v) for k, v in report.items()}, f, ensure_ascii=False, indent=2)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="取引履歴CSVをまとめて分析し、勝率・損益レシオのレポートを書き出す")
+    parser.add_argument("input_dir", type=Path, help="取引履歴CSVを置いたディレクトリ")
+    parser.add_argument("-o", "--output-dir", type=Path, default=Path("reports"), help="レポートの出力先 (既定: reports)")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="並列に処理するプロセス数")
+    parser.add_argument("--pattern", default="*.csv", help="対象ファイルのパターン (既定: *.csv)")
+    args = parser.parse_args(argv)
+
+    paths = sorted(args.input_dir.glob(args.pattern))
+    if not paths:
+        print(f"{args.input_dir} に {args.pattern} が見つかりませんでした。", file=sys.stderr)
+        return 1
+
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+
+    reports = []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for report in executor.map(analyze_file, paths):
+            write_json(args.output_dir / f"{Path(report['file']).stem}.json", report)
+            status = report["error"] or f"{report['total_trades']} trades, win rate {report['win_rate']:.1f}%"
+            print(f"{report['file']}: {status}")
+            reports.append(report)
+
+    pd.DataFrame(reports).to_csv(args.output_dir / "summary.csv", index=False)
+    aggregate = aggregate_reports(reports)
+    write_json(args.output_dir / "aggregate.json", aggregate)
+
+    print(f"合計: {aggregate['files']} files ({aggregate['failed_files']} failed), "
+          f"{aggregate['total_trades']} trades, win rate {aggregate['win_rate']:.1f}%")
+    return 0 if aggregate["failed_files"] == 0 else 2
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""
+取得元への同時アクセスのシミュレーション (ネットワーク不要)
+複数のセッションが同じ人気銘柄のチャートを同時に開いた状況を、偽の取得元 (FlakyPriceProvider) に対して再現する
+
+    1. direct   : スケジューラーなし (各セッションがそのまま問い合わせる)
+    2. scheduled: FetchScheduler (single-flight + トークンバケット + 再試行)
+    3. stale    : 取得範囲の期限切れ後に取得元が全て失敗する状況で、キャッシュの日足を返せるか
+
+使い方 (stock-tool ディレクトリで実行):
+    python -m bench.fetch_load --sessions 8 --tickers 10 --limit-per-sec 5 --fail-rate 0.1
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import date
+
+import metrics
+from bench.synthetic import FlakyPriceProvider
+from fetch_scheduler import FetchScheduler
+from price_store import PriceStore
+
+POPULAR_TICKERS = ["7203.T", "6758.T", "9984.T", "8306.T", "6861.T", "9432.T", "8035.T", "4063.T", "6098.T", "7974.T"]
+
+class DirectScheduler:
+    """
+    比較用: まとめず・制限せず・再試行せずにそのまま呼び出す
+    """
+
+    def call(self, key, func, *args):
+        return func(*args)
+
+    def stats(self):
+        return {}
+
+def run_sessions(store, tickers, sessions, start, end):
+    """
+    sessions 個のスレッドが同時に全銘柄の日足を要求し、(所要時間, セッション側で見えたエラー数) を返す
+    """
+    errors = []
+    barrier = threading.Barrier(sessions)
+
+    def session(i):
+        barrier.wait()
+        for ticker in tickers[i % len(tickers):] + tickers[:i % len(tickers)]:
+            try:
+                store.get(ticker, start, end)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=session, args=(i,)) for i in range(sessions)]
+    began = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - began, len(errors)
+
+def stale_served():
+    return metrics.snapshot()[1].get("price_cache.stale_served", 0)
+
+def report(name, args, provider, seconds, errors, stats, stale_before):
+    stale = stale_served() - stale_before
+    print(f"{name}:")
+    print(f"  requests from sessions : {args.sessions * args.tickers}")
+    print(f"  upstream calls         : {len(provider.calls)} (rate limited: {provider.rate_limited})")
+    print(f"  errors seen by sessions: {errors}")
+    print(f"  stale served           : {stale}")
+    print(f"  wall time              : {seconds:.2f}s")
+    if stats:
+        print("  scheduler              : " + ", ".join(f"{k}={v}" for k, v in stats.items()))
+
+def scenario(name, args, scheduler, tmp):
+    provider = FlakyPriceProvider(latency=args.latency, limit_per_sec=args.limit_per_sec,
+                                  fail_rate=args.fail_rate, seed=args.seed)
+    store = PriceStore(os.path.join(tmp, f"{name}.sqlite3"), fetch_history=provider.history, scheduler=scheduler)
+    tickers = (POPULAR_TICKERS * (args.tickers // len(POPULAR_TICKERS) + 1))[:args.tickers]
+    start, end = date(2024, 1, 4), date(2024, 12, 28)
+    stale_before = stale_served()
+    seconds, errors = run_sessions(store, tickers, args.sessions, start, end)
+    report(name, args, provider, seconds, errors, scheduler.stats(), stale_before)
+    return store, provider, tickers, (start, end)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="取得元への同時アクセスのシミュレーション")
+    parser.add_argument("--sessions", type=int, default=8, help="同時に開くセッション数")
+    parser.add_argument("--tickers", type=int, default=10, help="各セッションが開く銘柄数")
+    parser.add_argument("--latency", type=float, default=0.05, help="取得元の応答時間 (秒)")
+    parser.add_argument("--limit-per-sec", type=int, default=5, help="取得元の頻度制限 (回/秒)")
+    parser.add_argument("--fail-rate", type=float, default=0.1, help="取得元が接続エラーを返す確率")
+    parser.add_argument("--rate", type=float, default=4.0, help="スケジューラーの頻度制限 (回/秒)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        scenario("direct", args, DirectScheduler(), tmp)
+
+        scheduler = FetchScheduler(rate=args.rate, burst=args.limit_per_sec, backoff=0.2)
+        store, provider, tickers, (start, end) = scenario("scheduled", args, scheduler, tmp)
+
+        # 期限切れ + 取得元の障害: キャッシュの日足を返す
+        store.max_age_days = 0
+        provider.failing = True
+        provider.calls.clear()
+        stale_before = stale_served()
+        seconds, errors = run_sessions(store, tickers, args.sessions, start, end)
+        report("stale", args, provider, seconds, errors, scheduler.stats(), stale_before)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
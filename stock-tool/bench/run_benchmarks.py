@@ -0,0 +1,216 @@
+"""
+主要な処理のベンチマーク (ネットワーク不要)
+    - load_and_process_data    : CSVの読み込みと前処理
+    - merge_trade_frames       : 期間の重なる2つの口座のCSVの統合と重複除去 (読み込み済みのデータを6:6に分割)
+    - analyze_trade_performance: FIFO突合・移動平均法・総平均法の取得単価と集計
+    - equity_curve             : 全銘柄の 日付×銘柄 の終値による損益推移とドローダウン
+    - trade_excursions         : 全約定ペアの保有期間の最安値・最高値 (MAE / MFE)
+    - trade_cube               : 約定ペアの集計キューブ (銘柄×決済月×買付曜日×保有期間) の作成
+    - cube_rollup              : 集計キューブの絞り込みと切り口ごとの集計 (ドリルダウン1回分)
+    - indicators               : 取引回数上位の銘柄のチャート期間に対する指標計算
+    - build_price_figure       : 最も取引回数の多い銘柄のチャート作成 (表示の間引きを含む) とJSONシリアライズ
+    - figure_cache_restore     : 同じチャートをキャッシュ (圧縮したJSON) から復元してJSONシリアライズ
+
+使い方 (stock-tool ディレクトリで実行):
+    python -m bench.run_benchmarks --sizes 1000 10000 100000 1000000 -o bench_results.json
+    python -m bench.run_benchmarks --compare old_results.json   # 前回の結果との比較
+
+結果はコミットID・実行環境と共にJSONで保存されるため、コミット間で比較できる
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from bench.synthetic import OfflinePriceProvider, write_sbi_csv
+from charts import build_price_figure, chart_window, downsample_bars, figure_from_bytes, figure_to_bytes
+from cube import build_trade_cube, cube_mask, cube_summary, rollup
+from excursions import excursion_ranges, trade_excursions
+from indicators import add_indicators
+from portfolio import equity_curve, portfolio_price_ranges, position_events
+from trade_analysis import analyze_trade_performance, load_and_process_data, merge_trade_frames
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+INDICATOR_TICKERS = 20  # 指標計算を行う銘柄数 (取引回数の多い順)
+
+def timed(func, repeat):
+    """
+    func を repeat 回実行し、各回の所要時間 (秒) と最後の戻り値を返す
+    """
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return times, result
+
+def record(results, name, fills, rows, times, **extra):
+    entry = {
+        "benchmark": name,
+        "fills": fills,
+        "rows": rows,
+        "min_s": min(times),
+        "median_s": statistics.median(times),
+        "rows_per_s": rows / min(times) if min(times) > 0 else None,
+        **extra,
+    }
+    results.append(entry)
+    print(f"  {name:<28} rows={rows:>9,}  min={entry['min_s']:.4f}s  median={entry['median_s']:.4f}s")
+
+def run_size(fills, args, provider, results):
+    print(f"fills={fills:,}")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "sbi.csv")
+        write_sbi_csv(path, fills, args.tickers, args.days, seed=args.seed, provider=provider)
+
+        def parse():
+            with open(path, "rb") as f:
+                return load_and_process_data(f)
+
+        times, (df, error) = timed(parse, args.repeat)
+        if error:
+            raise RuntimeError(error)
+        record(results, "load_and_process_data", fills, len(df), times, file_bytes=os.path.getsize(path))
+
+    # 全体の前6割と後6割を別の口座のファイルとみなす (重なる2割が重複)
+    frames = [df.iloc[:len(df) * 6 // 10], df.iloc[len(df) * 4 // 10:]]
+    times, (_, duplicates) = timed(lambda: merge_trade_frames(frames), args.repeat)
+    record(results, "merge_trade_frames", fills, sum(len(f) for f in frames), times, duplicates=duplicates)
+
+    times, (result, _) = timed(lambda: analyze_trade_performance(df), args.repeat)
+    record(results, "analyze_trade_performance", fills, len(df), times,
+           matched_trades=result["total_trades"] if result else 0)
+
+    # 全銘柄の 日付×銘柄 の終値で評価した損益推移
+    events = position_events(result["state"]["history"], result["state"]["open_lots"])
+    ranges = portfolio_price_ranges(events, today=events["date"].max())
+    closes = pd.concat(
+        {t: provider.history(t, r.start, r.end + pd.Timedelta(days=1))["Close"] for t, r in ranges.iterrows()},
+        axis=1, sort=True,
+    )
+    times, _ = timed(lambda: equity_curve(events, closes), args.repeat)
+    record(results, "equity_curve", fills, closes.size, times, tickers=closes.shape[1], days=closes.shape[0])
+
+    # 全約定ペアの保有期間の高値・安値 (銘柄→日付 の縦長の日足)
+    history = result["state"]["history"]
+    bars = pd.concat(
+        {t: provider.history(t, r.start, r.end + pd.Timedelta(days=1))[["High", "Low"]]
+         for t, r in excursion_ranges(history).iterrows()},
+        names=["ticker", "date"],
+    ).rename(columns=str.lower).reset_index()
+    times, _ = timed(lambda: trade_excursions(history, bars), args.repeat)
+    record(results, "trade_excursions", fills, len(history), times, bars=len(bars))
+
+    # 集計キューブの作成と、20銘柄・月曜と金曜の買付に絞った月別の集計
+    times, cube = timed(lambda: build_trade_cube(history), args.repeat)
+    record(results, "trade_cube", fills, len(history), times, cube_rows=len(cube))
+
+    def drill_down():
+        mask = cube_mask(cube, tickers=list(cube["ticker"].unique()[:INDICATOR_TICKERS]), weekdays=[0, 4])
+        return cube_summary(cube, mask), rollup(cube, "month", mask)
+
+    times, _ = timed(drill_down, args.repeat)
+    record(results, "cube_rollup", fills, len(cube), times)
+
+    # 取引回数の多い銘柄のチャート期間の日足 (オフライン)
+    counts = df["銘柄コード"].value_counts()
+    histories = {}
+    for ticker in counts.index[:INDICATOR_TICKERS]:
+        trades = df[df["銘柄コード"] == ticker]
+        fetch_start, _, end = chart_window(trades["約定日"].min(), trades["約定日"].max())
+        histories[ticker] = provider.history(ticker, fetch_start, end + pd.Timedelta(days=1))
+
+    times, _ = timed(lambda: [add_indicators(h.copy()) for h in histories.values()], args.repeat)
+    record(results, "indicators", fills, sum(len(h) for h in histories.values()), times,
+           tickers=len(histories))
+
+    top = counts.index[0]
+    ticker_df = df[df["銘柄コード"] == top]
+    stock_data = add_indicators(histories[top].copy())
+
+    def figure():
+        bars, resolution = downsample_bars(stock_data.copy())
+        fig = build_price_figure(bars, ticker_df, resolution=resolution)
+        return fig.to_json()
+
+    times, payload = timed(figure, args.repeat)
+    record(results, "build_price_figure", fills, len(stock_data), times,
+           trades=len(ticker_df), payload_bytes=len(payload))
+
+    bars, resolution = downsample_bars(stock_data.copy())
+    blob = figure_to_bytes(build_price_figure(bars, ticker_df, resolution=resolution))
+    times, _ = timed(lambda: figure_from_bytes(blob).to_json(), args.repeat)
+    record(results, "figure_cache_restore", fills, len(stock_data), times, cached_bytes=len(blob))
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_path):
+    """
+    前回の結果 (JSON) との比較を表示する (比 > 1 は今回の方が遅い)
+    """
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    old = {(r["benchmark"], r["fills"]): r for r in baseline["results"]}
+    print(f"\ncompared with {baseline_path} (commit {baseline['meta'].get('commit')})")
+    for r in results:
+        prev = old.get((r["benchmark"], r["fills"]))
+        if prev:
+            ratio = r["min_s"] / prev["min_s"] if prev["min_s"] > 0 else float("nan")
+            print(f"  {r['benchmark']:<28} fills={r['fills']:>9,}  {prev['min_s']:.4f}s -> {r['min_s']:.4f}s  x{ratio:.2f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stock Trade Visualizer のベンチマーク")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="約定件数 (1k〜5M)")
+    parser.add_argument("--tickers", type=int, default=200, help="銘柄数")
+    parser.add_argument("--days", type=int, default=1500, help="期間 (営業日数)")
+    parser.add_argument("--repeat", type=int, default=3, help="各ベンチマークの実行回数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", default="bench_results.json", help="結果の出力先 (JSON)")
+    parser.add_argument("--compare", help="比較する前回の結果 (JSON)")
+    args = parser.parse_args(argv)
+
+    provider = OfflinePriceProvider()
+    results = []
+    for fills in args.sizes:
+        run_size(fills, args, provider, results)
+
+    output = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "tickers": args.tickers,
+            "days": args.days,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(output, f, ensure_ascii=False, indent=2)
+    print(f"\nwrote {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""
+起動時間のベンチマーク (ネットワーク不要)
+    - import.<module>  : 新しいプロセスでモジュールを読み込む時間
+    - first_render     : 新しいプロセスで app.py を実行し、最初の画面 (アップロード欄) ができるまでの時間
+                         (streamlit run と同様に streamlit は読み込み済みの状態から測る。ウォームアップは無効)
+
+使い方 (stock-tool ディレクトリで実行):
+    python -m bench.startup -o bench_startup.json
+    python -m bench.startup --compare old_startup.json
+
+毎回新しいプロセスで測るため、モジュールの読み込みがキャッシュされた状態にはならない
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+from bench.run_benchmarks import compare, git_commit, record
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+IMPORT_MODULES = ["streamlit", "pandas", "plotly.graph_objects", "plotly.subplots", "yfinance"]
+DEFERRED_MODULES = ["yfinance", "plotly.graph_objects", "plotly.subplots"]
+
+# 子プロセスで実行するスクリプト (結果は最終行にJSONで出力する)
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{"seconds": time.perf_counter() - start}}))
+"""
+
+FIRST_RENDER_SCRIPT = """
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+start = time.perf_counter()
+at = AppTest.from_file({app_path!r}, default_timeout=120)
+at.run()
+print(json.dumps({{
+    "seconds": time.perf_counter() - start,
+    "exceptions": [e.value for e in at.exception],
+    "loaded": [m for m in {deferred!r} if m in sys.modules],
+}}))
+"""
+
+def run_child(script, env=None):
+    """
+    新しいPythonプロセスでスクリプトを実行し、最終行のJSONを返す
+    """
+    output = subprocess.run(
+        [sys.executable, "-c", script],
+        capture_output=True, text=True, check=True, env=env,
+        cwd=os.path.dirname(APP_PATH),
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def bench_imports(args, results):
+    for module in IMPORT_MODULES:
+        times = [run_child(IMPORT_SCRIPT.format(module=module))["seconds"] for _ in range(args.repeat)]
+        record(results, f"import.{module}", 0, 0, times)
+
+def bench_first_render(args, results):
+    with tempfile.TemporaryDirectory() as tmp:
+        # 既存の株価キャッシュに触れないよう、一時ファイルを使う
+        env = {**os.environ, "STARTUP_WARMUP": "0", "PRICE_CACHE_PATH": os.path.join(tmp, "cache.sqlite3")}
+        env.pop("METRICS_PORT", None)
+        runs = [
+            run_child(FIRST_RENDER_SCRIPT.format(app_path=APP_PATH, deferred=DEFERRED_MODULES), env)
+            for _ in range(args.repeat)
+        ]
+    if runs[-1]["exceptions"]:
+        raise RuntimeError(runs[-1]["exceptions"])
+    record(results, "first_render", 0, 0, [r["seconds"] for r in runs], loaded_modules=runs[-1]["loaded"])
+    print(f"  loaded at first render: {', '.join(runs[-1]['loaded']) or '-'}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stock Trade Visualizer の起動時間ベンチマーク")
+    parser.add_argument("--repeat", type=int, default=5, help="各ベンチマークの実行回数")
+    parser.add_argument("-o", "--output", default="bench_startup.json", help="結果の出力先 (JSON)")
+    parser.add_argument("--compare", help="比較する前回の結果 (JSON)")
+    args = parser.parse_args(argv)
+
+    results = []
+    bench_imports(args, results)
+    bench_first_render(args, results)
+
+    output = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(output, f, ensure_ascii=False, indent=2)
+    print(f"\nwrote {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,200 @@
+"""
+ベンチマーク用の合成データ
+- SBI証券形式 (Shift-JIS) の約定履歴CSVの生成
+- yf.Ticker(...).history の代わりに使うオフラインの株価 (銘柄ごとに決まったランダムウォーク)
+- 遅延・失敗・頻度制限を真似る偽の取得元 (FlakyPriceProvider)
+
+単体でも実行できる:
+    python -m bench.synthetic out.csv --fills 100000 --tickers 200 --days 1500
+"""
+import argparse
+import threading
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+
+CALENDAR_START = "2000-01-03"
+CALENDAR_END = "2035-12-31"
+SBI_COLUMNS = [
+    "約定日", "銘柄", "銘柄コード", "市場", "取引", "期限", "預り", "課税",
+    "約定数量", "約定単価", "手数料/諸経費等", "税額", "受渡日", "受渡金額/決済損益",
+]
+WRITE_CHUNK_ROWS = 500_000
+
+class OfflinePriceProvider:
+    """
+    銘柄コードから決まるランダムウォークの日足 (営業日のみ) を返す
+    同じ銘柄・期間なら常に同じ値になるため、ネットワークなしで再現性のある計測ができる
+    """
+
+    def __init__(self):
+        self.calendar = pd.bdate_range(CALENDAR_START, CALENDAR_END)
+        self._series = {}
+
+    def _ohlcv(self, ticker):
+        if ticker not in self._series:
+            rng = np.random.default_rng(zlib.crc32(ticker.encode()))
+            n = len(self.calendar)
+            close = 1000 * np.exp(np.cumsum(rng.normal(0, 0.015, n)))
+            spread = close * rng.uniform(0.002, 0.02, n)
+            open_ = close * (1 + rng.normal(0, 0.005, n))
+            self._series[ticker] = pd.DataFrame({
+                "Open": open_,
+                "High": np.maximum(open_, close) + spread,
+                "Low": np.minimum(open_, close) - spread,
+                "Close": close,
+                "Volume": rng.integers(10_000, 1_000_000, n).astype("float64"),
+            }, index=self.calendar)
+        return self._series[ticker]
+
+    def history(self, ticker, start, end):
+        """
+        [start, end) の日足 (PriceStore の fetch_history と同じ呼び出し方)
+        """
+        data = self._ohlcv(ticker)
+        return data[(data.index >= pd.Timestamp(start)) & (data.index < pd.Timestamp(end))].copy()
+
+    def close_on(self, ticker, dates):
+        return self._ohlcv(ticker)["Close"].reindex(dates).to_numpy()
+
+class OfflineTicker:
+    """
+    yf.Ticker の代わり (history と info のみ)
+    """
+    provider = OfflinePriceProvider()
+
+    def __init__(self, ticker):
+        self.ticker = ticker
+
+    def history(self, start=None, end=None, **kwargs):
+        return self.provider.history(self.ticker, start, end)
+
+    @property
+    def info(self):
+        return {"shortName": f"Synthetic {self.ticker}"}
+
+class FlakyPriceProvider:
+    """
+    遅延・失敗・頻度制限を真似る偽の取得元 (FetchScheduler の動作確認用)
+    - 各問い合わせに latency 秒かかる
+    - 直近1秒の問い合わせが limit_per_sec を超えると 429 相当の例外を送出する
+    - fail_rate の確率で接続エラーを送出する (failing=True の間は常に失敗)
+    """
+
+    def __init__(self, provider=None, latency=0.05, limit_per_sec=None, fail_rate=0.0, seed=0):
+        self.provider = provider or OfflinePriceProvider()
+        self.latency = latency
+        self.limit_per_sec = limit_per_sec
+        self.fail_rate = fail_rate
+        self.failing = False
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+        self.calls = []          # (時刻, 銘柄) 問い合わせごと
+        self.rate_limited = 0
+
+    def _request(self, ticker):
+        with self.lock:
+            now = time.monotonic()
+            self.calls.append((now, ticker))
+            recent = sum(1 for t, _ in self.calls[-(self.limit_per_sec or 0) - 1:] if now - t < 1.0)
+            limited = self.limit_per_sec is not None and recent > self.limit_per_sec
+            failed = self.failing or self.rng.random() < self.fail_rate
+            if limited:
+                self.rate_limited += 1
+        time.sleep(self.latency)
+        if limited:
+            raise RuntimeError(f"429 Too Many Requests: {ticker}")
+        if failed:
+            raise ConnectionError(f"connection reset: {ticker}")
+
+    def history(self, ticker, start, end):
+        self._request(ticker)
+        return self.provider.history(ticker, start, end)
+
+    def name(self, ticker):
+        self._request(ticker)
+        return f"Synthetic {ticker}"
+
+def generate_fills(n_fills, n_tickers=200, days=1500, start="2019-01-04", seed=0, provider=None):
+    """
+    約定データを生成する (新しい約定が先頭、SBI証券のエクスポートと同じ並び)
+    約定単価はオフライン株価の終値に合わせる
+    """
+    provider = provider or OfflinePriceProvider()
+    rng = np.random.default_rng(seed)
+    trading_days = pd.bdate_range(start, periods=days)
+    codes = np.sort(rng.choice(np.arange(1300, 9999), n_tickers, replace=False))
+
+    ticker_idx = rng.integers(0, n_tickers, n_fills)
+    day_idx = rng.integers(0, days, n_fills)
+    prices = np.empty(n_fills)
+    for i, code in enumerate(codes):
+        rows = ticker_idx == i
+        prices[rows] = provider.close_on(f"{code}.T", trading_days)[day_idx[rows]]
+
+    order = np.lexsort((ticker_idx, -day_idx))
+    return pd.DataFrame({
+        "date": trading_days[day_idx[order]],
+        "code": codes[ticker_idx[order]],
+        "buy": rng.random(n_fills) < 0.55,
+        "qty": rng.choice([100, 200, 300, 500, 1000], n_fills),
+        "price": np.round(prices[order]),
+    })
+
+def to_sbi_frame(fills):
+    """
+    生成した約定データをSBI証券のCSV列に整形する
+    """
+    date_str = fills["date"].dt.strftime("%Y/%m/%d")
+    code = fills["code"].astype(str)
+    return pd.DataFrame({
+        "約定日": date_str,
+        "銘柄": "合成銘柄" + code,
+        "銘柄コード": code,
+        "市場": "東証",
+        "取引": np.where(fills["buy"], "株式現物買", "株式現物売"),
+        "期限": "当日",
+        "預り": "特定",
+        "課税": "申告",
+        "約定数量": fills["qty"],
+        "約定単価": fills["price"].astype("int64"),
+        "手数料/諸経費等": "--",
+        "税額": "--",
+        "受渡日": (fills["date"] + pd.offsets.BDay(2)).dt.strftime("%Y/%m/%d"),
+        "受渡金額/決済損益": (fills["qty"] * fills["price"]).astype("int64"),
+    }, columns=SBI_COLUMNS)
+
+def write_sbi_csv(path_or_buffer, n_fills, n_tickers=200, days=1500, seed=0, provider=None):
+    """
+    SBI証券形式の約定履歴CSV (Shift-JIS, CRLF, ヘッダー前に説明行あり) を書き出す
+    大きな件数でもメモリを抑えるため、チャンクごとに追記する
+    """
+    fills = generate_fills(n_fills, n_tickers, days, seed=seed, provider=provider)
+    preamble = f'"約定履歴照会"\r\n"一括"\r\n\r\n"検索件数","{n_fills}件"\r\n\r\n'
+
+    own_file = isinstance(path_or_buffer, str)
+    f = open(path_or_buffer, "wb") if own_file else path_or_buffer
+    try:
+        f.write(preamble.encode("shift-jis"))
+        for i in range(0, max(n_fills, 1), WRITE_CHUNK_ROWS):
+            chunk = to_sbi_frame(fills.iloc[i:i + WRITE_CHUNK_ROWS])
+            text = chunk.to_csv(index=False, header=(i == 0), quoting=1, lineterminator="\r\n")
+            f.write(text.encode("shift-jis"))
+    finally:
+        if own_file:
+            f.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SBI証券形式の合成約定履歴CSVを生成する")
+    parser.add_argument("output", help="出力するCSVのパス")
+    parser.add_argument("--fills", type=int, default=100_000, help="約定件数")
+    parser.add_argument("--tickers", type=int, default=200, help="銘柄数")
+    parser.add_argument("--days", type=int, default=1500, help="期間 (営業日数)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    write_sbi_csv(args.output, args.fills, args.tickers, args.days, args.seed)
+
+if __name__ == "__main__":
+    main()
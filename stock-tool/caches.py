@@ -0,0 +1,233 @@
+"""
+メモリ量 (バイト数) で上限を決めるキャッシュ
+- MemoryBudget: プロセス内の全キャッシュを1つの上限で管理し、どのキャッシュのものかを問わず
+  最も長く使われていないものから追い出す。使われなくなったセッションのものもまとめて追い出せる
+- ByteLRU: MemoryBudget の1つのキャッシュ (group) を、独自の上限を持つ LRU として使う
+ヒット・ミス・追い出しの回数をキャッシュごとに記録する
+標準ライブラリと metrics のみを使う (Streamlit に依存しない)
+"""
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+def estimate_bytes(value, seen=None):
+    """
+    値がメモリ上で占めるおおよそのバイト数
+    DataFrame / Series は文字列の列の中身まで数え、dict・list・tuple はたどって合計する
+    (同じオブジェクトを複数の場所から参照していても1回だけ数える)
+    """
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+
+    memory_usage = getattr(value, "memory_usage", None)
+    if callable(memory_usage):  # pandas の DataFrame / Series / Index
+        usage = memory_usage(deep=True)
+        return int(usage.sum()) if hasattr(usage, "sum") else int(usage)
+    if hasattr(value, "nbytes") and hasattr(value, "dtype"):  # numpy の配列
+        return int(value.nbytes)
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_bytes(k, seen) + estimate_bytes(v, seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(estimate_bytes(v, seen) for v in value)
+    return size
+
+class MemoryBudget:
+    """
+    値とそのバイト数を (group, key) ごとに登録し、合計が max_bytes を超えないように古いものから追い出す
+    - group: キャッシュの名前。set_limit で group ごとの上限も決められる
+    - owner: 値を持つセッション (全セッションで共有する値は None)。evict_idle で使われなくなったセッションの値を追い出す
+    - on_evict: 追い出したときに呼ぶ関数 (値を別の場所にも保持している場合に、そちらから外すため)
+    プロセス内の全セッション・全スレッドで共有できる
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # (group, key) -> (値, バイト数, owner, on_evict)。末尾が最近使ったもの
+        self.bytes = 0
+        self.limits = {}
+        self.groups = {}
+        self.last_seen = {}  # owner -> 最後に使われた時刻 (time.monotonic)
+        self.idle_evictions = 0
+
+    def _group(self, group):
+        return self.groups.setdefault(group, {
+            "entries": 0, "bytes": 0, "hits": 0, "misses": 0, "evictions": 0, "evicted_bytes": 0, "oversize": 0,
+        })
+
+    def set_limit(self, group, max_bytes):
+        with self.lock:
+            self.limits[group] = max_bytes
+            self._group(group)
+
+    def get(self, group, key):
+        """
+        登録されていれば値を返して最近使ったものにする。無ければ None
+        """
+        with self.lock:
+            entry = self.entries.get((group, key))
+            counts = self._group(group)
+            if entry is None:
+                counts["misses"] += 1
+            else:
+                self.entries.move_to_end((group, key))
+                counts["hits"] += 1
+        metrics.count(f"cache.{group}.{'miss' if entry is None else 'hit'}")
+        return None if entry is None else entry[0]
+
+    def touch(self, group, key):
+        """
+        値を取り出さずに最近使ったものにする (ヒット数は数えない)
+        """
+        with self.lock:
+            if (group, key) in self.entries:
+                self.entries.move_to_end((group, key))
+
+    def put(self, group, key, value, size=None, owner=None, on_evict=None):
+        """
+        値を登録し、上限を超えた分を古いものから追い出す (size を省くと estimate_bytes で測る)
+        1件で上限を超える値は登録せず、同じキーの古い値も外して False を返す
+        """
+        size = estimate_bytes(value) if size is None else size
+        with self.lock:
+            old = self.entries.pop((group, key), None)
+            if old is not None:
+                self._forget(group, old[1])
+            counts = self._group(group)
+            limit = min(self.max_bytes, self.limits.get(group, self.max_bytes))
+            if size > limit:
+                counts["oversize"] += 1
+                return False
+            self.entries[(group, key)] = (value, size, owner, on_evict)
+            self.bytes += size
+            counts["entries"] += 1
+            counts["bytes"] += size
+            if owner is not None:
+                self.last_seen.setdefault(owner, time.monotonic())
+
+            # 1. group の上限を超えた分をその group の古いものから
+            evicted = []
+            if counts["bytes"] > limit:
+                for k in [k for k in self.entries if k[0] == group]:
+                    if counts["bytes"] <= limit:
+                        break
+                    evicted.append(self._evict(k))
+            # 2. 全体の上限を超えた分を全 group の古いものから
+            while self.bytes > self.max_bytes:
+                evicted.append(self._evict(next(iter(self.entries))))
+        self._evicted(evicted)
+        return True
+
+    def _forget(self, group, size):
+        self.bytes -= size
+        self.groups[group]["entries"] -= 1
+        self.groups[group]["bytes"] -= size
+
+    def _evict(self, k):
+        # ロックの中で呼ぶ。on_evict はロックの外で _evicted が呼ぶ
+        entry = self.entries.pop(k)
+        self._forget(k[0], entry[1])
+        self.groups[k[0]]["evictions"] += 1
+        self.groups[k[0]]["evicted_bytes"] += entry[1]
+        return k[0], entry[3]
+
+    def _evicted(self, evicted):
+        for group, on_evict in evicted:
+            metrics.count(f"cache.{group}.evict")
+            if on_evict is not None:
+                on_evict()
+
+    def seen(self, owner):
+        """
+        owner (セッション) が使われたことを記録する (evict_idle の判定に使う)
+        """
+        if owner is not None:
+            with self.lock:
+                self.last_seen[owner] = time.monotonic()
+
+    def evict_idle(self, is_active, idle_seconds):
+        """
+        閉じられた (is_active が False) か idle_seconds より長く使われていないセッションの値を全て追い出す
+        戻り値: 追い出した件数
+        """
+        now = time.monotonic()
+        with self.lock:
+            owners = dict(self.last_seen)
+        # is_active は Streamlit のロックを取り得るため、こちらのロックの外で呼ぶ
+        idle = {owner for owner, seen in owners.items() if now - seen > idle_seconds or not is_active(owner)}
+        if not idle:
+            return 0
+
+        with self.lock:
+            evicted = [self._evict(k) for k, entry in list(self.entries.items()) if entry[2] in idle]
+            for owner in idle:
+                self.last_seen.pop(owner, None)
+            self.idle_evictions += len(evicted)
+        self._evicted(evicted)
+        return len(evicted)
+
+    def clear(self, group=None):
+        """
+        値を全て外す (group を渡すとその group だけ)。追い出しとしては数えない
+        """
+        with self.lock:
+            for k in [k for k in self.entries if group is None or k[0] == group]:
+                self._forget(k[0], self.entries.pop(k)[1])
+
+    def group_stats(self, group):
+        with self.lock:
+            return dict(self._group(group))
+
+    def stats(self):
+        """
+        全体の使用量と累計の追い出しの回数、group ごとの件数・バイト数・ヒット・ミス・追い出しの回数
+        """
+        with self.lock:
+            return {
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "entries": len(self.entries),
+                "evictions": sum(counts["evictions"] for counts in self.groups.values()),
+                "idle_evictions": self.idle_evictions,
+                "sessions": len(self.last_seen),
+                "groups": {group: dict(counts) for group, counts in self.groups.items()},
+            }
+
+class ByteLRU:
+    """
+    MemoryBudget の1つの group を、独自の上限 max_bytes を持つ LRU キャッシュとして使う
+    budget を渡さなければこのキャッシュ専用の MemoryBudget を作る
+    """
+
+    def __init__(self, name, max_bytes, budget=None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.budget = budget or MemoryBudget(max_bytes)
+        self.budget.set_limit(name, max_bytes)
+
+    def get(self, key):
+        """
+        キャッシュにあれば値を返して最近使ったものにする。無ければ None
+        """
+        return self.budget.get(self.name, key)
+
+    def put(self, key, value, size):
+        """
+        値を登録し、上限を超えた分を古いものから追い出す。1件で上限を超える値は登録しない
+        """
+        return self.budget.put(self.name, key, value, size)
+
+    def clear(self):
+        self.budget.clear(self.name)
+
+    def stats(self):
+        """
+        現在の件数・バイト数と累計のヒット・ミス・追い出しの回数
+        """
+        return {**self.budget.group_stats(self.name), "max_bytes": self.max_bytes}
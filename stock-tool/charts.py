@@ -0,0 +1,378 @@
+"""
+価格チャート (Plotly) の組み立て
+Streamlit に依存しないため、ベンチマーク (bench/) からも使う
+plotly は読み込みに時間がかかるため、起動時ではなく最初のチャート作成時に読み込む
+"""
+import json
+import zlib
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+from indicators import DEFAULT_INDICATORS, indicator_columns, indicator_warmup
+from market_calendar import trading_days_before
+
+def chart_window(min_trade_date, max_trade_date, warmup_bars=indicator_warmup(DEFAULT_INDICATORS)):
+    """
+    取引期間からチャートの (取得開始日, 表示開始日, 終了日) を求める
+    表示は取引の前後30日、取得は表示開始日から指標のウォームアップ分 (warmup_bars 営業日) だけ遡る
+    スカラーでも Series でも計算でき、未来の終了日は to_date_range で今日に丸められる
+    """
+    display_start_date = min_trade_date - timedelta(days=30)
+    end_date = max_trade_date + timedelta(days=30)
+    fetch_start_date = trading_days_before(display_start_date, warmup_bars)
+
+    return fetch_start_date, display_start_date, end_date
+
+# --- 売買マーカー ---
+MAX_TRADE_ANNOTATIONS = 50      # 吹き出しを表示する取引数の既定値 (新しい順)
+WEBGL_MARKER_THRESHOLD = 500    # 取引数がこれを超えたらマーカーをWebGL (Scattergl) で描画する
+
+TRADE_SNAP_DAYS = 4             # 日足では取引日からこの暦日数以内のバーにだけ寄せる (休場日の取引のため)
+
+def bucket_days(resolution):
+    """
+    解像度 ("D" / "W" / "M" / "3M" など) の1本のバーが表す期間のおおよその暦日数 (最長の月で数える)
+    """
+    if resolution == "D":
+        return 1
+    if resolution == "W":
+        return 7
+    return 31 * int(resolution[:-1] or 1)
+
+def align_trades_to_bars(trade_dates, bar_dates, resolution="D", max_gap_days=TRADE_SNAP_DAYS):
+    """
+    各取引日に最も近いチャートのバーの位置を返す (休場日の取引も近いバーに寄せる)
+    週足・月足のときは、取引日を含む期間のバー (開始日が取引日以前で最も新しいバー) を返す
+    近くにバーが無い取引 (上場廃止後や日足の欠けている期間の取引) は、離れた日付・価格に描かないよう -1 にする
+    (日足では最も近いバーが max_gap_days より離れている場合、週足・月足ではバーの期間に含まれない場合)
+    """
+    bars = bar_dates.to_numpy(dtype="datetime64[ns]")
+    trades = trade_dates.to_numpy(dtype="datetime64[ns]")
+    max_gap = np.timedelta64(max_gap_days, "D")
+    if len(bars) == 0:
+        return np.full(len(trades), -1, dtype=np.intp)
+    if resolution != "D":
+        pos = np.searchsorted(bars, trades, side="right") - 1
+        inside = trades - bars[pos.clip(0)] < np.timedelta64(bucket_days(resolution), "D")
+        # 最初のバーより前の取引は、期間の途中から始まるデータのために近ければ最初のバーに寄せる
+        before_first = (pos < 0) & (bars[0] - trades <= max_gap)
+        return np.where(before_first, 0, np.where((pos >= 0) & inside, pos, -1))
+    if len(bars) == 1:
+        pos = np.zeros(len(trades), dtype=np.intp)
+    else:
+        pos = np.searchsorted(bars, trades).clip(1, len(bars) - 1)
+        prev = pos - 1
+        nearer_prev = (trades - bars[prev]) <= (bars[pos] - trades)
+        pos = np.where(nearer_prev, prev, pos)
+    return np.where(np.abs(trades - bars[pos]) <= max_gap, pos, -1)
+
+def add_trade_markers(fig, ticker_df, stock_data, qty_col, max_annotations=MAX_TRADE_ANNOTATIONS, resolution="D"):
+    """
+    売買マーカーを売り・買いそれぞれ1つのトレースにまとめて描画する
+    吹き出しは新しい取引から max_annotations 件だけ付ける
+    近くにバーが無い取引 (align_trades_to_bars が -1 を返すもの) は描かない
+    """
+    trades = ticker_df[ticker_df["Side"].isin(["Buy", "Sell"]) & ticker_df["約定単価"].notna()]
+    if trades.empty:
+        return
+
+    # 取引日 → チャート上のバー (二分探索で一括対応付け)
+    bar_pos = align_trades_to_bars(trades["約定日"], stock_data.index, resolution)
+    near = bar_pos >= 0
+    trades, bar_pos = trades[near], bar_pos[near]
+    if trades.empty:
+        return
+    x = stock_data['DateStr'].to_numpy()[bar_pos]
+    price = trades["約定単価"].to_numpy()
+    is_buy = (trades["Side"] == "Buy").to_numpy()
+
+    # 表示テキストの一括生成 (例: 12/05 買<br>1055円 100株)
+    side_label = pd.Series(np.where(is_buy, "買", "売"), index=trades.index)
+    qty = "-"
+    if qty_col:
+        qty_num = trades[qty_col].round()
+        qty = qty_num.astype("Int64").astype(str).where(qty_num.notna(), "-")
+    label = (
+        trades["約定日"].dt.strftime('%m/%d') + " " + side_label + "<br>"
+        + trades["約定単価"].astype("int64").astype(str) + "円 " + qty + "株"
+    ).to_numpy()
+
+    # Markers (one trace per side)
+    import plotly.graph_objects as go
+
+    scatter = go.Scattergl if len(trades) > WEBGL_MARKER_THRESHOLD else go.Scatter
+    for name, mask, color, symbol in (
+        ("買い", is_buy, '#ef4444', 'triangle-up'),
+        ("売り", ~is_buy, '#2563eb', 'triangle-down'),
+    ):
+        if not mask.any():
+            continue
+        fig.add_trace(scatter(
+            x=x[mask],
+            y=price[mask],
+            mode='markers',
+            name=name,
+            text=label[mask],
+            hovertemplate='%{text}<extra></extra>',
+            marker=dict(color=color, symbol=symbol, size=11, line=dict(color='white', width=1))
+        ), row=1, col=1)
+
+    # Annotations (Speech Bubble) - 新しい取引から上限件数まで
+    if max_annotations <= 0:
+        return
+    recent = np.argsort(trades["約定日"].to_numpy(), kind="stable")[-max_annotations:]
+    annotations = []
+    for i in recent:
+        color = '#ef4444' if is_buy[i] else '#2563eb'
+        annotations.append(dict(
+            x=x[i],
+            y=price[i],
+            xref='x',
+            yref='y',
+            text=f"<b>{label[i]}</b>",
+            showarrow=True,
+            arrowhead=2,
+            arrowsize=1,
+            arrowwidth=2,
+            arrowcolor=color,
+            ax=0,
+            ay=-60 if is_buy[i] else 60,  # Increase distance for visibility
+            bgcolor="white",
+            bordercolor=color,
+            borderwidth=2,
+            borderpad=4,
+            font=dict(color=color, size=12),
+            opacity=1.0
+        ))
+    # 1回の更新でまとめて追加 (サブプロットのタイトルも annotations に含まれる)
+    fig.update_layout(annotations=[*fig.layout.annotations, *annotations])
+
+# --- 表示の間引き (LOD) ---
+LOD_MAX_BARS = 500     # 日足がこれを超えたら週足・月足に集約する (ブラウザに送るバーの上限)
+MAX_TICK_LABELS = 20   # x軸の目盛りの最大数
+RESOLUTION_LABELS = {"D": "日足", "W": "週足", "M": "月足"}
+OHLCV_AGGREGATION = ["Open", "High", "Low", "Close", "Volume"]
+
+def downsample_bars(stock_data, max_bars=LOD_MAX_BARS):
+    """
+    日足が max_bars 本を超えたら週足、それでも超えたら月足 (さらに超えたら数か月ずつ) に集約する
+    - 始値は期間の最初、高値・安値は期間の最高・最安 (ヒゲの長さは保たれる)、終値は最後、出来高は合計
+    - 指標の列は期間の最後の日の値
+    - 各バーの日付は期間の最初の営業日
+    戻り値: (集約後のデータ, 解像度 "D" / "W" / "M" / "3M" など)
+    """
+    if len(stock_data) <= max_bars:
+        return stock_data, "D"
+
+    # 1. 期間の区切り (日付は昇順なので、キーが変わる位置が期間の先頭)
+    dates = stock_data.index.tz_localize(None) if stock_data.index.tz is not None else stock_data.index
+    for resolution, freq in (("W", "W-SUN"), ("M", "M")):
+        keys = dates.to_period(freq).asi8
+        if len(np.unique(keys)) <= max_bars:
+            break
+    else:
+        months = -(-len(np.unique(keys)) // max_bars)
+        keys = keys // months
+        resolution = f"{months}M"
+    starts = np.r_[0, np.flatnonzero(np.diff(keys)) + 1]
+    ends = np.r_[starts[1:] - 1, len(keys) - 1]
+
+    # 2. 期間ごとの集約 (reduceat で一括計算)
+    bars = pd.DataFrame(index=stock_data.index[starts])
+    bars["Open"] = stock_data["Open"].to_numpy()[starts]
+    bars["High"] = np.fmax.reduceat(stock_data["High"].to_numpy(), starts)
+    bars["Low"] = np.fmin.reduceat(stock_data["Low"].to_numpy(), starts)
+    bars["Close"] = stock_data["Close"].to_numpy()[ends]
+    bars["Volume"] = np.add.reduceat(np.nan_to_num(stock_data["Volume"].to_numpy(dtype="float64")), starts)
+    for col in stock_data.columns.difference(OHLCV_AGGREGATION, sort=False):
+        bars[col] = stock_data[col].to_numpy()[ends]
+    return bars, resolution
+
+def tick_labels(dates, resolution, max_ticks=MAX_TICK_LABELS):
+    """
+    x軸の目盛り (位置の日付文字列, 表示文字列) を最大 max_ticks 個に間引いて返す
+    """
+    if len(dates) == 0:
+        return [], []
+    positions = np.unique(np.linspace(0, len(dates) - 1, min(len(dates), max_ticks)).round().astype(int))
+    if resolution != "D":
+        fmt = "%Y/%m" if resolution.endswith("M") else "%Y/%m/%d"
+    else:
+        fmt = "%m/%d" if dates[-1] - dates[0] <= pd.Timedelta(days=365) else "%y/%m/%d"
+    ticks = dates[positions]
+    return ticks.strftime('%Y-%m-%d').tolist(), ticks.strftime(fmt).tolist()
+
+# --- 価格チャート ---
+INDICATOR_COLORS = ['#f59e0b', '#2563eb', '#8b5cf6', '#ec4899', '#14b8a6', '#f97316', '#64748b']
+
+def build_price_figure(stock_data, ticker_df, max_annotations=MAX_TRADE_ANNOTATIONS, indicators=DEFAULT_INDICATORS,
+                       resolution="D"):
+    """
+    ローソク足・指標・売買マーカー・出来高のチャートを作る
+    オシレーター (RSI, MACD など) は出来高の下に1つずつ段を追加する
+    stock_data には add_indicators で indicators の列を追加しておく (週足・月足なら downsample_bars で集約済み)
+    """
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+
+    columns = indicator_columns(indicators)
+    panels = list(dict.fromkeys(panel for _, panel in columns if panel))
+    rows = 2 + len(panels)
+    panel_rows = {panel: 3 + i for i, panel in enumerate(panels)}
+
+    # Plotly Chart
+    fig = make_subplots(
+        rows=rows, cols=1, 
+        shared_xaxes=True, 
+        vertical_spacing=0.05, 
+        row_heights=[0.75, 0.25] + [0.25] * len(panels),
+        subplot_titles=("Price Action", "Volume", *panels)
+    )
+
+    stock_data['DateStr'] = stock_data.index.strftime('%Y-%m-%d')
+
+    # Candlestick (Modern Colors)
+    fig.add_trace(go.Candlestick(
+        x=stock_data['DateStr'],
+        open=stock_data['Open'],
+        high=stock_data['High'],
+        low=stock_data['Low'],
+        close=stock_data['Close'],
+        name='Price',
+        increasing_line_color='#10b981', # Emerald Green
+        decreasing_line_color='#ef4444'  # Red
+    ), row=1, col=1)
+
+    # Indicators (価格に重ねる線と、オシレーターの段)
+    for i, (column, panel) in enumerate(columns):
+        line = dict(color=INDICATOR_COLORS[i % len(INDICATOR_COLORS)], width=1.5)
+        if column.endswith(" hist"):
+            trace = go.Bar(x=stock_data['DateStr'], y=stock_data[column], name=column,
+                           marker_color=line['color'], opacity=0.5)
+        else:
+            if column.endswith((" upper", " lower")):
+                line["dash"] = "dot"
+            trace = go.Scatter(x=stock_data['DateStr'], y=stock_data[column], mode='lines', name=column, line=line)
+        fig.add_trace(trace, row=panel_rows.get(panel, 1), col=1)
+
+    # Trade Markers & Annotations
+    qty_col = None
+    for col in ['約定数量', '数量', '株数']:
+        if col in ticker_df.columns:
+            qty_col = col
+            break
+
+    add_trade_markers(fig, ticker_df, stock_data, qty_col, max_annotations, resolution=resolution)
+
+    # Volume
+    fig.add_trace(go.Bar(
+        x=stock_data['DateStr'],
+        y=stock_data['Volume'],
+        name='Volume',
+        marker_color='#9ca3af', # Gray
+        opacity=0.4
+    ), row=2, col=1)
+
+    # Layout Styling
+    tickvals, ticktext = tick_labels(stock_data.index, resolution)
+
+    fig.update_layout(
+        height=800 + 200 * len(panels),
+        template="plotly_white", # Light Theme
+        paper_bgcolor='rgba(0,0,0,0)',
+        plot_bgcolor='rgba(0,0,0,0)',
+        font=dict(family="Inter, sans-serif", color="#1f2937"),
+        yaxis=dict(title="Price (JPY)", gridcolor='#e5e7eb'),
+        yaxis2=dict(title="Volume", gridcolor='#e5e7eb'),
+        showlegend=True,
+        legend=dict(
+            orientation="h",
+            yanchor="bottom",
+            y=1.02,
+            xanchor="right",
+            x=1
+        ),
+        margin=dict(l=20, r=20, t=60, b=20)
+    )
+    for panel, row in panel_rows.items():
+        fig.update_yaxes(title=None, gridcolor='#e5e7eb', row=row, col=1)
+        if panel.startswith("RSI"):
+            fig.update_yaxes(range=[0, 100], row=row, col=1)
+
+    # 日付の目盛りは最下段だけに表示する
+    fig.update_xaxes(type='category', showticklabels=False, gridcolor='#e5e7eb')
+    fig.update_xaxes(
+        showticklabels=True,
+        tickmode='array',
+        tickvals=tickvals,
+        ticktext=ticktext,
+        title=None,
+        tickangle=-45,
+        row=rows, col=1,
+    )
+    fig.update_layout(xaxis_rangeslider_visible=False)
+
+    return fig
+
+# --- 作成済みチャートの保存 ---
+FIGURE_COMPRESS_LEVEL = 1  # JSONは繰り返しが多く、最速の圧縮でも1/3程度になる
+
+def figure_to_bytes(fig):
+    """
+    チャートをキャッシュに保存するため、JSONを圧縮したバイト列にする
+    """
+    return zlib.compress(fig.to_json().encode(), FIGURE_COMPRESS_LEVEL)
+
+def figure_from_bytes(blob):
+    """
+    figure_to_bytes で保存したチャートを復元する
+    保存したのは検証済みのチャートのため、プロパティの検証 (作成し直すのと同程度に遅い) を省く
+    """
+    import plotly.graph_objects as go
+
+    return go.Figure(json.loads(zlib.decompress(blob)), _validate=False)
+
+# --- ポートフォリオの損益推移 ---
+def build_equity_figure(curve):
+    """
+    損益合計 (実現 + 評価) と実現損益の推移、その下にドローダウンの2段チャートを作る
+    """
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+
+    fig = make_subplots(
+        rows=2, cols=1,
+        shared_xaxes=True,
+        vertical_spacing=0.05,
+        row_heights=[0.7, 0.3],
+        subplot_titles=("損益 (JPY)", "ドローダウン (JPY)")
+    )
+    fig.add_trace(go.Scatter(
+        x=curve.index, y=curve["equity"], mode='lines', name='損益合計 (実現 + 評価)',
+        line=dict(color='#2563eb', width=1.5)
+    ), row=1, col=1)
+    fig.add_trace(go.Scatter(
+        x=curve.index, y=curve["realized"], mode='lines', name='実現損益',
+        line=dict(color='#9ca3af', width=1.2, dash='dot')
+    ), row=1, col=1)
+    fig.add_trace(go.Scatter(
+        x=curve.index, y=curve["drawdown"], mode='lines', name='ドローダウン',
+        fill='tozeroy', line=dict(color='#ef4444', width=1)
+    ), row=2, col=1)
+
+    fig.update_layout(
+        height=500,
+        template="plotly_white",
+        paper_bgcolor='rgba(0,0,0,0)',
+        plot_bgcolor='rgba(0,0,0,0)',
+        font=dict(family="Inter, sans-serif", color="#1f2937"),
+        showlegend=True,
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
+        margin=dict(l=20, r=20, t=60, b=20),
+        hovermode="x unified",
+    )
+    fig.update_xaxes(gridcolor='#e5e7eb')
+    fig.update_yaxes(gridcolor='#e5e7eb')
+    return fig
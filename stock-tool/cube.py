@@ -0,0 +1,101 @@
+"""
+約定ペアの集計キューブ (銘柄 × 決済月 × 買付曜日 × 保有期間の区分)
+突合結果を1回の groupby で切り口の組み合わせごとの 回数・勝ち数・総利益・総損失・保有日数の合計 にまとめ、
+絞り込みや切り口の変更はこの小さな表を足し合わせるだけで済ませる (突合・集計をやり直さない)
+合計値だけを持つため、どの組み合わせで足し合わせても勝率・損益レシオ・平均保有日数を正しく求められる
+Streamlit に依存しない
+"""
+import numpy as np
+import pandas as pd
+
+CUBE_DIMENSIONS = ["ticker", "month", "weekday", "hold_bucket"]
+CUBE_MEASURES = ["count", "wins", "gross_profit", "gross_loss", "hold_days"]
+WEEKDAY_LABELS = ["月", "火", "水", "木", "金", "土", "日"]
+# 保有日数 (暦日数) の区分。左端を含む [edge, 次の edge)
+HOLD_BUCKET_EDGES = [0, 1, 2, 6, 31, 91, 366]
+HOLD_BUCKET_LABELS = ["当日", "1日", "2〜5日", "6〜30日", "31〜90日", "91〜365日", "1年超"]
+
+def build_trade_cube(history):
+    """
+    約定ペア (match_fifo_lots の結果) から集計キューブを作る
+    切り口: ticker, month (売却した月の初日), weekday (買付日の曜日 0=月), hold_bucket (保有期間の区分)
+    値: count, wins (損益が正の回数), gross_profit, gross_loss (負けの損失の絶対値), hold_days (保有日数の合計)
+    """
+    pnl = history["pnl"].to_numpy(dtype="float64")
+    wins = pnl > 0
+    hold_days = (history["sell_date"] - history["buy_date"]).dt.days.to_numpy()
+    bucket = np.searchsorted(HOLD_BUCKET_EDGES, hold_days, side="right") - 1
+
+    frame = pd.DataFrame({
+        "ticker": history["ticker"].astype(str),
+        "month": history["sell_date"].to_numpy(dtype="datetime64[M]").astype("datetime64[ns]"),
+        "weekday": history["buy_date"].dt.dayofweek.astype("int8"),
+        "hold_bucket": pd.Categorical.from_codes(bucket, categories=HOLD_BUCKET_LABELS, ordered=True),
+        "count": np.ones(len(history), dtype="int64"),
+        "wins": wins.astype("int64"),
+        "gross_profit": np.where(wins, pnl, 0.0),
+        "gross_loss": np.where(wins, 0.0, -pnl),
+        "hold_days": hold_days.astype("int64"),
+    })
+    return frame.groupby(CUBE_DIMENSIONS, observed=True, sort=True)[CUBE_MEASURES].sum().reset_index()
+
+def cube_mask(cube, tickers=None, months=None, weekdays=None, hold_buckets=None):
+    """
+    キューブの行の絞り込み (None の切り口は絞り込まない)
+    months: (最初の月, 最後の月) の両端を含む範囲
+    """
+    mask = np.ones(len(cube), dtype=bool)
+    if tickers is not None:
+        mask &= cube["ticker"].isin(tickers).to_numpy()
+    if months is not None:
+        mask &= ((cube["month"] >= pd.Timestamp(months[0])) & (cube["month"] <= pd.Timestamp(months[1]))).to_numpy()
+    if weekdays is not None:
+        mask &= cube["weekday"].isin(weekdays).to_numpy()
+    if hold_buckets is not None:
+        mask &= cube["hold_bucket"].isin(hold_buckets).to_numpy()
+    return mask
+
+def add_ratios(totals):
+    """
+    合計値の列から 勝率・損益レシオ・平均利益・平均損失・平均保有日数・損益 の列を加える (summarize_trades と同じ定義)
+    """
+    count = totals["count"]
+    losses = count - totals["wins"]
+    avg_profit = (totals["gross_profit"] / totals["wins"]).where(totals["wins"] > 0, 0.0)
+    avg_loss = (totals["gross_loss"] / losses).where(losses > 0, 0.0)
+    return totals.assign(
+        win_rate=(totals["wins"] / count * 100).where(count > 0, 0.0),
+        risk_reward=(avg_profit / avg_loss).where(avg_loss > 0, np.inf),
+        avg_profit=avg_profit,
+        avg_loss=avg_loss,
+        avg_hold_days=(totals["hold_days"] / count).where(count > 0, 0.0),
+        pnl=totals["gross_profit"] - totals["gross_loss"],
+    )
+
+def rollup(cube, by, mask=None):
+    """
+    絞り込んだキューブを切り口 by (CUBE_DIMENSIONS のいずれか) ごとに足し合わせ、勝率などを加える
+    """
+    rows = cube if mask is None else cube[mask]
+    totals = rows.groupby(by, observed=True, sort=True)[CUBE_MEASURES].sum()
+    return add_ratios(totals)
+
+def cube_summary(cube, mask=None):
+    """
+    絞り込んだキューブ全体の合計 (summarize_trades と同じキーに平均保有日数・損益を加えた dict)
+    """
+    rows = cube if mask is None else cube[mask]
+    totals = add_ratios(rows[CUBE_MEASURES].sum().to_frame().T).iloc[0]
+    return {
+        "win_rate": float(totals["win_rate"]),
+        "risk_reward": float(totals["risk_reward"]),
+        "total_trades": int(totals["count"]),
+        "avg_profit": float(totals["avg_profit"]),
+        "avg_loss": float(totals["avg_loss"]),
+        "win_count": int(totals["wins"]),
+        "loss_count": int(totals["count"] - totals["wins"]),
+        "gross_profit": float(totals["gross_profit"]),
+        "gross_loss": float(totals["gross_loss"]),
+        "avg_hold_days": float(totals["avg_hold_days"]),
+        "pnl": float(totals["pnl"]),
+    }
@@ -0,0 +1,92 @@
+"""
+約定ペアごとの最大逆行幅 (MAE) ・最大順行幅 (MFE) と保有期間の集計
+全銘柄の日足 (高値・安値) を 銘柄→日付 の順に1本の配列に並べ、各トレードの保有期間を
+その配列の区間 [開始, 終了) に対応付けて、np.fmin.reduceat / np.fmax.reduceat で全トレードを一括で求める
+(トレードごとに日足を切り出して走査しない)
+Streamlit に依存しない
+"""
+import numpy as np
+import pandas as pd
+
+DAY_KEY_SPAN = 1 << 20  # 銘柄と日付を1つの整数キーにまとめるときの日付の桁 (1970年からの日数より大きい値)
+
+def excursion_ranges(history):
+    """
+    銘柄ごとに高値・安値が必要な期間 (最初の買い日, 最後の売り日) を返す
+    """
+    return history.groupby("ticker").agg(start=("buy_date", "min"), end=("sell_date", "max"))
+
+def trade_excursions(history, bars):
+    """
+    約定ペアごとに保有期間 (買い日〜売り日、両端を含む) の最安値・最高値から MAE / MFE を求める
+    bars: 列 ticker, date, high, low の日足 (銘柄→日付の順に並んでいること)
+    戻り値: history と同じ行順の DataFrame
+        hold_days (暦日数), hold_bars (保有期間の日足の本数),
+        low, high (保有期間の最安値・最高値), mae, mfe (円), mae_pct, mfe_pct (買値に対する%)
+    日足が1本も無いトレードは hold_days 以外が欠損になる
+    """
+    buy_date = history["buy_date"].to_numpy(dtype="datetime64[D]")
+    sell_date = history["sell_date"].to_numpy(dtype="datetime64[D]")
+    result = pd.DataFrame({"hold_days": (sell_date - buy_date).astype("int64")}, index=history.index)
+
+    # 1. 日足とトレードを (銘柄の番号, 日付) の整数キーで同じ数直線に並べる
+    tickers = pd.Index(bars["ticker"].unique())
+    bar_code = tickers.get_indexer(bars["ticker"])
+    bar_key = bar_code * DAY_KEY_SPAN + bars["date"].to_numpy(dtype="datetime64[D]").astype("int64")
+    trade_code = tickers.get_indexer(history["ticker"])
+    lo = np.searchsorted(bar_key, trade_code * DAY_KEY_SPAN + buy_date.astype("int64"), side="left")
+    hi = np.searchsorted(bar_key, trade_code * DAY_KEY_SPAN + sell_date.astype("int64"), side="right")
+    measured = (trade_code >= 0) & (hi > lo)
+
+    # 2. 各区間の最安値・最高値 (区間の開始・終了を交互に並べ、偶数番目の結果が各区間の値になる)
+    #    終了位置が配列の末尾になり得るため番兵を1つ足す。欠損値は fmin / fmax が無視する
+    low = np.full(len(history), np.nan)
+    high = np.full(len(history), np.nan)
+    if measured.any():
+        bounds = np.column_stack([lo[measured], hi[measured]]).ravel()
+        low[measured] = np.fmin.reduceat(np.append(bars["low"].to_numpy(dtype="float64"), np.nan), bounds)[::2]
+        high[measured] = np.fmax.reduceat(np.append(bars["high"].to_numpy(dtype="float64"), np.nan), bounds)[::2]
+
+    # 3. 買値からの逆行・順行 (買値より下がらなかったトレードの MAE は0、上がらなかったトレードの MFE は0)
+    buy_price = history["buy_price"].to_numpy(dtype="float64")
+    qty = history["qty"].to_numpy(dtype="float64")
+    result["hold_bars"] = np.where(measured, hi - lo, np.nan)
+    result["low"] = low
+    result["high"] = high
+    result["mae_pct"] = np.minimum(low / buy_price - 1, 0) * 100
+    result["mfe_pct"] = np.maximum(high / buy_price - 1, 0) * 100
+    result["mae"] = np.minimum(low - buy_price, 0) * qty
+    result["mfe"] = np.maximum(high - buy_price, 0) * qty
+    return result
+
+def holding_period_stats(history):
+    """
+    保有期間 (暦日数) の平均・中央値と、勝ちトレード・負けトレードそれぞれの平均
+    """
+    days = (history["sell_date"] - history["buy_date"]).dt.days.to_numpy(dtype="float64")
+    wins = history["pnl"].to_numpy() > 0
+
+    def mean(values):
+        return float(values.mean()) if len(values) else 0.0
+
+    return {
+        "avg_hold_days": mean(days),
+        "median_hold_days": float(np.median(days)) if len(days) else 0.0,
+        "avg_hold_days_win": mean(days[wins]),
+        "avg_hold_days_loss": mean(days[~wins]),
+    }
+
+def excursion_summary(history, excursions):
+    """
+    MAE / MFE の平均と、含み益のうち実際に利益として確定できた割合 (MFE に対する実現損益)
+    """
+    measured = excursions["mae_pct"].notna().to_numpy()
+    mfe = excursions["mfe"].to_numpy()[measured]
+    pnl = history["pnl"].to_numpy(dtype="float64")[measured]
+    captured = mfe > 0
+    return {
+        "measured_trades": int(measured.sum()),
+        "avg_mae_pct": float(excursions["mae_pct"][measured].mean()) if measured.any() else 0.0,
+        "avg_mfe_pct": float(excursions["mfe_pct"][measured].mean()) if measured.any() else 0.0,
+        "mfe_capture_pct": float(pnl[captured].sum() / mfe[captured].sum() * 100) if captured.any() else 0.0,
+    }
@@ -0,0 +1,179 @@
+"""
+取得元 (Yahoo Finance) への問い合わせをプロセス全体でまとめて制御するスケジューラー
+- 同じキー (銘柄・期間) の同時の問い合わせは1回にまとめ、結果を全員で共有する (single-flight)
+- トークンバケットで問い合わせの頻度を制限する
+- 失敗した問い合わせはジッター付きの指数バックオフで再試行する
+- 再試行しても失敗したキーはしばらく問い合わせずに即座に失敗させる (呼び出し側はキャッシュの古いデータを使う)
+標準ライブラリと metrics のみを使い、時計・sleep・乱数を差し替えられるため偽の取得元でも動作を確かめられる
+"""
+import logging
+import random
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger("stock_tool.fetch")
+
+FETCH_RATE_PER_SEC = 2.0   # 取得元への問い合わせの平均頻度 (回/秒)
+FETCH_BURST = 5            # 連続して問い合わせてよい回数 (バケットの容量)
+FETCH_MAX_RETRIES = 3      # 失敗時の再試行回数
+FETCH_BACKOFF_SEC = 0.5    # 最初の再試行までの待ち時間 (以降は倍々)
+FETCH_MAX_BACKOFF_SEC = 8.0
+FETCH_FAILURE_COOLDOWN_SEC = 60.0  # 失敗したキーを再び問い合わせるまでの時間
+
+class TokenBucket:
+    """
+    平均 rate 回/秒、最大 capacity 回まで連続を許すトークンバケット
+    トークンが無いときは次のトークンを予約してから待つため、待っている呼び出しも到着順に進む
+    """
+
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(capacity)
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        トークンを1つ取り出し、待った秒数を返す
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+class _Flight:
+    # 実行中の問い合わせ1件 (同じキーの呼び出しはこの結果を待つ)
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+class FetchScheduler:
+    """
+    取得元への問い合わせを single-flight・頻度制限・再試行付きで実行する
+    プロセス内の全セッション・全スレッドで1つを共有する
+    """
+
+    def __init__(self, rate=FETCH_RATE_PER_SEC, burst=FETCH_BURST, max_retries=FETCH_MAX_RETRIES,
+                 backoff=FETCH_BACKOFF_SEC, max_backoff=FETCH_MAX_BACKOFF_SEC,
+                 failure_cooldown=FETCH_FAILURE_COOLDOWN_SEC, clock=time.monotonic, sleep=time.sleep, rng=None):
+        self.bucket = TokenBucket(rate, burst, clock, sleep)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_cooldown = failure_cooldown
+        self.clock = clock
+        self.sleep = sleep
+        self.rng = rng or random.Random()
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.failed = {}  # キー -> (再び問い合わせてよい時刻, 最後の例外)
+        self.counts = {
+            "calls": 0, "upstream": 0, "coalesced": 0, "throttled": 0,
+            "retries": 0, "failures": 0, "short_circuited": 0,
+        }
+        self.waiting = 0  # トークン待ち・バックオフ中の問い合わせ数
+
+    def call(self, key, func, *args):
+        """
+        func(*args) を実行して結果を返す。同じ key の問い合わせが実行中ならその結果を待って共有する
+        再試行しても失敗した場合は最後の例外を送出する (待っていた呼び出しにも同じ例外を送出する)
+        失敗から failure_cooldown 秒以内の同じキーは問い合わせずに同じ例外を送出する
+        """
+        with self.lock:
+            self.counts["calls"] += 1
+            failed = self.failed.get(key)
+            if failed and self.clock() < failed[0]:
+                self.counts["short_circuited"] += 1
+                metrics.count("fetch.short_circuited")
+                raise failed[1]
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+            else:
+                flight.followers += 1
+                self.counts["coalesced"] += 1
+        metrics.count("fetch.calls")
+
+        if not leader:
+            metrics.count("fetch.coalesced")
+            flight.done.wait()
+        else:
+            try:
+                flight.result = self._run(key, func, args)
+            except Exception as e:
+                flight.error = e
+            finally:
+                with self.lock:
+                    del self.flights[key]
+                    now = self.clock()
+                    self.failed = {k: v for k, v in self.failed.items() if v[0] > now and k != key}
+                    if flight.error is not None:
+                        self.failed[key] = (now + self.failure_cooldown, flight.error)
+                flight.done.set()
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def _run(self, key, func, args):
+        for attempt in range(self.max_retries + 1):
+            with self.lock:
+                self.waiting += 1
+            try:
+                waited = self.bucket.acquire()
+            finally:
+                with self.lock:
+                    self.waiting -= 1
+            if waited > 0:
+                self._count("throttled")
+
+            self._count("upstream")
+            try:
+                return func(*args)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    self._count("failures")
+                    logger.warning("fetch failed after %d attempts: %s (%s)", attempt + 1, key, e)
+                    raise
+                # ジッター付き指数バックオフ (待ち時間は上限の半分〜上限の一様乱数)
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+                delay *= self.rng.uniform(0.5, 1.0)
+                self._count("retries")
+                logger.info("fetch retry %d in %.2fs: %s (%s)", attempt + 1, delay, key, e)
+                with self.lock:
+                    self.waiting += 1
+                try:
+                    self.sleep(delay)
+                finally:
+                    with self.lock:
+                        self.waiting -= 1
+
+    def _count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+        metrics.count(f"fetch.{name}")
+
+    def stats(self):
+        """
+        累計の回数と現在の状態 (実行中の問い合わせ数・待ち行列の長さ)
+        """
+        with self.lock:
+            return {
+                **self.counts,
+                "in_flight": len(self.flights),
+                "waiting_callers": sum(f.followers for f in self.flights.values()),
+                "queue_depth": self.waiting,
+            }
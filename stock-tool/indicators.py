@@ -0,0 +1,158 @@
+"""
+テクニカル指標の計算エンジン
+指標は "SMA(25)" や "MACD(12,26,9)" のような文字列で指定し、登録された計算関数で列単位に一括計算する
+各指標は値が確定するまでに必要な過去のバー数 (ウォームアップ) を持ち、
+チャートの取得開始日は営業日カレンダーからその本数だけ遡って決める
+Streamlit に依存しないため、ベンチマーク (bench/) からも使う
+"""
+import math
+import re
+from dataclasses import dataclass
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_INDICATORS = ["SMA(5)", "SMA(25)"]
+INDICATOR_PRESETS = ["SMA(5)", "SMA(25)", "SMA(75)", "EMA(20)", "BB(20,2)", "VWAP(20)", "RSI(14)", "MACD(12,26,9)"]
+# 指数平滑は過去の値の影響が残り続けるため、初期値の重みがこの値を下回るまでをウォームアップとみなす
+EMA_TOLERANCE = 1e-3
+
+@dataclass(frozen=True)
+class IndicatorDef:
+    defaults: tuple    # 既定のパラメータ
+    warmup: Callable   # (*params) -> 必要な過去のバー数
+    compute: Callable  # (stock_data, *params) -> outputs と同じ順の Series のタプル
+    outputs: tuple     # 作る列の接尾辞 ("" は指標名そのものの列)
+    panel: bool        # True: ローソク足とは別の段に描く (オシレーター)
+    windows: tuple     # パラメータごとに、バー数なら許す最小の本数 (整数のみ)、バー数でなければ None
+
+INDICATORS = {}
+
+def register_indicator(name, defaults, warmup, outputs=("",), panel=False, windows=None):
+    """
+    指標の計算関数を登録するデコレーター
+    windows を省くと全てのパラメータを1本以上のバー数として扱う
+    """
+    def decorator(compute):
+        INDICATORS[name] = IndicatorDef(defaults, warmup, compute, outputs, panel, windows or (1,) * len(defaults))
+        return compute
+    return decorator
+
+SPEC_PATTERN = re.compile(r"^\s*([A-Za-z]+)\s*(?:\(([^()]*)\))?\s*$")
+
+def parse_indicator(spec):
+    """
+    "MACD(12,26,9)" → ("MACD", (12, 26, 9))。括弧を省略すると既定のパラメータを使う
+    """
+    match = SPEC_PATTERN.match(spec)
+    name = match.group(1).upper() if match else None
+    if name not in INDICATORS:
+        raise ValueError(f"不明な指標です: {spec} (対応: {', '.join(INDICATORS)})")
+
+    definition = INDICATORS[name]
+    if not match.group(2):
+        return name, definition.defaults
+    try:
+        params = tuple(float(p) for p in match.group(2).split(","))
+    except ValueError:
+        raise ValueError(f"指標のパラメータは数値で指定してください: {spec}") from None
+    if len(params) != len(definition.defaults) or min(params) <= 0:
+        raise ValueError(f"{name} には {len(definition.defaults)} 個の正の数を指定してください: {spec}")
+    for value, minimum in zip(params, definition.windows):
+        if minimum is not None and (not value.is_integer() or value < minimum):
+            raise ValueError(f"{name} の期間 (バー数) は {minimum} 以上の整数で指定してください: {spec}")
+    return name, tuple(int(p) if p.is_integer() else p for p in params)
+
+def indicator_label(name, params):
+    return f"{name}({','.join(str(p) for p in params)})"
+
+def indicator_warmup(specs):
+    """
+    指定した全ての指標の値が表示開始日に確定しているために必要な過去のバー数
+    """
+    return max((INDICATORS[name].warmup(*params) for name, params in map(parse_indicator, specs)), default=0)
+
+def ema_convergence(alpha):
+    # 初期値の重み (1 - alpha)^k が EMA_TOLERANCE を下回るバー数 k
+    return math.ceil(math.log(EMA_TOLERANCE) / math.log(1 - alpha))
+
+def ema_warmup(window):
+    # 最初の window 本の単純平均を初期値にし、その影響が薄れるまで
+    return window - 1 + ema_convergence(2 / (window + 1))
+
+def seeded_ema(values, window, alpha=None):
+    """
+    指数平滑移動平均。最初の有効な window 本の単純平均を初期値とする (TA-Lib と同じ定義)
+    """
+    alpha = alpha or 2 / (window + 1)
+    first = values.first_valid_index()
+    start = values.index.get_loc(first) if first is not None else len(values)
+    if len(values) - start < window:
+        return pd.Series(np.nan, index=values.index)
+    seeded = values.copy()
+    seeded.iloc[:start + window - 1] = np.nan
+    seeded.iloc[start + window - 1] = values.iloc[start:start + window].mean()
+    return seeded.ewm(alpha=alpha, adjust=False).mean()
+
+@register_indicator("SMA", (25,), warmup=lambda n: n - 1)
+def sma(stock_data, n):
+    return (stock_data["Close"].rolling(n).mean(),)
+
+# 指数平滑は alpha = 2/(n+1) (RSI は 1/n) が1未満になる2本以上から
+@register_indicator("EMA", (20,), warmup=ema_warmup, windows=(2,))
+def ema(stock_data, n):
+    return (seeded_ema(stock_data["Close"], n),)
+
+@register_indicator("BB", (20, 2), warmup=lambda n, k: n - 1, outputs=(" upper", "", " lower"), windows=(1, None))
+def bollinger(stock_data, n, k):
+    rolling = stock_data["Close"].rolling(n)
+    middle = rolling.mean()
+    band = k * rolling.std(ddof=0)
+    return middle + band, middle, middle - band
+
+@register_indicator("VWAP", (20,), warmup=lambda n: n - 1)
+def vwap(stock_data, n):
+    # 直近 n 本の出来高加重平均価格 (典型価格 = (高値 + 安値 + 終値) / 3)
+    typical = (stock_data["High"] + stock_data["Low"] + stock_data["Close"]) / 3
+    volume = stock_data["Volume"]
+    return ((typical * volume).rolling(n).sum() / volume.rolling(n).sum().replace(0, np.nan),)
+
+@register_indicator("RSI", (14,), warmup=lambda n: n + ema_convergence(1 / n), panel=True, windows=(2,))
+def rsi(stock_data, n):
+    # Wilder の平滑化 (alpha = 1/n)
+    change = stock_data["Close"].diff()
+    gain = seeded_ema(change.clip(lower=0), n, alpha=1 / n)
+    loss = seeded_ema(-change.clip(upper=0), n, alpha=1 / n)
+    return (100 - 100 / (1 + gain / loss.replace(0, np.nan)),)
+
+@register_indicator(
+    "MACD", (12, 26, 9), warmup=lambda fast, slow, signal: max(ema_warmup(fast), ema_warmup(slow)) + ema_warmup(signal),
+    outputs=("", " signal", " hist"), panel=True, windows=(2, 2, 2),
+)
+def macd(stock_data, fast, slow, signal):
+    line = seeded_ema(stock_data["Close"], fast) - seeded_ema(stock_data["Close"], slow)
+    signal_line = seeded_ema(line, signal)
+    return line, signal_line, line - signal_line
+
+def indicator_columns(specs):
+    """
+    指標が作る列を (列名, 段) のリストで返す。段は別の段に描く指標の名前、ローソク足に重ねる列は None
+    """
+    columns = []
+    for name, params in map(parse_indicator, specs):
+        definition = INDICATORS[name]
+        label = indicator_label(name, params)
+        columns.extend((label + suffix, label if definition.panel else None) for suffix in definition.outputs)
+    return columns
+
+def add_indicators(stock_data, specs=DEFAULT_INDICATORS):
+    """
+    指標の列を追加する (取得した全期間で一括計算し、表示期間への切り出しは呼び出し側で行う)
+    """
+    for name, params in map(parse_indicator, specs):
+        definition = INDICATORS[name]
+        label = indicator_label(name, params)
+        for suffix, values in zip(definition.outputs, definition.compute(stock_data, *params)):
+            stock_data[label + suffix] = values
+    return stock_data
@@ -0,0 +1,117 @@
+"""
+東京証券取引所の営業日カレンダー
+土日・祝日 (振替休日・国民の休日を含む)・年末年始 (12/31〜1/3) を休場日とする
+祝日は2000年以降の祝日法に沿って計算する (それ以前は概算)
+"""
+from datetime import date, timedelta
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+CALENDAR_FIRST_YEAR = 1990
+CALENDAR_YEARS_AHEAD = 2  # 今年から何年先まで休場日を用意するか
+
+# 祝日法の特例や一度限りの休日 (年: [(月, 日), ...])
+SPECIAL_HOLIDAYS = {
+    1990: [(11, 12)],                            # 即位礼正殿の儀
+    1993: [(6, 9)],                              # 皇太子徳仁親王の結婚の儀
+    2019: [(4, 30), (5, 1), (5, 2), (10, 22)],   # 天皇の即位
+}
+# 東京オリンピックに伴い移動した祝日 (年: {祝日名: (月, 日)})
+MOVED_HOLIDAYS = {
+    2020: {"海の日": (7, 23), "スポーツの日": (7, 24), "山の日": (8, 10)},
+    2021: {"海の日": (7, 22), "スポーツの日": (7, 23), "山の日": (8, 8)},
+}
+
+def nth_monday(year, month, n):
+    first = date(year, month, 1)
+    return first + timedelta(days=(7 - first.weekday()) % 7 + 7 * (n - 1))
+
+def equinox_day(year, base):
+    # 春分 (base=20.8431)・秋分 (base=23.2488) の日 (1980〜2099年の近似式)
+    return int(base + 0.242194 * (year - 1980) - (year - 1980) // 4)
+
+def jp_holidays(year):
+    """
+    その年の祝日 (振替休日・国民の休日を含む) の集合を返す
+    """
+    moved = MOVED_HOLIDAYS.get(year, {})
+    days = {
+        date(year, 1, 1),
+        nth_monday(year, 1, 2) if year >= 2000 else date(year, 1, 15),
+        date(year, 2, 11),
+        date(year, 3, equinox_day(year, 20.8431)),
+        date(year, 4, 29),
+        date(year, 5, 3),
+        date(year, 5, 5),
+        date(year, 9, equinox_day(year, 23.2488)),
+        date(year, 11, 3),
+        date(year, 11, 23),
+    }
+    # 天皇誕生日
+    if year <= 2018:
+        days.add(date(year, 12, 23))
+    elif year >= 2020:
+        days.add(date(year, 2, 23))
+    # みどりの日 (2006年以前は国民の休日)
+    if year >= 2007:
+        days.add(date(year, 5, 4))
+    # 海の日
+    if year >= 1996:
+        days.add(date(year, *moved["海の日"]) if "海の日" in moved else
+                 nth_monday(year, 7, 3) if year >= 2003 else date(year, 7, 20))
+    # 山の日
+    if year >= 2016:
+        days.add(date(year, *moved.get("山の日", (8, 11))))
+    # 敬老の日
+    days.add(nth_monday(year, 9, 3) if year >= 2003 else date(year, 9, 15))
+    # スポーツの日 (体育の日)
+    days.add(date(year, *moved["スポーツの日"]) if "スポーツの日" in moved else
+             nth_monday(year, 10, 2) if year >= 2000 else date(year, 10, 10))
+    days.update(date(year, m, d) for m, d in SPECIAL_HOLIDAYS.get(year, []))
+
+    # 国民の休日: 前後を祝日に挟まれた平日
+    for d in sorted(days):
+        between = d + timedelta(days=1)
+        if between + timedelta(days=1) in days and between not in days and between.weekday() != 6:
+            days.add(between)
+
+    # 振替休日: 日曜の祝日の後の最初の祝日でない日 (2006年以前は翌月曜のみ)
+    for d in sorted(days):
+        if d.weekday() == 6:
+            substitute = d + timedelta(days=1)
+            while year >= 2007 and substitute in days:
+                substitute += timedelta(days=1)
+            days.add(substitute)
+    return days
+
+def tse_holidays(first_year, last_year):
+    """
+    [first_year, last_year] の休場日 (祝日と年末年始) を datetime64[D] の配列で返す
+    """
+    days = set()
+    for year in range(first_year, last_year + 1):
+        days.update(jp_holidays(year))
+        days.update([date(year, 1, 2), date(year, 1, 3), date(year, 12, 31)])
+    return np.array(sorted(days), dtype="datetime64[D]")
+
+@lru_cache(maxsize=1)
+def trading_calendar():
+    """
+    営業日カレンダー (numpy.busdaycalendar)。土日と休場日を除く
+    """
+    return np.busdaycalendar(
+        holidays=tse_holidays(CALENDAR_FIRST_YEAR, date.today().year + CALENDAR_YEARS_AHEAD)
+    )
+
+def trading_days_before(days, n):
+    """
+    各日付 (その日が休場日なら次の営業日) から n 営業日前の日付を返す
+    スカラー (Timestamp) でも Series でも計算できる
+    """
+    values = np.asarray(pd.Series(days).to_numpy(dtype="datetime64[D]"))
+    result = np.busday_offset(values, -n, roll="forward", busdaycal=trading_calendar())
+    if isinstance(days, pd.Series):
+        return pd.Series(result.astype("datetime64[ns]"), index=days.index, name=days.name)
+    return pd.Timestamp(result[0])
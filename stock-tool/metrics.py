@@ -0,0 +1,200 @@
+"""
+処理段階ごとの計測 (所要時間・行数・メモリ) とキャッシュのヒット数の記録
+標準ライブラリのみを使うため、app.py / trade_analysis.py / バッチ処理のどこからでも使える
+
+- stage(name): with ブロックの所要時間・行数・メモリを記録し、JSON 1行のログを出す
+- count(name): キャッシュのヒット/ミスなどの回数を数える
+- register_gauge(name, func): 待ち行列の長さなど、その時点の値を公開する
+- render_prometheus(): 累計値を Prometheus のテキスト形式で返す (start_metrics_server で公開)
+"""
+import contextvars
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger("stock_tool.metrics")
+
+RECENT_EVENTS = 500  # 直近の計測結果を保持する件数
+
+_lock = threading.Lock()
+_stages = {}     # 段階名 -> {"calls", "seconds", "rows"}
+_counters = {}   # 名前 -> 回数
+_gauges = {}     # 名前 -> 現在値を返す関数
+_recent = deque(maxlen=RECENT_EVENTS)
+_run_events = contextvars.ContextVar("run_events", default=None)
+
+def rss_bytes():
+    """
+    プロセスの常駐メモリ (概算)。Linux では /proc、それ以外は最大常駐メモリで代用する
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+class StageTimer:
+    """
+    stage() の with ブロック内で処理した行数を rows に設定する
+    """
+
+    def __init__(self, name, rows=None):
+        self.name = name
+        self.rows = rows
+
+@contextmanager
+def stage(name, rows=None):
+    """
+    with ブロックの所要時間・行数・メモリ増減を記録する
+    """
+    timer = StageTimer(name, rows)
+    rss_before = rss_bytes()
+    start = time.perf_counter()
+    try:
+        yield timer
+    finally:
+        seconds = time.perf_counter() - start
+        rss = rss_bytes()
+        event = {
+            "stage": name,
+            "seconds": round(seconds, 6),
+            "rows": timer.rows,
+            "rss_mb": round(rss / 2**20, 1),
+            "rss_delta_mb": round((rss - rss_before) / 2**20, 1),
+            "thread": threading.current_thread().name,
+        }
+        with _lock:
+            totals = _stages.setdefault(name, {"calls": 0, "seconds": 0.0, "rows": 0})
+            totals["calls"] += 1
+            totals["seconds"] += seconds
+            totals["rows"] += timer.rows or 0
+            _recent.append(event)
+        events = _run_events.get()
+        if events is not None:
+            events.append(event)
+        logger.info(json.dumps(event, ensure_ascii=False))
+
+def count(name, n=1):
+    """
+    キャッシュのヒット/ミスなどの回数を加算する
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+def register_gauge(name, func):
+    """
+    待ち行列の長さなど、その時点の値を返す関数を登録する (render_prometheus のたびに評価する)
+    """
+    with _lock:
+        _gauges[name] = func
+
+def gauges():
+    """
+    登録した関数を評価した現在値
+    """
+    with _lock:
+        funcs = list(_gauges.items())
+    return {name: func() for name, func in funcs}
+
+def start_run():
+    """
+    これ以降に同じコンテキスト (Streamlit のスクリプト実行1回分) で記録した計測を集める
+    """
+    events = []
+    _run_events.set(events)
+    return events
+
+def run_events():
+    """
+    start_run() 以降に記録した計測結果
+    """
+    return list(_run_events.get() or [])
+
+def snapshot():
+    """
+    段階ごとの累計と回数の写しを返す
+    """
+    with _lock:
+        return {name: dict(v) for name, v in _stages.items()}, dict(_counters), list(_recent)
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+def render_prometheus():
+    """
+    累計値を Prometheus のテキスト形式で返す
+    """
+    stages, counters, _ = snapshot()
+    lines = [
+        "# HELP stock_tool_stage_seconds_total Wall time spent in each stage.",
+        "# TYPE stock_tool_stage_seconds_total counter",
+    ]
+    lines += [f'stock_tool_stage_seconds_total{{stage="{_label(k)}"}} {v["seconds"]:.6f}' for k, v in stages.items()]
+    lines += [
+        "# HELP stock_tool_stage_calls_total Number of times each stage ran.",
+        "# TYPE stock_tool_stage_calls_total counter",
+    ]
+    lines += [f'stock_tool_stage_calls_total{{stage="{_label(k)}"}} {v["calls"]}' for k, v in stages.items()]
+    lines += [
+        "# HELP stock_tool_stage_rows_total Rows processed by each stage.",
+        "# TYPE stock_tool_stage_rows_total counter",
+    ]
+    lines += [f'stock_tool_stage_rows_total{{stage="{_label(k)}"}} {v["rows"]}' for k, v in stages.items()]
+    lines += [
+        "# HELP stock_tool_events_total Cache hits, misses and other counted events.",
+        "# TYPE stock_tool_events_total counter",
+    ]
+    lines += [f'stock_tool_events_total{{name="{_label(k)}"}} {v}' for k, v in counters.items()]
+    lines += [
+        "# HELP stock_tool_gauge Current value of registered gauges (queue depth and so on).",
+        "# TYPE stock_tool_gauge gauge",
+    ]
+    lines += [f'stock_tool_gauge{{name="{_label(k)}"}} {v}' for k, v in gauges().items()]
+    lines += [
+        "# HELP stock_tool_resident_memory_bytes Approximate resident memory of the process.",
+        "# TYPE stock_tool_resident_memory_bytes gauge",
+        f"stock_tool_resident_memory_bytes {rss_bytes()}",
+    ]
+    return "\n".join(lines) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # アクセスログは出さない
+
+def start_metrics_server(port, host="0.0.0.0"):
+    """
+    /metrics を返すHTTPサーバーをデーモンスレッドで起動する
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+def configure_logging(level=logging.INFO):
+    """
+    計測ログ (JSON 1行) を標準エラー出力に出す (複数回呼んでもハンドラは1つ)
+    """
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(level)
+        logger.propagate = False
@@ -0,0 +1,203 @@
+"""
+CPU を長く使う処理 (CSVの解析・FIFO突合・銘柄ごとの集計) をワーカープロセスで実行するプール
+Streamlit は全セッションのスクリプトを1つのプロセスのスレッドで実行するため、
+大きなファイルの解析が GIL を握り続けると他のセッションの画面まで止まる。ここでは計算だけを別プロセスに渡す
+
+- 同時に実行するのは max_workers 件まで。残りは到着順の待ち行列に並び、呼び出し側は順番 (position) を表示できる
+- 待ち行列のジョブは cancel で取り消せる。実行中のジョブはプロセスを止めずに結果を捨てる
+- 呼び出したセッションが閉じられたジョブ (is_active が False) は、実行前に取り除き、実行中なら結果を捨てる
+Streamlit に依存しない (セッションの生死は is_active で受け取る)
+"""
+import multiprocessing
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+import metrics
+
+# ワーカーは1つごとに numpy・pandas を読み込んだ別プロセスになり、MemoryBudget の外でメモリを使う
+# 512MB のインスタンスでは1つまでにする
+OFFLOAD_WORKERS = 1
+# Streamlit のスレッドを抱えたプロセスを fork しないよう、forkserver から起動する (使えない環境では spawn)
+OFFLOAD_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+# ワーカーで使うモジュールを forkserver に読み込んでおき、ジョブごとの import を省く
+OFFLOAD_PRELOAD = ["numpy", "pandas", "trade_analysis", "excursions", "portfolio"]
+
+def _run_task(func, args):
+    # ワーカープロセスで実行する (結果と実行にかかった秒数を返す)
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+class OffloadJob:
+    """
+    プールに投入した1件の計算。result() で結果を待ち、position() で待ち行列の順番を返す
+    """
+
+    def __init__(self, pool, session_id, name, func, args):
+        self.pool = pool
+        self.session_id = session_id
+        self.name = name
+        self.func = func
+        self.args = args
+        self.future = Future()
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.run_seconds = None
+
+    def position(self):
+        """
+        0: 実行中、1以上: 待ち行列の順番、None: 終了 (完了・失敗・取り消し)
+        """
+        return self.pool.position(self)
+
+    def done(self):
+        return self.future.done()
+
+    def cancelled(self):
+        return self.future.cancelled()
+
+    def cancel(self):
+        return self.pool.cancel(self)
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+class OffloadPool:
+    """
+    ワーカープロセスのプールと、その前に置く到着順の待ち行列
+    プロセス内の全セッションで1つを共有する
+    """
+
+    def __init__(self, max_workers=OFFLOAD_WORKERS, is_active=None, start_method=OFFLOAD_START_METHOD,
+                 preload=OFFLOAD_PRELOAD):
+        self.max_workers = max_workers
+        self.is_active = is_active or (lambda session_id: True)
+        self.start_method = start_method
+        self.preload = preload
+        self.lock = threading.Lock()
+        self.executor = None
+        self.queue = deque()
+        self.running = set()
+        self.counts = {"submitted": 0, "completed": 0, "failed": 0, "cancelled": 0, "dropped": 0}
+
+    def _executor(self):
+        # 最初のジョブで起動する (起動時間を使わないセッションに払わせない)
+        if self.executor is None:
+            context = multiprocessing.get_context(self.start_method)
+            if self.start_method == "forkserver":
+                context.set_forkserver_preload(self.preload)
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+        return self.executor
+
+    def submit(self, session_id, name, func, *args):
+        """
+        func(*args) をワーカーで実行するジョブを待ち行列に加える (func はモジュールの関数であること)
+        """
+        job = OffloadJob(self, session_id, name, func, args)
+        with self.lock:
+            self.queue.append(job)
+            self.counts["submitted"] += 1
+        metrics.count(f"offload.{name}.submitted")
+        self._dispatch()
+        return job
+
+    def position(self, job):
+        with self.lock:
+            if job in self.running:
+                return 0
+            try:
+                return self.queue.index(job) + 1
+            except ValueError:
+                return None
+
+    def cancel(self, job):
+        """
+        ジョブを取り消す。待ち行列にあれば取り除き、実行中なら終わったときに結果を捨てる
+        """
+        with self.lock:
+            if job in self.queue:
+                self.queue.remove(job)
+            cancelled = job.future.cancel()
+            if cancelled:
+                self.counts["cancelled"] += 1
+        if cancelled:
+            metrics.count(f"offload.{job.name}.cancelled")
+        return cancelled
+
+    def cancel_session(self, session_id):
+        """
+        セッションの全てのジョブを取り消す
+        """
+        with self.lock:
+            jobs = [job for job in (*self.queue, *self.running) if job.session_id == session_id]
+        for job in jobs:
+            self.cancel(job)
+
+    def _dispatch(self):
+        # 空いているワーカーの数だけ待ち行列の先頭から実行する (閉じたセッションのジョブは取り除く)
+        with self.lock:
+            sessions = {job.session_id for job in (*self.running, *self.queue)}
+        # is_active は Streamlit のロックを取り得るため、こちらのロックの外で呼ぶ
+        closed = {session_id for session_id in sessions if not self.is_active(session_id)}
+
+        with self.lock:
+            for job in [job for job in self.running if not job.future.cancelled()]:
+                if job.session_id in closed:
+                    job.future.cancel()
+                    self.counts["dropped"] += 1
+            starting = []
+            while self.queue and len(self.running) < self.max_workers:
+                job = self.queue.popleft()
+                if job.future.cancelled():
+                    continue
+                if job.session_id in closed:
+                    job.future.cancel()
+                    self.counts["dropped"] += 1
+                    continue
+                job.started_at = time.monotonic()
+                self.running.add(job)
+                starting.append(job)
+
+        for job in starting:
+            try:
+                future = self._executor().submit(_run_task, job.func, job.args)
+            except Exception as e:
+                self._finish(job, error=e)
+                continue
+            job.args = None  # 送った引数は保持しない
+            future.add_done_callback(partial(self._finished, job))
+
+    def _finished(self, job, future):
+        try:
+            value, job.run_seconds = future.result()
+        except BaseException as e:
+            self._finish(job, error=e)
+        else:
+            self._finish(job, value=value)
+
+    def _finish(self, job, value=None, error=None):
+        # 取り消し (cancel) と同じロックの中で結果を渡す
+        with self.lock:
+            self.running.discard(job)
+            if isinstance(error, BrokenProcessPool):
+                # ワーカーが異常終了した (メモリ不足など)。次のジョブのためにプールを作り直す
+                self.executor = None
+            if not job.future.cancelled():
+                self.counts["failed" if error is not None else "completed"] += 1
+                if error is not None:
+                    job.future.set_exception(error)
+                else:
+                    job.future.set_result(value)
+        self._dispatch()
+
+    def stats(self):
+        """
+        累計のジョブ数と現在の実行中・待ち行列の件数
+        """
+        with self.lock:
+            return {**self.counts, "running": len(self.running), "queued": len(self.queue),
+                    "max_workers": self.max_workers}
@@ -0,0 +1,92 @@
+"""
+ポートフォリオ全体の損益推移 (実現損益 + 評価損益)
+FIFO突合の結果 (約定ペアと売れ残りロット) から日付×銘柄の保有数量の行列を作り、
+同じ形の終値の行列と掛け合わせて評価額を求める (銘柄ごとのループは行わない)
+Streamlit に依存しない
+"""
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+def position_events(history, open_lots):
+    """
+    約定ペアと売れ残りロットを、保有数量と現金の増減のイベントに展開する
+    - 約定ペア: 買い日に +qty (現金 -買値×qty)、売り日に -qty (現金 +売値×qty)
+    - 売れ残りロット: 買い日に +qty (現金 -買値×qty)
+    保有数量を超える売りは FIFO 突合と同じく無視される
+    """
+    events = pd.DataFrame({
+        "date": np.concatenate([history["buy_date"], history["sell_date"], open_lots["date"]]),
+        "ticker": np.concatenate([history["ticker"], history["ticker"], open_lots["ticker"]]).astype(object),
+        "qty": np.concatenate([history["qty"], -history["qty"], open_lots["qty"]]),
+        "price": np.concatenate([history["buy_price"], history["sell_price"], open_lots["price"]]),
+        "realized": np.concatenate([np.zeros(len(history)), history["pnl"], np.zeros(len(open_lots))]),
+    })
+    events["cash"] = -events["qty"] * events["price"]
+    return events.sort_values("date", kind="stable", ignore_index=True)
+
+def portfolio_price_ranges(events, today=None):
+    """
+    銘柄ごとに評価に必要な株価の期間 (最初の約定日, 最後の約定日 または 保有が残っていれば今日) を返す
+    """
+    today = pd.Timestamp(today or date.today())
+    ranges = events.groupby("ticker").agg(start=("date", "min"), end=("date", "max"), held=("qty", "sum"))
+    ranges.loc[ranges["held"] > 1e-9, "end"] = today
+    return ranges[["start", "end"]]
+
+def equity_curve(events, closes):
+    """
+    日付×銘柄の終値 (closes) で毎日の保有を評価し、損益の推移を返す
+    終値が無い日・銘柄は直前の終値、それも無ければ直前の約定単価で評価する
+    戻り値: (日付ごとの DataFrame, 最大ドローダウンなどの集計)
+    """
+    # 1. 日付軸 (終値のある日 + 約定日) と銘柄軸
+    dates = closes.index.union(pd.DatetimeIndex(events["date"].unique())).sort_values()
+    dates = dates[dates >= events["date"].min()]
+    tickers = closes.columns.union(pd.Index(events["ticker"].unique()))
+    closes = closes.reindex(index=dates, columns=tickers)
+
+    # 2. 約定を (日付, 銘柄) のマスに積み上げ、日付方向の累積和で保有数量にする
+    row = dates.searchsorted(events["date"].to_numpy())
+    col = tickers.get_indexer(events["ticker"])
+    cell = row * len(tickers) + col
+    delta = np.bincount(cell, weights=events["qty"].to_numpy(), minlength=len(dates) * len(tickers))
+    positions = np.cumsum(delta.reshape(len(dates), len(tickers)), axis=0)
+    positions[np.abs(positions) < 1e-9] = 0.0
+
+    # 3. 評価単価: 終値 → 直前の終値 → 直前の約定単価 (イベントは日付順なので同じマスは最後の約定が残る)
+    trade_price = np.full((len(dates), len(tickers)), np.nan)
+    trade_price[row, col] = events["price"].to_numpy()
+    price = closes.ffill().fillna(pd.DataFrame(trade_price, index=dates, columns=tickers).ffill()).to_numpy()
+
+    # 4. 評価額・現金収支・実現損益を日付ごとに集計
+    market_value = np.where(positions != 0, positions * price, 0.0).sum(axis=1)
+    cash = np.cumsum(np.bincount(row, weights=events["cash"].to_numpy(), minlength=len(dates)))
+    realized = np.cumsum(np.bincount(row, weights=events["realized"].to_numpy(), minlength=len(dates)))
+    equity = cash + market_value
+    peak = np.maximum.accumulate(equity)
+    drawdown = equity - peak
+
+    curve = pd.DataFrame({
+        "market_value": market_value,
+        "realized": realized,
+        "unrealized": equity - realized,
+        "equity": equity,
+        "drawdown": drawdown,
+        "holdings": (positions != 0).sum(axis=1),
+    }, index=dates)
+
+    trough = int(np.argmin(drawdown))
+    peak_pos = int(np.argmax(equity[:trough + 1]))
+    summary = {
+        "final_equity": float(equity[-1]),
+        "final_realized": float(realized[-1]),
+        "final_unrealized": float(equity[-1] - realized[-1]),
+        "max_drawdown": float(drawdown[trough]),
+        "max_drawdown_peak": dates[peak_pos],
+        "max_drawdown_trough": dates[trough],
+        "days": len(dates),
+        "tickers": len(tickers),
+    }
+    return curve, summary
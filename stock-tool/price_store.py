@@ -0,0 +1,279 @@
+"""
+株価 (日足) の永続キャッシュ
+銘柄×日付の日足を SQLite に保存し、要求された期間のうち未取得の日だけを取得元 (Yahoo Finance) から取り寄せる
+取得元への問い合わせは FetchScheduler を通す
+Streamlit に依存しない (ベンチマークからもアプリを読み込まずに使える)
+"""
+import sqlite3
+from contextlib import closing
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+import metrics
+from fetch_scheduler import FetchScheduler
+
+PRICE_CACHE_MAX_AGE_DAYS = 7  # 分割・配当による調整後株価の変化を取り込むため、古い取得範囲は取り直す
+# 当日分 (まだ確定していない日足) と、日足が1本も返らなかった期間 (上場前・休場日・一時的な不具合など) を
+# 再び問い合わせるまでの時間
+PRICE_CACHE_PROVISIONAL_TTL_MINUTES = 60
+OHLCV_COLUMNS = ["Open", "High", "Low", "Close", "Volume"]
+
+def download_history(ticker, start, end):
+    """
+    yfinanceから日足を取得する (endは含まない)
+    """
+    import yfinance as yf  # 起動を速くするため、最初の取得時に読み込む
+
+    return yf.Ticker(ticker).history(start=start, end=end)
+
+class PriceStore:
+    """
+    銘柄×日付の日足をSQLiteに保存し、取得済みの期間を記録する永続キャッシュ
+    要求された期間のうち未取得の日だけを取得元から取り寄せる
+    ファイルはプロセス・セッション間で共有され、接続は呼び出しごとに開く (スレッド間で共有しない)
+    """
+
+    def __init__(self, path, fetch_history=download_history, max_age_days=PRICE_CACHE_MAX_AGE_DAYS, scheduler=None,
+                 provisional_ttl_minutes=PRICE_CACHE_PROVISIONAL_TTL_MINUTES):
+        self.path = path
+        self.fetch_history = fetch_history
+        self.max_age_days = max_age_days
+        self.provisional_ttl_minutes = provisional_ttl_minutes
+        self.scheduler = scheduler or FetchScheduler()
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS prices (
+                    ticker TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    open REAL, high REAL, low REAL, close REAL, volume REAL,
+                    PRIMARY KEY (ticker, date)
+                )
+            """)
+            # 取得済み期間 [start, end) と取得時刻
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS coverage (
+                    ticker TEXT NOT NULL,
+                    start TEXT NOT NULL,
+                    end TEXT NOT NULL,
+                    fetched_at TEXT NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS coverage_ticker ON coverage (ticker)")
+            # 当日分と日足が1本も返らなかった期間 [start, end)。coverage とは別に短い期限で覚え、取得済み期間とはまとめない
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS provisional_ranges (
+                    ticker TEXT NOT NULL,
+                    start TEXT NOT NULL,
+                    end TEXT NOT NULL,
+                    fetched_at TEXT NOT NULL
+                )
+            """)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def covered_ranges(self, conn, ticker):
+        """
+        有効期限内の取得済み期間 (start, end, fetched_at) を開始日順に返す
+        """
+        min_fetched = (datetime.now() - timedelta(days=self.max_age_days)).isoformat()
+        rows = conn.execute(
+            "SELECT start, end, fetched_at FROM coverage WHERE ticker = ? AND fetched_at >= ? ORDER BY start",
+            (ticker, min_fetched),
+        ).fetchall()
+        return [(date.fromisoformat(s), date.fromisoformat(e), f) for s, e, f in rows]
+
+    def provisional_ranges(self, conn, ticker):
+        """
+        provisional_ttl_minutes 以内に問い合わせた当日分・日足が返らなかった期間 (start, end, fetched_at) を返す
+        """
+        min_fetched = (datetime.now() - timedelta(minutes=self.provisional_ttl_minutes)).isoformat()
+        rows = conn.execute(
+            "SELECT start, end, fetched_at FROM provisional_ranges WHERE ticker = ? AND fetched_at >= ?",
+            (ticker, min_fetched),
+        ).fetchall()
+        return [(date.fromisoformat(s), date.fromisoformat(e), f) for s, e, f in rows]
+
+    def missing_ranges(self, ticker, start, end):
+        """
+        [start, end) のうちキャッシュに無い期間のリストを返す
+        """
+        with closing(self._connect()) as conn:
+            covered = sorted(self.covered_ranges(conn, ticker) + self.provisional_ranges(conn, ticker))
+
+        missing = []
+        cursor = start
+        for s, e, _ in covered:
+            if e <= cursor:
+                continue
+            if s >= end:
+                break
+            if s > cursor:
+                missing.append((cursor, s))
+            cursor = max(cursor, e)
+        if cursor < end:
+            missing.append((cursor, end))
+
+        # 土日だけの期間は取得しても空なので問い合わせない
+        return [(s, e) for s, e in missing if np.busday_count(s, e) > 0]
+
+    def store(self, ticker, start, end, history):
+        """
+        取得した日足を保存し、取得済み期間を記録する
+        当日分 (まだ確定していない) と日足が1本も返らなかった期間 (上場前か一時的な不具合か区別できない) は
+        取得済みとはせず、provisional_ttl_minutes の間だけ問い合わせを控える
+        """
+        rows = []
+        if not history.empty:
+            dates = history.index.strftime("%Y-%m-%d")
+            values = history.reindex(columns=OHLCV_COLUMNS).to_numpy(dtype="float64")
+            rows = [(ticker, d, *v) for d, v in zip(dates, values.tolist())]
+
+        today = date.today()
+        covered_end = min(end, today)
+        provisional = []
+        if start < covered_end and not rows:
+            provisional.append((start, covered_end))
+        if end > today:
+            provisional.append((max(start, today), end))
+
+        now = datetime.now()
+        with closing(self._connect()) as conn, conn:
+            conn.executemany("INSERT OR REPLACE INTO prices VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            if start < covered_end and rows:
+                conn.execute(
+                    "INSERT INTO coverage VALUES (?, ?, ?, ?)",
+                    (ticker, start.isoformat(), covered_end.isoformat(), now.isoformat()),
+                )
+                self._merge_coverage(conn, ticker)
+            if provisional:
+                min_fetched = (now - timedelta(minutes=self.provisional_ttl_minutes)).isoformat()
+                conn.execute("DELETE FROM provisional_ranges WHERE ticker = ? AND fetched_at < ?", (ticker, min_fetched))
+                conn.executemany(
+                    "INSERT INTO provisional_ranges VALUES (?, ?, ?, ?)",
+                    [(ticker, s.isoformat(), e.isoformat(), now.isoformat()) for s, e in provisional],
+                )
+
+    def _merge_coverage(self, conn, ticker):
+        # 重なり・隣接する取得済み期間を1つにまとめる (期限切れの範囲は捨てる)
+        # まとめた期間の取得時刻は最も古いものに合わせ、有効期限を延ばさない
+        merged = []
+        for s, e, fetched_at in self.covered_ranges(conn, ticker):
+            if merged and s <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], e)
+                merged[-1][2] = min(merged[-1][2], fetched_at)
+            else:
+                merged.append([s, e, fetched_at])
+
+        conn.execute("DELETE FROM coverage WHERE ticker = ?", (ticker,))
+        conn.executemany(
+            "INSERT INTO coverage VALUES (?, ?, ?, ?)",
+            [(ticker, s.isoformat(), e.isoformat(), f) for s, e, f in merged],
+        )
+
+    def load(self, ticker, start, end):
+        """
+        キャッシュから [start, end) の日足を読み出す
+        """
+        with closing(self._connect()) as conn:
+            df = pd.read_sql_query(
+                "SELECT date, open, high, low, close, volume FROM prices "
+                "WHERE ticker = ? AND date >= ? AND date < ? ORDER BY date",
+                conn,
+                params=(ticker, start.isoformat(), end.isoformat()),
+            )
+        df.columns = ["Date"] + OHLCV_COLUMNS
+        df.index = pd.DatetimeIndex(pd.to_datetime(df.pop("Date"), format="%Y-%m-%d"), name="Date")
+        return df
+
+    def recent_tickers(self, limit):
+        """
+        最近取得した銘柄を新しい順に最大 limit 件返す
+        """
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT ticker FROM coverage GROUP BY ticker ORDER BY MAX(fetched_at) DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [t for (t,) in rows]
+
+    def ensure(self, ticker, start, end):
+        """
+        [start, end) のうち未取得の期間だけを取得元から取り寄せて保存する
+        同じ銘柄・期間の取得はセッション間で1回にまとめ (FetchScheduler)、
+        再試行しても取得できない場合は、期限切れでもキャッシュに日足があればそれを使う
+        """
+        missing = self.missing_ranges(ticker, start, end)
+        metrics.count("price_cache.miss" if missing else "price_cache.hit")
+        for s, e in missing:
+            try:
+                self.scheduler.call(("prices", ticker, s, e), self._fetch_range, ticker, s, e)
+            except Exception:
+                if not self.has_rows(ticker, start, end):
+                    raise
+                metrics.count("price_cache.stale_served")
+
+    def _fetch_range(self, ticker, start, end):
+        with metrics.stage("price_fetch.upstream") as timer:
+            history = self.fetch_history(ticker, start, end)
+            timer.rows = len(history)
+        self.store(ticker, start, end, history)
+
+    def has_rows(self, ticker, start, end):
+        """
+        [start, end) の日足がキャッシュに1日でもあるか (取得範囲の期限は問わない)
+        """
+        with closing(self._connect()) as conn:
+            return conn.execute(
+                "SELECT 1 FROM prices WHERE ticker = ? AND date >= ? AND date < ? LIMIT 1",
+                (ticker, start.isoformat(), end.isoformat()),
+            ).fetchone() is not None
+
+    def load_close_panel(self, tickers, start, end, chunk=500):
+        """
+        複数銘柄の [start, end) の終値を 日付×銘柄 の行列 (DataFrame) で読み出す
+        """
+        parts = []
+        with closing(self._connect()) as conn:
+            for i in range(0, len(tickers), chunk):
+                batch = list(tickers[i:i + chunk])
+                parts.append(pd.read_sql_query(
+                    f"SELECT date, ticker, close FROM prices WHERE ticker IN ({','.join('?' * len(batch))}) "
+                    "AND date >= ? AND date < ?",
+                    conn,
+                    params=(*batch, start.isoformat(), end.isoformat()),
+                ))
+        closes = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=["date", "ticker", "close"])
+        panel = closes.pivot(index="date", columns="ticker", values="close")
+        panel.index = pd.DatetimeIndex(pd.to_datetime(panel.index, format="%Y-%m-%d"), name="Date")
+        return panel.sort_index()
+
+    def load_high_low(self, tickers, start, end, chunk=500):
+        """
+        複数銘柄の [start, end) の高値・安値を、銘柄→日付の順に並んだ縦長の DataFrame (ticker, date, high, low) で読み出す
+        """
+        parts = []
+        with closing(self._connect()) as conn:
+            for i in range(0, len(tickers), chunk):
+                batch = sorted(tickers[i:i + chunk])
+                parts.append(pd.read_sql_query(
+                    f"SELECT ticker, date, high, low FROM prices WHERE ticker IN ({','.join('?' * len(batch))}) "
+                    "AND date >= ? AND date < ? ORDER BY ticker, date",
+                    conn,
+                    params=(*batch, start.isoformat(), end.isoformat()),
+                ))
+        bars = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=["ticker", "date", "high", "low"])
+        bars["date"] = pd.to_datetime(bars["date"], format="%Y-%m-%d")
+        return bars
+
+    def get(self, ticker, start, end):
+        """
+        [start, end) の日足を返す。未取得の期間だけを取得元から取り寄せる
+        """
+        self.ensure(ticker, start, end)
+        with metrics.stage("price_cache.load") as timer:
+            df = self.load(ticker, start, end)
+            timer.rows = len(df)
+        return df
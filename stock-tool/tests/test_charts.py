@@ -0,0 +1,23 @@
+"""
+売買マーカーをチャートのバーに対応付ける (align_trades_to_bars) テスト
+"""
+import pandas as pd
+
+from charts import align_trades_to_bars
+
+# 2月の日足が欠けている (上場廃止前後・取得できなかった期間など)
+DAILY_BARS = pd.DatetimeIndex([*pd.bdate_range("2024-01-01", "2024-01-31"), *pd.bdate_range("2024-03-01", "2024-03-29")])
+
+def test_trades_on_holidays_snap_to_the_nearest_bar():
+    trades = pd.Series(pd.to_datetime(["2024-01-06", "2024-02-02", "2024-03-30"]))
+    positions = align_trades_to_bars(trades, DAILY_BARS)
+    assert list(DAILY_BARS[positions]) == list(pd.to_datetime(["2024-01-05", "2024-01-31", "2024-03-29"]))
+
+def test_trades_far_from_any_bar_are_dropped():
+    trades = pd.Series(pd.to_datetime(["2023-11-01", "2024-02-14", "2024-06-03"]))
+    assert list(align_trades_to_bars(trades, DAILY_BARS)) == [-1, -1, -1]
+
+def test_weekly_bars_only_take_trades_inside_their_week():
+    weekly = pd.DatetimeIndex(["2024-01-01", "2024-01-08", "2024-03-04"])
+    trades = pd.Series(pd.to_datetime(["2024-01-03", "2024-01-14", "2024-01-15", "2024-03-06"]))
+    assert list(align_trades_to_bars(trades, weekly, "W")) == [0, 1, -1, 2]
@@ -0,0 +1,38 @@
+"""
+取得単価の計算 (FIFO・移動平均法・総平均法) の回帰テスト
+"""
+import io
+
+import pandas as pd
+
+from bench.synthetic import write_sbi_csv
+from trade_analysis import analyze_trade_performance, load_and_process_data
+
+def load_synthetic(fills=2_000, tickers=20, seed=0):
+    buffer = io.BytesIO()
+    write_sbi_csv(buffer, fills, tickers, days=300, seed=seed)
+    buffer.seek(0)
+    df, error = load_and_process_data(buffer)
+    assert error is None
+    return df
+
+def test_sells_only_file_reports_no_trades():
+    df = load_synthetic()
+    result, error = analyze_trade_performance(df[df["Side"] == "Sell"].reset_index(drop=True))
+    assert result is None
+    assert "見つかりませんでした" in error
+
+def test_sells_only_incremental_batch_keeps_previous_history():
+    df = load_synthetic()
+    first, error = analyze_trade_performance(df)
+    assert error is None
+
+    # 保有していない銘柄の売りだけを追加する (突合する買いが1件も無い)
+    sells = df[df["Side"] == "Sell"].head(3).copy()
+    sells["約定日"] = first["state"]["last_date"] + pd.Timedelta(days=1)
+    sells["銘柄コード"] = "9999.T"
+    result, error = analyze_trade_performance(pd.concat([df, sells], ignore_index=True), first["state"])
+    assert error is None
+    assert result["new_fills"] == 3
+    for method, summary in result["methods"].items():
+        assert summary["total_trades"] == first["methods"][method]["total_trades"]
@@ -0,0 +1,84 @@
+"""
+FIFO 突合 (match_fifo_lots) を、置き換える前の行ループの実装と比べるテスト
+約定日が重複すると旧実装の並べ替え (安定でない) で同日の順が変わるため、約定日は全て異なるものにする
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from trade_analysis import HISTORY_DTYPES, analyze_trade_performance, match_fifo_lots
+
+def baseline_fifo(df, qty_col, name_col):
+    # 旧 analyze_trade_performance の突合部分 (iterrows と買いキュー)
+    trade_history = []
+    for ticker in df['銘柄コード'].unique():
+        ticker_df = df[df['銘柄コード'] == ticker].sort_values('約定日')
+
+        stock_name = ticker
+        if name_col and not ticker_df.empty:
+            stock_name = ticker_df.iloc[0][name_col]
+
+        buy_queue = []
+        for _, row in ticker_df.iterrows():
+            side = row['Side']
+            price = row['約定単価']
+            qty = row[qty_col]
+            date = row['約定日']
+
+            if side == 'Buy':
+                buy_queue.append({'price': price, 'qty': qty, 'date': date})
+            elif side == 'Sell':
+                while qty > 0 and buy_queue:
+                    buy_pos = buy_queue[0]
+                    match_qty = min(buy_pos['qty'], qty)
+                    pnl = (price - buy_pos['price']) * match_qty
+                    trade_history.append({
+                        'ticker': ticker,
+                        'name': stock_name,
+                        'buy_date': buy_pos['date'],
+                        'buy_price': buy_pos['price'],
+                        'sell_date': date,
+                        'sell_price': price,
+                        'qty': match_qty,
+                        'pnl': pnl
+                    })
+                    buy_pos['qty'] -= match_qty
+                    qty -= match_qty
+                    if buy_pos['qty'] == 0:
+                        buy_queue.pop(0)
+    return pd.DataFrame(trade_history, columns=list(HISTORY_DTYPES)).astype(HISTORY_DTYPES)
+
+def random_portfolio(seed, n_fills=300, n_tickers=8):
+    """
+    約定日が全て異なる約定データ (新しい約定が先頭。売りが保有数量を超えることもある)
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.Timestamp("2020-01-01") + pd.to_timedelta(rng.choice(5000, n_fills, replace=False), unit="D")
+    codes = rng.choice([f"{1300 + i}.T" for i in range(n_tickers)], n_fills)
+    df = pd.DataFrame({
+        '約定日': dates,
+        '銘柄名': pd.Series(codes).str.replace(".T", "", regex=False).radd("銘柄"),
+        '銘柄コード': codes,
+        'Side': np.where(rng.random(n_fills) < 0.55, 'Buy', 'Sell'),
+        '約定単価': rng.integers(100, 5000, n_fills).astype("float64"),
+        '約定数量': rng.choice([100, 200, 300, 500, 1000], n_fills).astype("float64"),
+    })
+    return df.sort_values('約定日', ascending=False, ignore_index=True)
+
+@pytest.mark.parametrize("seed", range(30))
+def test_match_fifo_lots_matches_row_loop(seed):
+    df = random_portfolio(seed)
+    expected = baseline_fifo(df, '約定数量', '銘柄名')
+    history = match_fifo_lots(df, '約定数量', '銘柄名')
+    pd.testing.assert_frame_equal(history.astype(HISTORY_DTYPES), expected)
+
+def test_summary_matches_row_loop():
+    df = random_portfolio(0, n_fills=2_000, n_tickers=30)
+    expected = baseline_fifo(df, '約定数量', '銘柄名')
+    result, error = analyze_trade_performance(df)
+    assert error is None
+    pnl = expected['pnl']
+    assert result["total_trades"] == len(expected)
+    assert result["win_rate"] == pytest.approx((pnl > 0).mean() * 100)
+    assert result["avg_profit"] == pytest.approx(pnl[pnl > 0].mean())
+    assert result["avg_loss"] == pytest.approx(abs(pnl[pnl <= 0].mean()))
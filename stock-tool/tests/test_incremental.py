@@ -0,0 +1,72 @@
+"""
+差分分析 (前回の分析状態から続けて突合する) が、全期間を一度に分析した結果と一致するかのテスト
+総平均法は前回の状態の時点を期の区切りとみなすため、全期間の結果とは一致しない (比べない)
+"""
+import io
+
+import pandas as pd
+import pytest
+
+from bench.synthetic import write_sbi_csv
+from trade_analysis import analyze_trade_performance, dump_analysis_state, load_analysis_state, load_and_process_data
+
+HISTORY_KEYS = ["ticker", "sell_date", "buy_date", "buy_price", "sell_price", "qty"]
+SELL_KEYS = ["ticker", "date", "price", "qty"]
+
+def load_synthetic(seed, fills=3_000, tickers=30):
+    buffer = io.BytesIO()
+    write_sbi_csv(buffer, fills, tickers, days=300, seed=seed)
+    buffer.seek(0)
+    df, error = load_and_process_data(buffer)
+    assert error is None
+    return df
+
+def sorted_frame(frame, columns, keys):
+    # 差分分析では前回までの行の後に新しい行が続くため、並びを揃えてから比べる
+    # (日付の列は状態ファイルを経由すると分解能が変わるため ns に揃える)
+    dtypes = {col: "datetime64[ns]" for col in columns if col.endswith("date")}
+    return frame[columns].astype({"ticker": object, **dtypes}).sort_values(keys, kind="stable", ignore_index=True)
+
+def run_in_two_parts(df, boundary):
+    first, error = analyze_trade_performance(df[df["約定日"] < boundary].reset_index(drop=True))
+    assert error is None
+    state = load_analysis_state(dump_analysis_state(first["state"]))
+    result, error = analyze_trade_performance(df, state)
+    assert error is None
+    return result
+
+@pytest.mark.parametrize("seed", range(5))
+def test_incremental_matches_full_run(seed):
+    df = load_synthetic(seed)
+    dates = df["約定日"]
+    boundary = (dates.min() + (dates.max() - dates.min()) / 2).to_period("M").to_timestamp()
+    full, error = analyze_trade_performance(df)
+    assert error is None
+
+    result = run_in_two_parts(df, boundary)
+    assert result["new_fills"] == (dates >= boundary).sum()
+
+    # FIFO: 約定ペアと集計
+    pd.testing.assert_frame_equal(
+        sorted_frame(result["history"], HISTORY_KEYS + ["pnl"], HISTORY_KEYS),
+        sorted_frame(full["history"], HISTORY_KEYS + ["pnl"], HISTORY_KEYS),
+    )
+    # 移動平均法: 売りごとの取得単価と集計
+    pd.testing.assert_frame_equal(
+        sorted_frame(result["sells"], SELL_KEYS + ["moving_cost"], SELL_KEYS),
+        sorted_frame(full["sells"], SELL_KEYS + ["moving_cost"], SELL_KEYS),
+    )
+    for method in ["fifo", "moving"]:
+        assert result["methods"][method] == pytest.approx(full["methods"][method])
+
+def test_reuploading_the_same_data_adds_no_fills():
+    df = load_synthetic(0)
+    full, error = analyze_trade_performance(df)
+    assert error is None
+
+    state = load_analysis_state(dump_analysis_state(full["state"]))
+    result, error = analyze_trade_performance(df, state)
+    assert error is None
+    assert result["new_fills"] == 0
+    for method in ["fifo", "moving", "total"]:
+        assert result["methods"][method] == pytest.approx(full["methods"][method])
@@ -0,0 +1,60 @@
+"""
+複数のCSV (重なりのある期間ごとのエクスポート) の統合 (merge_trade_frames) のテスト
+"""
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from bench.synthetic import write_sbi_csv
+from trade_analysis import load_and_process_data, load_trade_files, sorted_run_order
+
+def synthetic_csv(seed, fills=3_000, tickers=30):
+    buffer = io.BytesIO()
+    write_sbi_csv(buffer, fills, tickers, days=300, seed=seed)
+    return buffer.getvalue()
+
+def split_csv(data, bounds):
+    """
+    CSVのデータ行を [start, end) ごとのファイルに分ける (説明行とヘッダー行は各ファイルに付ける)
+    """
+    lines = data.split(b"\r\n")
+    header = next(i for i, line in enumerate(lines) if "約定日".encode("shift-jis") in line)
+    rows = [line for line in lines[header + 1:] if line]
+    files = []
+    for i, (start, end) in enumerate(bounds):
+        file = io.BytesIO(b"\r\n".join(lines[:header + 1] + rows[start:end]) + b"\r\n")
+        file.name = f"part{i}.csv"
+        files.append(file)
+    return files
+
+def comparable(df):
+    # ファイルごとにカテゴリの並びが異なるため、値で比べる
+    return df.astype({col: object for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)})
+
+@pytest.mark.parametrize("seed", range(3))
+def test_overlapping_files_merge_to_the_single_file(seed):
+    data = synthetic_csv(seed)
+    single, error = load_and_process_data(io.BytesIO(data))
+    assert error is None
+    # 1つのファイルを約定日の昇順にしたもの (同じ日の行は元の順)
+    expected = single.take(sorted_run_order(single["約定日"])).reset_index(drop=True)
+
+    n = len(single)
+    rng = np.random.default_rng(seed)
+    cuts = np.sort(rng.choice(np.arange(1, n), 4, replace=False))
+    # 隣り合うファイルの期間が重なるように分ける (最後のファイルは最初のファイルとも重ねない)
+    bounds = [(0, cuts[1]), (cuts[0], cuts[3]), (cuts[2], n)]
+    merged, error, duplicates = load_trade_files(split_csv(data, bounds))
+    assert error is None
+    assert duplicates == (cuts[1] - cuts[0]) + (cuts[3] - cuts[2])
+    pd.testing.assert_frame_equal(comparable(merged), comparable(expected))
+
+def test_same_file_twice_is_counted_once():
+    data = synthetic_csv(0)
+    single, _ = load_and_process_data(io.BytesIO(data))
+    merged, error, duplicates = load_trade_files(split_csv(data, [(0, len(single)), (0, len(single))]))
+    assert error is None
+    assert duplicates == len(single)
+    assert len(merged) == len(single)
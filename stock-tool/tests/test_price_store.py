@@ -0,0 +1,69 @@
+"""
+株価キャッシュ (PriceStore) が取得元に問い合わせる回数のテスト
+"""
+from datetime import date, timedelta
+
+import pandas as pd
+import pytest
+
+import price_store
+from fetch_scheduler import FetchScheduler
+from price_store import PriceStore
+
+TODAY = date(2026, 10, 15)  # 木曜日
+
+class FixedDate(date):
+    @classmethod
+    def today(cls):
+        return TODAY
+
+class CountingSource:
+    """
+    平日の日足を返す偽の取得元 (empty=True の銘柄は常に空を返す)。問い合わせを calls に記録する
+    """
+
+    def __init__(self, empty=()):
+        self.empty = set(empty)
+        self.calls = []
+
+    def __call__(self, ticker, start, end):
+        self.calls.append((ticker, start, end))
+        if ticker in self.empty:
+            return pd.DataFrame()
+        index = pd.bdate_range(start, end - timedelta(days=1), name="Date")
+        return pd.DataFrame({"Open": 1.0, "High": 2.0, "Low": 0.5, "Close": 1.5, "Volume": 100.0}, index=index)
+
+@pytest.fixture
+def make_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(price_store, "date", FixedDate)
+
+    def make(**kwargs):
+        source = CountingSource(**kwargs)
+        return PriceStore(str(tmp_path / "prices.sqlite3"), fetch_history=source, scheduler=FetchScheduler()), source
+    return make
+
+def test_repeated_get_including_today_fetches_once(make_store):
+    store, source = make_store()
+    for _ in range(3):
+        bars = store.get("7203.T", TODAY - timedelta(days=60), TODAY + timedelta(days=1))
+    assert len(source.calls) == 1
+    assert bars.index[-1] == pd.Timestamp(TODAY)
+
+def test_today_is_fetched_again_after_the_provisional_ttl(make_store):
+    store, source = make_store()
+    store.get("7203.T", TODAY - timedelta(days=60), TODAY + timedelta(days=1))
+    store.provisional_ttl_minutes = 0
+    store.get("7203.T", TODAY - timedelta(days=60), TODAY + timedelta(days=1))
+    # 確定済みの期間は取り直さず、当日分だけを問い合わせる
+    assert source.calls[1] == ("7203.T", TODAY, TODAY + timedelta(days=1))
+
+def test_empty_response_is_not_recorded_as_covered(make_store):
+    store, source = make_store(empty={"1234.T"})
+    for _ in range(3):
+        assert store.get("1234.T", TODAY - timedelta(days=60), TODAY + timedelta(days=1)).empty
+    assert len(source.calls) == 1
+
+    store.provisional_ttl_minutes = 0
+    assert store.missing_ranges("1234.T", TODAY - timedelta(days=60), TODAY + timedelta(days=1)) == [
+        (TODAY - timedelta(days=60), TODAY + timedelta(days=1)),
+    ]
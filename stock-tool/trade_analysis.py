@@ -0,0 +1,714 @@
+"""
+取引履歴CSVの読み込みとトレード分析 (FIFO突合・移動平均法・総平均法・勝率・損益レシオ)
+Streamlit / Plotly / yfinance に依存しないため、app.py とバッチ処理 (batch_report.py) の両方から使う
+"""
+import gzip
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from metrics import stage
+
+# CSV読み込みの設定
+HEADER_SCAN_BYTES = 64 * 1024  # ヘッダー行を探す先頭部分のサイズ
+CSV_CHUNK_ROWS = 100_000       # 一度にパースする行数
+CSV_ENCODING = "shift-jis"     # 日本語CSVを想定
+
+TRADE_DATE_FORMATS = ["%Y/%m/%d", "%Y-%m-%d"]
+TRADE_SIDES = ["Buy", "Sell"]
+
+# 分析で使用する列とその型 (それ以外の列は読み込まない)
+CSV_COLUMN_DTYPES = {
+    "約定日": "str",
+    "銘柄コード": "str",
+    "銘柄名": "str",
+    "銘柄": "str",
+    "取引": "str",
+    "約定単価": "float64",
+    "約定数量": "float64",
+    "数量": "float64",
+    "株数": "float64",
+}
+
+def find_header_offset(file):
+    """
+    ファイル先頭の一定範囲だけを読み、ヘッダー行の開始バイト位置を返す
+    Shift-JISの2バイト目に改行コードは現れないため、バイト列のまま行分割できる
+    """
+    file.seek(0)
+    prefix = file.read(HEADER_SCAN_BYTES)
+
+    offset = 0
+    for raw_line in prefix.split(b"\n"):
+        line = raw_line.decode(CSV_ENCODING, errors="ignore")
+        if "約定日" in line and "銘柄コード" in line:
+            return offset
+        offset += len(raw_line) + 1
+    return None
+
+def parse_trade_dates(values):
+    """
+    約定日を明示した書式で日付に変換する (SBI証券は "2024/01/05")
+    書式を指定すると pandas が書式の推定を省けるため、100万行でも一括で変換できる
+    """
+    for fmt in TRADE_DATE_FORMATS:
+        try:
+            return pd.to_datetime(values, format=fmt)
+        except ValueError:
+            continue
+    # どの書式にも一致しない場合は従来どおり推定に任せる (行ごとの解析になるため遅い)
+    return pd.to_datetime(values)
+
+def normalize_trade_frame(df):
+    """
+    読み込んだ約定データを列単位で整形し、メモリの小さい型に揃える (行ごとの関数呼び出しはしない)
+    - 銘柄コード: "7203" / "7203.0" → "7203.T"
+    - Side: 取引に「買」を含めば Buy、「売」を含めば Sell (それ以外は欠損)
+    - 銘柄コード・銘柄名・取引・Side はカテゴリ型、数量は float32
+    """
+    # 1. 銘柄コードの整形
+    raw_codes = df["銘柄コード"]
+    codes = raw_codes.astype(str).str.replace(".0", "", regex=False)
+    codes = codes.where(codes.str.endswith(".T"), codes + ".T").where(raw_codes.notna(), "")
+    df["銘柄コード"] = codes.astype("category")
+
+    # 2. 売買区分の判定
+    trade_type = df["取引"].astype("category")
+    labels = trade_type.cat.categories.astype(str)
+    # 取引の種類は少ないため、カテゴリごとに判定してコードで展開する
+    category_side = np.where(labels.str.contains("買"), "Buy", np.where(labels.str.contains("売"), "Sell", None))
+    side = np.append(category_side, None)[trade_type.cat.codes.to_numpy()]  # 欠損 (コード -1) は None
+    df["取引"] = trade_type
+    df["Side"] = pd.Categorical(side, categories=TRADE_SIDES)
+
+    # 3. 銘柄名
+    for col in ["銘柄名", "銘柄"]:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+
+    # 4. 数量は整数株のため float32 で正確に表せる (欠損があり得るため整数型にはしない)
+    #    約定単価は0.1円刻みがあり、損益を円で合計するため float64 のまま
+    for col in ["約定数量", "数量", "株数"]:
+        if col in df.columns:
+            df[col] = df[col].astype("float32")
+
+    # 5. 日付の処理
+    df["約定日"] = parse_trade_dates(df["約定日"])
+    return df
+
+def load_and_process_data(file):
+    """
+    CSVファイル (アップロードされたファイル、または open(path, "rb") したファイル) を読み込み、前処理を行う関数
+    ファイル全体を文字列化せず、逐次デコードしながらチャンク単位でパースする
+    """
+    try:
+        # 1. ヘッダー行の動的特定 (先頭部分のみ走査)
+        with stage("parse.header_scan"):
+            header_offset = find_header_offset(file)
+        if header_offset is None:
+            return None, "CSV内に「約定日」または「銘柄コード」が見つかりませんでした。"
+
+        # 2. CSV読み込み (逐次デコード + チャンク単位のパース)
+        with stage("parse.decode_read_csv") as timer:
+            file.seek(header_offset)
+            stream = io.TextIOWrapper(file, encoding=CSV_ENCODING, errors="ignore", newline="")
+            try:
+                reader = pd.read_csv(
+                    stream,
+                    usecols=lambda col: col in CSV_COLUMN_DTYPES,
+                    dtype=CSV_COLUMN_DTYPES,
+                    thousands=",",
+                    chunksize=CSV_CHUNK_ROWS,
+                )
+                # 3. 不要データの除外 (チャンクごとに行う)
+                chunks = [chunk.dropna(subset=["銘柄コード"]) for chunk in reader]
+            finally:
+                # アップロードされたファイル自体は閉じない
+                stream.detach()
+
+            df = pd.concat(chunks, ignore_index=True)
+            timer.rows = len(df)
+
+        with stage("parse.normalize", rows=len(df)):
+            normalize_trade_frame(df)
+
+        return df, None
+
+    except Exception as e:
+        return None, f"データ読み込み中にエラーが発生しました: {str(e)}"
+
+# 複数ファイル (口座ごとのエクスポート) の統合
+PARSE_WORKERS = 4  # 同時に読み込むファイル数の上限
+# 同じ約定とみなす列 (数量の列はファイルにあるものを使う)
+DEDUP_KEY_COLUMNS = ["約定日", "銘柄コード", "取引", "約定単価", "約定数量", "数量", "株数"]
+
+def sorted_run_order(dates):
+    """
+    1ファイルの行を約定日の昇順に並べる順序 (同じ日の行は元の順のまま)
+    SBI証券のCSVは新しい順のため、ほとんどの場合は日付の塊を逆に並べるだけになる
+    """
+    values = dates.to_numpy(dtype="datetime64[ns]")
+    if len(values) < 2 or (values[1:] >= values[:-1]).all():
+        return np.arange(len(values))
+    # 安定ソート (timsort) は既存の昇順・降順の並びをそのまま使うため、ほぼ線形で終わる
+    return np.argsort(values, kind="stable")
+
+def merge_sorted_runs(runs):
+    """
+    約定日の昇順に並んだ複数の配列 (ラン) を併合し、連結した配列での位置を併合後の順に返す
+    2つずつ二分探索で併合するため、全体の並べ替えは行わない (同じ日はファイルの順)
+    """
+    offsets = np.r_[0, np.cumsum([len(r) for r in runs])]
+    merged = [(keys, np.arange(start, start + len(keys))) for keys, start in zip(runs, offsets)]
+    while len(merged) > 1:
+        pairs = []
+        for (a_keys, a_idx), (b_keys, b_idx) in zip(merged[0::2], merged[1::2]):
+            # 併合後の位置 = 自分のランでの位置 + 相手のランで自分より前に来る要素の数
+            a_pos = np.arange(len(a_keys)) + np.searchsorted(b_keys, a_keys, side="left")
+            b_pos = np.arange(len(b_keys)) + np.searchsorted(a_keys, b_keys, side="right")
+            keys = np.empty(len(a_keys) + len(b_keys), dtype=a_keys.dtype)
+            idx = np.empty(len(keys), dtype=np.intp)
+            keys[a_pos], keys[b_pos] = a_keys, b_keys
+            idx[a_pos], idx[b_pos] = a_idx, b_idx
+            pairs.append((keys, idx))
+        if len(merged) % 2:
+            pairs.append(merged[-1])
+        merged = pairs
+    return merged[0][1] if merged else np.array([], dtype=np.intp)
+
+def merge_trade_frames(frames):
+    """
+    複数のファイルから読み込んだ約定データを約定日順の1つのデータにまとめ、重複する約定を除く
+    - 各ファイルを約定日の昇順の並びにしてから併合する (連結してからの並べ替えはしない)
+    - 約定日・銘柄コード・取引・約定単価・数量が同じ約定は、ファイルをまたいで1回だけ数える
+      (同じファイル内の同一の約定は別々の約定として残し、ファイル間では多い方の件数に揃える)
+    戻り値: (統合したデータ, 除いた重複の件数)
+    """
+    if len(frames) == 1:
+        return frames[0], 0
+
+    # 1. カテゴリ型の列はカテゴリを揃える (揃えないと連結で object 型に戻る)
+    frames = [df.copy(deep=False) for df in frames]
+    category_cols = {col for df in frames for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)}
+    for col in category_cols:
+        present = [df for df in frames if col in df.columns]
+        categories = pd.api.types.union_categoricals([df[col] for df in present], ignore_order=True).categories
+        for df in present:
+            df[col] = df[col].cat.set_categories(categories)
+
+    # 2. ファイルごとの昇順の並びを併合し、その順に連結したデータから取り出す
+    with stage("parse.merge_runs", rows=sum(len(df) for df in frames)):
+        orders = [sorted_run_order(df["約定日"]) for df in frames]
+        runs = [df["約定日"].to_numpy(dtype="datetime64[ns]")[order] for df, order in zip(frames, orders)]
+        offsets = np.cumsum([0] + [len(df) for df in frames[:-1]])
+        rows = np.concatenate([order + offset for order, offset in zip(orders, offsets)])[merge_sorted_runs(runs)]
+        source = np.repeat(np.arange(len(frames)), [len(df) for df in frames])[rows]
+        merged = pd.concat(frames, ignore_index=True).take(rows)
+        # 一部のファイルにしか無い列 (銘柄名 / 銘柄 など) は連結で object 型になるため戻す
+        for col in category_cols:
+            merged[col] = merged[col].astype("category")
+
+    # 3. 重複の除去 (キー列のハッシュ + ファイル内での出現回数が同じ行は2回目以降を除く)
+    with stage("parse.dedup", rows=len(merged)):
+        key_cols = [col for col in DEDUP_KEY_COLUMNS if col in merged.columns]
+        hashes = pd.util.hash_pandas_object(merged[key_cols], index=False).to_numpy()
+        occurrence = pd.DataFrame({"source": source, "hash": hashes}).groupby(["source", "hash"], sort=False).cumcount()
+        duplicated = pd.DataFrame({"hash": hashes, "occurrence": occurrence.to_numpy()}).duplicated().to_numpy()
+        merged = merged[~duplicated].reset_index(drop=True)
+
+    return merged, int(duplicated.sum())
+
+def load_trade_files(files, max_workers=PARSE_WORKERS):
+    """
+    複数のCSVを並列に読み込み (load_and_process_data)、merge_trade_frames で1つにまとめる
+    戻り値: (データ, エラーメッセージ, 除いた重複の件数)
+    """
+    if len(files) == 1:
+        df, error = load_and_process_data(files[0])
+        return df, error, 0
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(files)), thread_name_prefix="csv-parse") as pool:
+        results = list(pool.map(load_and_process_data, files))
+
+    errors = [f"{getattr(file, 'name', i)}: {error}" for i, (file, (_, error)) in enumerate(zip(files, results)) if error]
+    if errors:
+        return None, "\n".join(errors), 0
+
+    try:
+        df, duplicates = merge_trade_frames([df for df, _ in results])
+    except Exception as e:
+        return None, f"ファイルの統合中にエラーが発生しました: {str(e)}", 0
+    return df, None, duplicates
+
+def load_trade_bytes(uploads):
+    """
+    (ファイル名, 内容のバイト列) のリストから load_trade_files で読み込む (ワーカープロセスに渡すための入口)
+    """
+    files = []
+    for name, data in uploads:
+        file = io.BytesIO(data)
+        file.name = name
+        files.append(file)
+    return load_trade_files(files)
+
+# 突合結果 (約定ペア) と売れ残った買いロットの列と型
+HISTORY_DTYPES = {
+    'ticker': object, 'name': object,
+    'buy_date': 'datetime64[ns]', 'buy_price': 'float64',
+    'sell_date': 'datetime64[ns]', 'sell_price': 'float64',
+    'qty': 'float64', 'pnl': 'float64',
+}
+OPEN_LOT_DTYPES = {'ticker': object, 'name': object, 'date': 'datetime64[ns]', 'price': 'float64', 'qty': 'float64'}
+# 売り約定ごとの実現損益 (平均法)。moving_cost / total_cost はその売りの1株あたりの取得単価
+SELL_DTYPES = {
+    'ticker': object, 'name': object, 'date': 'datetime64[ns]', 'price': 'float64', 'qty': 'float64',
+    'moving_cost': 'float64', 'total_cost': 'float64',
+}
+# 銘柄ごとの保有株の平均取得単価 (差分分析で次回に引き継ぐ)
+AVG_COST_DTYPES = {'ticker': object, 'moving': 'float64', 'total': 'float64'}
+HISTORY_COLUMNS = list(HISTORY_DTYPES)
+OPEN_LOT_COLUMNS = list(OPEN_LOT_DTYPES)
+SELL_COLUMNS = list(SELL_DTYPES)
+
+# 取得単価の計算方法
+COST_METHODS = {
+    "fifo": "先入先出法 (FIFO)",
+    "moving": "移動平均法",
+    "total": "総平均法",
+}
+AVERAGE_METHODS = ["moving", "total"]
+RECURRENCE_BLOCK = 300.0  # solve_linear_recurrence のブロックの幅 (対数)。その2倍の exp まで float64 に収まる
+
+def sort_fills(df, qty_col, name_col=None, cost_cols=None):
+    """
+    突合の準備として、約定を 銘柄 (出現順) → 約定日 の順に一度だけ並べ替え、列ごとの配列にして返す
+    売買区分・数量・単価が揃っている約定だけを残し、保有数量を超える売りの実効数量 (effective_qty) もここで求める
+    FIFO (match_fifo_lots) と平均法 (average_cost_sells) はこの結果を共有する (並べ替えは1回)
+    cost_cols: {"moving": 列名, "total": 列名} を渡すと、その列の値 (欠損でない行) を平均法の取得単価に使う
+    (差分分析で前回の平均取得単価を引き継ぐため)
+    """
+    # 1. 銘柄 (出現順) → 約定日の順に一度だけ並べ替える (同日内は元の行順を維持)
+    ticker_codes, tickers = pd.factorize(df['銘柄コード'])
+    order = np.lexsort((df['約定日'].to_numpy(), ticker_codes))
+    sorted_codes = ticker_codes[order]
+
+    # 銘柄名は各銘柄の最初の行から取得
+    if name_col:
+        first_rows = order[np.searchsorted(sorted_codes, np.arange(len(tickers)))]
+        names = df[name_col].to_numpy()[first_rows]
+    else:
+        names = np.asarray(tickers, dtype=object)
+
+    # 2. 売買区分・数量・単価が揃っている行だけを対象にする
+    side = df['Side'].to_numpy()[order]
+    qty = pd.to_numeric(df[qty_col], errors='coerce').to_numpy(dtype='float64')[order]
+    price = pd.to_numeric(df['約定単価'], errors='coerce').to_numpy(dtype='float64')[order]
+    is_buy = side == 'Buy'
+    keep = (is_buy | (side == 'Sell')) & (qty > 0) & ~np.isnan(price)
+
+    rows = order[keep]
+    codes = sorted_codes[keep]
+    qty = qty[keep]
+    price = price[keep]
+    is_buy = is_buy[keep]
+    cost_price = {}
+    for method in AVERAGE_METHODS:
+        col = (cost_cols or {}).get(method)
+        override = df[col].to_numpy(dtype='float64')[rows] if col else np.full(len(rows), np.nan)
+        cost_price[method] = np.where(np.isnan(override), price, override)
+
+    fills = {
+        "tickers": np.asarray(tickers, dtype=object), "names": names, "rows": rows, "codes": codes,
+        "dates": df['約定日'].to_numpy()[rows], "qty": qty, "price": price, "is_buy": is_buy, "cost_price": cost_price,
+    }
+    if len(rows) == 0:
+        return fills
+
+    # 3. 累積数量 (全銘柄通し) と銘柄の先頭位置
+    group_start = np.r_[True, codes[1:] != codes[:-1]]
+    group_id = np.cumsum(group_start) - 1
+    start_pos = np.flatnonzero(group_start)
+
+    buy_qty = np.where(is_buy, qty, 0.0)
+    sell_qty = np.where(is_buy, 0.0, qty)
+    buy_cum = np.cumsum(buy_qty)
+    sell_cum = np.cumsum(sell_qty)
+
+    # 銘柄ごとのオフセット (その銘柄より前の買い数量の合計)
+    offset = (buy_cum - buy_qty)[start_pos][group_id]
+    local_buy = buy_cum - offset
+    local_sell = sell_cum - (sell_cum - sell_qty)[start_pos][group_id]
+
+    # 4. 保有数量を超える売りは突合しない (買いキューが空の売りは捨てる)
+    #    実効累積売り数量 E_j = Q_j + min(0, 銘柄内の累積最小値(B_j - Q_j))
+    headroom = pd.Series(local_buy - local_sell).groupby(group_id).cummin().to_numpy()
+    effective = local_sell + np.minimum(headroom, 0.0)
+    effective_qty = effective - np.r_[0.0, effective[:-1]]
+    effective_qty[start_pos] = effective[start_pos]
+
+    fills.update({
+        "group_id": group_id, "start_pos": start_pos, "offset": offset, "buy_cum": buy_cum,
+        "effective": effective, "effective_qty": effective_qty,
+        # 各約定の直前の保有数量 (実効の売りを差し引いたもの)
+        "holding_before": (local_buy - buy_qty) - (effective - effective_qty),
+    })
+    return fills
+
+def match_fifo_lots(df, qty_col, name_col=None, with_open_lots=False, fills=None):
+    """
+    FIFO (先入れ先出し) 法で買いと売りを突合し、約定ペアを列指向のDataFrameで返す
+    銘柄ごとの累積数量を一本の数直線に並べ、買いロットと売りロットの区間の重なりを
+    np.searchsorted で求めるため、行ループやキュー操作を行わない
+    with_open_lots=True の場合は (約定ペア, 売れ残った買いロット) を返す
+    fills: sort_fills の結果 (平均法と並べ替えを共有する場合に渡す)
+    """
+    fills = fills if fills is not None else sort_fills(df, qty_col, name_col)
+    if len(fills["rows"]) == 0:
+        empty = pd.DataFrame(columns=HISTORY_COLUMNS).astype(HISTORY_DTYPES)
+        return (empty, pd.DataFrame(columns=OPEN_LOT_COLUMNS).astype(OPEN_LOT_DTYPES)) if with_open_lots else empty
+
+    tickers, names, codes = fills["tickers"], fills["names"], fills["codes"]
+    qty, price, is_buy = fills["qty"], fills["price"], fills["is_buy"]
+    offset, buy_cum = fills["offset"], fills["buy_cum"]
+    effective, effective_qty = fills["effective"], fills["effective_qty"]
+
+    # 5. 買いロットと売りロットの区間 [start, end) を数直線上に配置
+    buy_idx = np.flatnonzero(is_buy)
+    buy_ends = buy_cum[buy_idx]
+
+    sell_idx = np.flatnonzero(~is_buy & (effective_qty > 0))
+    sell_ends = offset[sell_idx] + effective[sell_idx]
+    sell_starts = sell_ends - effective_qty[sell_idx]
+
+    # 6. 全ての区切り位置で区間を分割し、各区分を含む買い・売りロットを二分探索で特定
+    points = np.unique(np.concatenate(([0.0], buy_ends, sell_starts, sell_ends)))
+    seg_start = points[:-1]
+    seg_qty = np.diff(points)
+
+    s = np.searchsorted(sell_ends, seg_start, side='right')
+    matched = s < len(sell_ends)
+    matched[matched] = sell_starts[s[matched]] <= seg_start[matched]
+
+    s = s[matched]
+    b = np.searchsorted(buy_ends, seg_start[matched], side='right')
+    seg_qty = seg_qty[matched]
+
+    buy_rows = buy_idx[b]
+    sell_rows = sell_idx[s]
+
+    # 7. 列指向の結果を構築
+    dates = fills["dates"]
+    buy_price = price[buy_rows]
+    sell_price = price[sell_rows]
+
+    history = pd.DataFrame({
+        'ticker': tickers[codes[sell_rows]],
+        'name': names[codes[sell_rows]],
+        'buy_date': dates[buy_rows],
+        'buy_price': buy_price,
+        'sell_date': dates[sell_rows],
+        'sell_price': sell_price,
+        'qty': seg_qty,
+        'pnl': (sell_price - buy_price) * seg_qty,
+    })
+    if not with_open_lots:
+        return history
+
+    # 8. 売れ残った買いロット (銘柄ごとの消化済み位置より後ろの部分)
+    end_pos = np.r_[fills["start_pos"][1:] - 1, len(codes) - 1]
+    consumed_to = (offset[end_pos] + effective[end_pos])[fills["group_id"][buy_idx]]
+    remaining = buy_ends - np.maximum(buy_ends - qty[buy_idx], consumed_to)
+    is_open = remaining > 0
+    open_rows = buy_idx[is_open]
+
+    open_lots = pd.DataFrame({
+        'ticker': tickers[codes[open_rows]],
+        'name': names[codes[open_rows]],
+        'date': dates[open_rows],
+        'price': price[open_rows],
+        'qty': remaining[is_open],
+    })
+    return history, open_lots
+
+def solve_linear_recurrence(a, b):
+    """
+    x_k = a_k * x_(k-1) + b_k (0 <= a_k <= 1, x_(-1) = 0) を行ループ無しで解く
+    a_k = 0 の位置で系列が切り替わる (それより前の値を引き継がない)
+    x_k = Σ_(i<=k) b_i * exp(L_k - L_i) (L は系列内の log a の累積和) を求める。exp が桁あふれしないよう
+    L を RECURRENCE_BLOCK ごとのブロックに分け、同じブロックと1つ前のブロックの項だけを足す
+    (それより前の項の重みは exp(-RECURRENCE_BLOCK) 以下のため捨てる)
+    """
+    if len(a) == 0:
+        return np.zeros(0)
+    reset = a <= 0
+    reset[:1] = True
+    segment = np.cumsum(reset)
+    log_a = np.log(np.where(reset, 1.0, a))
+    level = pd.Series(log_a).groupby(segment).cumsum().to_numpy()  # 系列の先頭からの減衰 (0以下)
+    block = np.floor(-level / RECURRENCE_BLOCK)
+
+    # ブロックの上端 top を基準にした項。同じブロックから見ると指数は [0, W)、次のブロックから見ると [-W, 0)
+    top = -block * RECURRENCE_BLOCK
+    own = pd.Series(b * np.exp(top - level)).groupby([segment, block]).cumsum().to_numpy()
+    block_start = np.r_[True, (segment[1:] != segment[:-1]) | (block[1:] != block[:-1])]
+    block_id = np.cumsum(block_start) - 1
+    carry = np.bincount(block_id, weights=b * np.exp(top - RECURRENCE_BLOCK - level))
+
+    # 1つ前のブロック (同じ系列で番号が1つ小さいもの) の項を足す
+    starts = np.flatnonzero(block_start)
+    has_prev = np.r_[False, (segment[starts[1:]] == segment[starts[:-1]]) & (block[starts[1:]] == block[starts[:-1]] + 1)]
+    prev = np.where(has_prev, np.r_[0.0, carry[:-1]], 0.0)[block_id]
+    return np.exp(level - top) * (own + prev)
+
+def average_cost_sells(fills):
+    """
+    sort_fills の結果から、移動平均法と総平均法で売り約定ごとの取得単価を求める (行ループ無し)
+    - 移動平均法: 買うたびに (保有株の取得価額 + 買付代金) ÷ (保有数量 + 買付数量)。売りでは変わらない
+    - 総平均法: 銘柄ごと・暦年ごとに (年初の保有株の取得価額 + その年の買付代金) ÷ (年初の保有数量 + その年の買付数量)
+      その年の売りは全てこの単価を使い、年末の保有株もこの単価で翌年に繰り越す
+    どちらも「前の単価に重みを掛けて新しい代金を足す」一次の漸化式のため solve_linear_recurrence で解く
+    保有数量を超える売り (実効数量0) は FIFO と同じく除く
+    戻り値: (売り約定ごとの DataFrame (SELL_DTYPES), 銘柄ごとの最後の平均取得単価 (AVG_COST_DTYPES))
+    """
+    if len(fills["rows"]) == 0:
+        return (pd.DataFrame(columns=SELL_COLUMNS).astype(SELL_DTYPES),
+                pd.DataFrame(columns=list(AVG_COST_DTYPES)).astype(AVG_COST_DTYPES))
+
+    codes, qty, is_buy = fills["codes"], fills["qty"], fills["is_buy"]
+    holding = fills["holding_before"]
+    end_pos = np.r_[fills["start_pos"][1:] - 1, len(codes) - 1]
+
+    # 買いが1件も無ければ (売りだけのCSV、売りだけの差分) 実効数量のある売りも無い
+    buy_idx = np.flatnonzero(is_buy)
+    if buy_idx.size == 0:
+        return (pd.DataFrame(columns=SELL_COLUMNS).astype(SELL_DTYPES),
+                pd.DataFrame({
+                    'ticker': fills["tickers"][codes[end_pos]],
+                    'moving': np.nan,
+                    'total': np.nan,
+                }).astype(AVG_COST_DTYPES))
+
+    # 1. 移動平均法: 買い約定ごとの平均単価 (保有0からの買いで系列が切り替わる)
+    after = holding[buy_idx] + qty[buy_idx]
+    moving = np.zeros(len(codes))
+    moving[buy_idx] = solve_linear_recurrence(
+        holding[buy_idx] / after, qty[buy_idx] * fills["cost_price"]["moving"][buy_idx] / after
+    )
+    moving_cost = moving[np.maximum.accumulate(np.where(is_buy, np.arange(len(codes)), 0))]
+
+    # 2. 総平均法: 銘柄×暦年の期ごとの平均単価 (年初の保有が0の期で系列が切り替わる)
+    year = fills["dates"].astype("datetime64[Y]").astype("int64")
+    period_start = np.r_[True, (codes[1:] != codes[:-1]) | (year[1:] != year[:-1])]
+    period = np.cumsum(period_start) - 1
+    opening = holding[period_start]
+    bought = opening + np.bincount(period, weights=np.where(is_buy, qty, 0.0))
+    paid = np.bincount(period, weights=np.where(is_buy, qty * fills["cost_price"]["total"], 0.0))
+    safe = np.where(bought > 0, bought, 1.0)
+    total_cost = solve_linear_recurrence(
+        np.where(bought > 0, opening / safe, 0.0), np.where(bought > 0, paid / safe, 0.0)
+    )[period]
+
+    # 3. 実効数量のある売り約定
+    sell = np.flatnonzero(~is_buy & (fills["effective_qty"] > 0))
+    sells = pd.DataFrame({
+        'ticker': fills["tickers"][codes[sell]],
+        'name': fills["names"][codes[sell]],
+        'date': fills["dates"][sell],
+        'price': fills["price"][sell],
+        'qty': fills["effective_qty"][sell],
+        'moving_cost': moving_cost[sell],
+        'total_cost': total_cost[sell],
+    })
+
+    # 4. 銘柄ごとの最後の平均単価 (差分分析で引き継ぐ)
+    avg_cost = pd.DataFrame({
+        'ticker': fills["tickers"][codes[end_pos]],
+        'moving': moving_cost[end_pos],
+        'total': total_cost[end_pos],
+    })
+    return sells, avg_cost
+
+def method_trades(trade_history, sells, method):
+    """
+    取得単価の計算方法ごとの実現損益の表 (列 pnl を持つ)。FIFO は約定ペア、平均法は売り約定ごと
+    """
+    if method == "fifo":
+        return trade_history
+    return sells.assign(pnl=(sells['price'] - sells[f'{method}_cost']) * sells['qty'])
+
+def summarize_trades(trade_history):
+    """
+    約定ペアの損益から勝率・損益レシオなどを集計する
+    """
+    pnl = trade_history['pnl'].to_numpy()
+    wins = pnl > 0
+
+    win_count = int(wins.sum())
+    loss_count = len(pnl) - win_count
+    total_completed = len(pnl)
+
+    win_rate = (win_count / total_completed) * 100 if total_completed > 0 else 0
+
+    gross_profit = float(pnl[wins].sum())
+    gross_loss = abs(float(pnl[~wins].sum()))
+
+    avg_profit = gross_profit / win_count if win_count > 0 else 0
+    avg_loss = gross_loss / loss_count if loss_count > 0 else 0
+
+    # 損益レシオ (平均損失が0の場合は便宜上0または無限大とするが、ここでは表示用に調整)
+    risk_reward = avg_profit / avg_loss if avg_loss > 0 else float('inf')
+
+    return {
+        "win_rate": win_rate,
+        "risk_reward": risk_reward,
+        "total_trades": total_completed,
+        "avg_profit": avg_profit,
+        "avg_loss": avg_loss,
+        "win_count": win_count,
+        "loss_count": loss_count,
+        "gross_profit": gross_profit,
+        "gross_loss": gross_loss,
+    }
+
+def analyze_trade_performance(df, state=None):
+    """
+    データフレーム全体から売買ペアを特定し、損益レシオと勝率を計算する
+    FIFO (先入れ先出し) 法でBuyとSellを突合 (match_fifo_lots) し、同じ並べ替えの結果から
+    移動平均法・総平均法の売りごとの取得単価も求める (average_cost_sells)。結果の "methods" に方法ごとの集計が入る
+    (勝率などの最上位のキーは FIFO の集計)
+    state (前回の分析状態) を渡すと、state["last_date"] より後の約定だけを
+    前回の売れ残りロットに続けて突合し、前回までの履歴に追加する (新しい約定がある銘柄のみ)
+    結果の "state" には次回の差分分析に使う状態が入る
+    """
+    # 数量カラムの特定
+    qty_col = None
+    for col in ['約定数量', '数量', '株数']:
+        if col in df.columns:
+            qty_col = col
+            break
+            
+    # 銘柄名カラムの特定
+    name_col = None
+    for col in ['銘柄名', '銘柄']:
+        if col in df.columns:
+            name_col = col
+            break
+
+    if not qty_col:
+        return None, "数量データの列が見つかりません"
+
+    if state is None:
+        with stage("analysis.fifo_match", rows=len(df)):
+            fills = sort_fills(df, qty_col, name_col)
+            trade_history, open_lots = match_fifo_lots(df, qty_col, name_col, with_open_lots=True, fills=fills)
+        with stage("analysis.average_cost", rows=len(fills["rows"])):
+            sells, avg_cost = average_cost_sells(fills)
+        new_fills = len(df)
+        last_date = df['約定日'].max()
+    else:
+        # 前回の最終約定日より後の約定のみ (同日分は前回のCSVに含まれているものとみなす)
+        new_df = df[df['約定日'] > state['last_date']]
+        carried = state['open_lots']['ticker'].isin(new_df['銘柄コード'].unique())
+        lots = state['open_lots'][carried]
+
+        # 前回の売れ残りロットを買い約定として先頭に置き、新しい約定と続けて突合
+        # 平均法ではロットの単価の代わりに前回の平均取得単価を使う (総平均法は前回の状態の時点を期の区切りとみなす)
+        seed = pd.DataFrame({
+            '約定日': lots['date'],
+            '銘柄コード': lots['ticker'],
+            'Side': 'Buy',
+            '約定単価': lots['price'],
+            qty_col: lots['qty'],
+        })
+        if name_col:
+            seed[name_col] = lots['name']
+        fills = pd.concat([seed, new_df[seed.columns]], ignore_index=True)
+        carried_cost = state['avg_cost'].set_index('ticker').reindex(lots['ticker'])
+        cost_cols = {method: f'_{method}_cost' for method in AVERAGE_METHODS}
+        for method, col in cost_cols.items():
+            fills[col] = pd.Series(carried_cost[method].to_numpy()).reindex(fills.index)  # 新しい約定の行は欠損
+        with stage("analysis.fifo_match_incremental", rows=len(fills)):
+            sorted_fills = sort_fills(fills, qty_col, name_col, cost_cols=cost_cols)
+            new_history, new_open = match_fifo_lots(fills, qty_col, name_col, with_open_lots=True, fills=sorted_fills)
+        with stage("analysis.average_cost", rows=len(sorted_fills["rows"])):
+            new_sells, new_avg_cost = average_cost_sells(sorted_fills)
+
+        trade_history = pd.concat([state['history'], new_history], ignore_index=True)
+        open_lots = pd.concat([state['open_lots'][~carried], new_open], ignore_index=True)
+        sells = pd.concat([state['sells'], new_sells], ignore_index=True)
+        avg_cost = pd.concat(
+            [state['avg_cost'][~state['avg_cost']['ticker'].isin(new_avg_cost['ticker'])], new_avg_cost],
+            ignore_index=True,
+        )
+        new_fills = len(new_df)
+        last_date = max(state['last_date'], df['約定日'].max()) if new_fills else state['last_date']
+
+    # 集計
+    if trade_history.empty:
+        return None, "完了したトレード（売り買いのセット）が見つかりませんでした。"
+
+    with stage("analysis.summarize", rows=len(trade_history)):
+        summary = summarize_trades(trade_history)
+        methods = {"fifo": summary}
+        for method in AVERAGE_METHODS:
+            methods[method] = summarize_trades(method_trades(trade_history, sells, method))
+
+    return {
+        **summary,
+        "history": trade_history,
+        "sells": sells,
+        "methods": methods,
+        "new_fills": new_fills,
+        "state": {
+            "last_date": last_date, "open_lots": open_lots, "history": trade_history,
+            "sells": sells, "avg_cost": avg_cost,
+        },
+    }, None
+
+# --- 分析状態の保存・読み込み (月次の差分分析用) ---
+ANALYSIS_STATE_VERSION = 2
+STATE_DATE_COLUMNS = {"open_lots": ["date"], "history": ["buy_date", "sell_date"], "sells": ["date"], "avg_cost": []}
+STATE_DTYPES = {"open_lots": OPEN_LOT_DTYPES, "history": HISTORY_DTYPES, "sells": SELL_DTYPES, "avg_cost": AVG_COST_DTYPES}
+
+def dump_analysis_state(state):
+    """
+    分析状態 (最終約定日・売れ残りロット・約定ペア・平均法の売りと平均取得単価) を gzip 圧縮したJSONに変換する
+    """
+    payload = {"version": ANALYSIS_STATE_VERSION, "last_date": state["last_date"].strftime('%Y-%m-%d')}
+    for key, date_cols in STATE_DATE_COLUMNS.items():
+        frame = state[key]
+        payload[key] = {
+            col: frame[col].dt.strftime('%Y-%m-%d').tolist() if col in date_cols else frame[col].tolist()
+            for col in STATE_DTYPES[key]
+        }
+    return gzip.compress(json.dumps(payload, ensure_ascii=False).encode("utf-8"), compresslevel=6)
+
+def load_analysis_state(data):
+    """
+    dump_analysis_state で保存した分析状態を読み込む
+    平均法を加える前の形式 (バージョン1) は、売れ残りロットの加重平均を平均取得単価として引き継ぐ
+    (平均法の損益は読み込み後の約定の分だけになる)
+    """
+    try:
+        payload = json.loads(gzip.decompress(data))
+    except (OSError, ValueError) as e:
+        raise ValueError(f"分析状態ファイルを読み込めませんでした: {e}")
+    if payload.get("version") not in (1, ANALYSIS_STATE_VERSION):
+        raise ValueError("分析状態ファイルの形式が異なります。")
+
+    state = {"last_date": pd.Timestamp(payload["last_date"])}
+    for key, date_cols in STATE_DATE_COLUMNS.items():
+        frame = pd.DataFrame(payload.get(key, {}), columns=list(STATE_DTYPES[key]))
+        for col in date_cols:
+            frame[col] = pd.to_datetime(frame[col], format='%Y-%m-%d')
+        state[key] = frame.astype(STATE_DTYPES[key])
+    if payload["version"] == 1:
+        lots = state["open_lots"]
+        cost = (lots["price"] * lots["qty"]).groupby(lots["ticker"]).sum() / lots.groupby("ticker")["qty"].sum()
+        state["avg_cost"] = pd.DataFrame(
+            {"ticker": cost.index, "moving": cost.to_numpy(), "total": cost.to_numpy()}
+        ).astype(AVG_COST_DTYPES)
+    return state